@@ -135,10 +135,20 @@ class Addon(Comp):
             pass
             """ It should be initialized in init_comp_unit_or_comp_list. """
 
-    def set_prompt(self, prompt):
+    @property
+    def model_param_names(self):
+        """ Comps are created with addon inputs, so take the comp_class to know them before that. """
+        comps = list(self.comp_list)
+        if self.comp_class:
+            comps.append(self.comp_class())
+        return set().union(*(comp.model_param_names for comp in comps))
+
+    def set_prompt(self, prompt, batch_prompts=None, task_ids=None):
         self.prompt = prompt
+        self.batch_prompts = batch_prompts
+        self.task_ids = task_ids
         for comp in self.comp_list:
-            comp.set_prompt(prompt)
+            comp.set_prompt(prompt, batch_prompts, task_ids)
 
     def set_position_in_card(self, position):
         """ Addon can hold comps, comp can't for now, so it need share the position with comps it holds,
@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+
+
 class OutputsCache:
     """ The cache of outputs of a Func/Comp/Addon, used by prompt worker as a global outputs cache,
         and can also be used as an inner cache of Comp/Addon as a tmp storage for consistency.
@@ -19,15 +23,18 @@ class OutputsCache:
 
     def __init__(self):
         self.cache = {}
+        self._lock = threading.RLock()
+        """ Funcs of a card may run in parallel threads, guard the check-then-set and copy operations. """
 
     def cached_keys(self):
         return self.cache.keys()
 
     def cache_func_outputs(self, func_name: str, func_idx: int, outputs: dict):
-        if not self.get_func_outputs(func_name):
-            self.cache[func_name] = {}
+        with self._lock:
+            if not self.get_func_outputs(func_name):
+                self.cache[func_name] = {}
 
-        self.cache[func_name][func_idx] = outputs
+            self.cache[func_name][func_idx] = outputs
 
     def clear_func_outputs(self, func_name: str):
         if func_name in self.cache.keys():
@@ -52,4 +59,317 @@ class OutputsCache:
         return outputs_at_idx.get(param_name)
 
     def sync_cache(self, other_cache):
-        self.cache = {**other_cache.cache}
+        with other_cache._lock:
+            self.cache = {**other_cache.cache}
+
+
+def estimate_size_in_bytes(value, _seen=None) -> int:
+    """ Roughly estimate the memory a cached output holds, tensors/ModelPatcher/CLIP/VAE and containers of them
+        are counted, other python objects are taken as free.
+        Duck-typed on purpose so the cache don't need to import torch or comfy.
+    """
+
+    if _seen is None:
+        _seen = set()
+
+    if value is None or id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+
+    if hasattr(value, 'element_size') and hasattr(value, 'nelement'):  # torch.Tensor
+        return value.nelement() * value.element_size()
+
+    if callable(getattr(value, 'model_size', None)):  # ModelPatcher
+        try:
+            return value.model_size()
+        except Exception:
+            return 0
+
+    patcher = getattr(value, 'patcher', None)  # comfy.sd.CLIP / comfy.sd.VAE
+    if patcher is not None:
+        return estimate_size_in_bytes(patcher, _seen)
+
+    if isinstance(value, dict):
+        return sum(estimate_size_in_bytes(v, _seen) for v in value.values())
+
+    if isinstance(value, (list, tuple, set)):
+        return sum(estimate_size_in_bytes(v, _seen) for v in value)
+
+    return 0
+
+
+class ContentOutputsCache:
+    """ Content-addressed cache of Func/Comp/Addon outputs, used by prompt worker across prompts and cards.
+
+        The key is a fingerprint of the func's own widget inputs plus the fingerprints of its upstream funcs,
+        so it's Merkle-style over the card graph, same key means same outputs, no matter which card or prompt
+        it comes from. Entries are evicted in LRU order when the estimated bytes exceed the budget.
+        Outputs holding models are put to model_residency instead if there is one, they are kept by its budget.
+
+        cache data format:
+        {
+            fingerprint: {
+                index_of_func: {
+                    param_name: value
+                    ...
+                }
+                ...
+            }
+            ...
+        }
+    """
+
+    def __init__(self, budget_bytes: int, model_residency: 'ModelResidency | None' = None):
+        self.budget_bytes = budget_bytes
+        self.total_bytes = 0
+
+        self.model_residency = model_residency
+
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def keys(self):
+        with self._lock:
+            return list(self._entries.keys())
+
+    def get(self, key: str):
+        """ Return the cached outputs of the fingerprint and mark it recently used, None if missed. """
+
+        if self.model_residency is not None and key in self.model_residency:
+            return self.model_residency.get(key)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, func_outputs: dict):
+        """ Cache the outputs of one func, func_outputs is in form of {index_of_func: {param_name: value}}.
+            Return the keys evicted to make room for it.
+        """
+
+        if self.model_residency is not None and models_in(func_outputs):
+            self.remove(key)
+            return self.model_residency.put(key, func_outputs)
+
+        size = estimate_size_in_bytes(func_outputs)
+        with self._lock:
+            self.remove(key)
+
+            self._entries[key] = func_outputs
+            self._sizes[key] = size
+            self.total_bytes += size
+
+            return self.evict(keep=key)
+
+    def remove(self, key: str):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries.pop(key)
+            self.total_bytes -= self._sizes.pop(key, 0)
+
+    def evict(self, keep: str | None = None):
+        """ Drop least recently used entries until the cache fits its budget, the entry of keep is never dropped. """
+
+        evicted = []
+        with self._lock:
+            for key in list(self._entries.keys()):
+                if self.total_bytes <= self.budget_bytes:
+                    break
+                if key == keep:
+                    continue
+                self.remove(key)
+                evicted.append(key)
+        return evicted
+
+    def clear_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self.total_bytes = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'total_bytes': self.total_bytes,
+                'budget_bytes': self.budget_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+def models_in(value, _models=None) -> dict[int, int]:
+    """ Models an output holds, id of the torch module -> bytes of it. Clones of a ModelPatcher, e.g. patched by
+        LoRAs, share the module of the model they are cloned from, so they are one model here.
+    """
+
+    if _models is None:
+        _models = {}
+
+    if value is None:
+        return _models
+
+    if callable(getattr(value, 'model_size', None)):  # ModelPatcher
+        module = getattr(value, 'model', None)
+        if module is not None and id(module) not in _models:
+            try:
+                _models[id(module)] = value.model_size()
+            except Exception:
+                _models[id(module)] = 0
+        return _models
+
+    patcher = getattr(value, 'patcher', None)  # comfy.sd.CLIP / comfy.sd.VAE
+    if patcher is not None:
+        return models_in(patcher, _models)
+
+    if isinstance(value, dict):
+        for v in value.values():
+            models_in(v, _models)
+    elif isinstance(value, (list, tuple, set)):
+        for v in value:
+            models_in(v, _models)
+
+    return _models
+
+
+class ModelResidency:
+    """ Outputs of model loaders, e.g. checkpoint, UNet, CLIP, VAE and LoRA, kept across prompts and cards,
+        keyed by fingerprint like ContentOutputsCache, see PromptWorker.calculate_fingerprints.
+
+        comfy.model_management only holds weak references of models, it moves models between device and RAM, but
+        a model is gone once nothing holds it. Models stay warm here, no matter which prompt used them last, until
+        the bytes of models exceed the budget, then entries are dropped by policy:
+        'lru' drops the least recently used first, 'lfu' drops the least used first, and the least recently used
+        among the ones used equally.
+        A model shared by entries, e.g. a checkpoint and its LoRA patched clones, is counted once.
+    """
+
+    policies = ('lru', 'lfu')
+
+    def __init__(self, budget_bytes: int, policy: str = 'lru'):
+        assert policy in self.policies, f"Policy of model residency must be one of {self.policies}, got {policy}."
+
+        self.budget_bytes = budget_bytes
+        self.policy = policy
+        self.total_bytes = 0
+
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._entry_models: dict[str, dict[int, int]] = {}
+        self._model_refs: dict[int, int] = {}
+        """ id of module -> count of entries holding it. """
+        self._uses: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._uses[key] = self._uses.get(key, 0) + 1
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, func_outputs: dict):
+        """ Keep the outputs of a loader, return the keys evicted to make room for it. """
+
+        models = models_in(func_outputs)
+        with self._lock:
+            uses = self._uses.get(key, 0)
+            self.remove(key)
+
+            self._entries[key] = func_outputs
+            self._entry_models[key] = models
+            self._uses[key] = uses + 1
+            for module_id, size in models.items():
+                if not self._model_refs.get(module_id):
+                    self.total_bytes += size
+                self._model_refs[module_id] = self._model_refs.get(module_id, 0) + 1
+
+            return self.evict(keep=key)
+
+    def remove(self, key: str):
+        with self._lock:
+            if key not in self._entries:
+                return
+            self._entries.pop(key)
+            self._uses.pop(key, None)
+            for module_id, size in self._entry_models.pop(key, {}).items():
+                self._model_refs[module_id] -= 1
+                if not self._model_refs[module_id]:
+                    self._model_refs.pop(module_id)
+                    self.total_bytes -= size
+
+    def evict(self, keep: str | None = None):
+        """ Drop entries by policy until models fit the budget, the entry of keep is never dropped. """
+
+        evicted = []
+        with self._lock:
+            keys = list(self._entries.keys())  # least recently used first
+            if self.policy == 'lfu':
+                keys.sort(key=lambda key_: self._uses.get(key_, 0))
+
+            for key in keys:
+                if self.total_bytes <= self.budget_bytes:
+                    break
+                if key == keep:
+                    continue
+                self.remove(key)
+                evicted.append(key)
+
+            self.evictions += len(evicted)
+        return evicted
+
+    def clear_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._entry_models.clear()
+            self._model_refs.clear()
+            self._uses.clear()
+            self.total_bytes = 0
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'models': len(self._model_refs),
+                'total_bytes': self.total_bytes,
+                'budget_bytes': self.budget_bytes,
+                'policy': self.policy,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -7,7 +7,7 @@ from data_type.whatsai_card import PreModel, Prompt
 from misc.logger import logger
 from .addon import Addon
 from .comp import Comp
-from .func import Func, FuncOutput, FuncInput, Link, ParamPos
+from .func import Func, FuncIO, FuncOutput, FuncInput, Link, ParamPos
 from ..addons import ADD_ON_CLASS_MAP
 from ..comps import Comp_SamplerCustom
 from ..funcs import Func_KSampler, Func_KSamplerAdvanced, Func_SamplerCustomAdvanced, Func_SamplerCustom
@@ -43,9 +43,16 @@ class Card(ABC):
     name: str
     meta_data: dict  # a dict can be parsed to CardMetaData
 
+    preemptible = False
+    """ If True, the card's sampling can be paused for a task of higher priority and resumed later,
+        it's worth for long running cards, e.g. videos.
+    """
+
     def __init__(self):
 
         self.prompt: Prompt | None = None
+        self.batch_prompts: list[Prompt] | None = None
+        self.task_ids: list[int] | None = None
 
         self.func_list: list[Func] = []
         """ Because Comp and Addon are Func, func_list includes all three types of them, don't take it as a narrow Func. """
@@ -54,6 +61,23 @@ class Card(ABC):
         self._func_outputs: dict[str, list[FuncOutput]] = {}
         self._links: list[Link] = []
 
+        self._func_positions: dict[str, int] = {}
+        """ func_name -> position in func_list, kept in sync when funcs are registered or unregistered. """
+
+        self._io_of_funcs: dict[tuple[str, str, bool], FuncIO] = {}
+        """ (func_name, param_name, is_output) -> Input/Output, found by get_func_input/get_func_output. """
+
+        self._io_of_pos: dict[tuple[int, int, int, bool], tuple[FuncIO, int]] = {}
+        """ (func_position, func_index, param_pos, is_output) -> (IO, io_changes of its funcs) found by
+            map_pos_to_func_and_io_names, cleared when positions change. Names are read from the IO, so renames
+            follow, an IO whose funcs changed io_changes since, e.g. a SwitchableComp selected, is looked up again.
+        """
+
+        self._successor_bits: list[int] | None = None
+        """ Bit i of _successor_bits[position] is set if the func at position i follows the func at position,
+            directly or not. Worked out on demand, None after links or positions change.
+        """
+
         self.supported_addons: dict[str: Addon] = {}
 
         self.addon_positions = {}
@@ -200,20 +224,23 @@ class Card(ABC):
         return valid_errors
 
     def get_func(self, func_name):
-        for func in self.func_list:
-            if func.name == func_name:
-                return func
-        return None
+        position = self._func_positions.get(func_name)
+        return self.func_list[position] if position is not None else None
 
     def set_addon_positions(self, addon_positions: dict):
         self.addon_positions = addon_positions
 
-    def set_prompt(self, prompt):
-        """ Hold the prompt, then send to Func/Comp/Addon. """
+    def set_prompt(self, prompt, batch_prompts=None, task_ids=None):
+        """ Hold the prompt, then send to Func/Comp/Addon.
+            batch_prompts are the prompts of tasks running as one batch, prompt is merged from them then.
+            task_ids are ids of the tasks of them.
+        """
 
         self.prompt = prompt
+        self.batch_prompts = batch_prompts
+        self.task_ids = task_ids
         for func in self.func_list:
-            func.set_prompt(prompt)
+            func.set_prompt(prompt, batch_prompts, task_ids)
 
     def find_position_of_func(self, name_or_names):
         """ Find position by func_name, name list supported. """
@@ -229,10 +256,15 @@ class Card(ABC):
     def _find_position_of_func(self, name):
         """ Find position by single func_name. """
 
-        for index, func_ in enumerate(self.func_list):
-            if func_.name == name:
-                return index
-        return None
+        return self._func_positions.get(name)
+
+    def _reindex_funcs(self, start=0):
+        """ Update indexes of func_list from start, called after funcs are put in or taken out. """
+
+        for position in range(start, len(self.func_list)):
+            self._func_positions[self.func_list[position].name] = position
+        self._io_of_pos.clear()
+        self._successor_bits = None
 
     def _add_func_inputs(self, func: Func):
         self._func_inputs[func.name] = func.inputs.values()
@@ -243,19 +275,26 @@ class Card(ABC):
     def get_func_input(self, func_name, param_name):
         """ Get input of a Func with func_name and param_name. """
 
-        func_inputs = self._func_inputs.get(func_name, [])
-        for input_ in func_inputs:
-            if input_.name == param_name:
-                return input_
-        return None
+        return self._get_func_io(func_name, param_name, is_output=False)
 
     def get_func_output(self, func_name, param_name):
         """ Get output of a Func with func_name and param_name. """
 
-        func_outputs = self._func_outputs.get(func_name, [])
-        for output in func_outputs:
-            if output.name == param_name:
-                return output
+        return self._get_func_io(func_name, param_name, is_output=True)
+
+    def _get_func_io(self, func_name, param_name, is_output):
+        """ Names of IO can be changed after the func is registered, e.g. set_input_name, so a hit is checked. """
+
+        key = (func_name, param_name, is_output)
+        io = self._io_of_funcs.get(key)
+        if io is not None and io.name == param_name:
+            return io
+
+        func_ios = self._func_outputs.get(func_name, []) if is_output else self._func_inputs.get(func_name, [])
+        for io in func_ios:
+            if io.name == param_name:
+                self._io_of_funcs[key] = io
+                return io
         return None
 
     def register_func(self, func):
@@ -273,6 +312,7 @@ class Card(ABC):
         self._add_func_outputs(func)
 
         self.func_list.append(func)
+        self._reindex_funcs(func.position)
 
         if isinstance(func, Comp):
             self.add_links(func.links)
@@ -284,10 +324,11 @@ class Card(ABC):
 
         self.func_list.insert(after + 1, func)
         func.set_position_in_card(after + 1)
-        func.set_prompt(self.prompt)
+        func.set_prompt(self.prompt, self.batch_prompts, self.task_ids)
 
         for func_ in self.func_list[after + 2:]:
             func_.set_position_in_card(func_.position + 1)
+        self._reindex_funcs(after + 1)
 
         if isinstance(func, Comp):
             self.add_links(func.links)
@@ -295,11 +336,15 @@ class Card(ABC):
         return func.neat_outputs
 
     def unregister_func(self, func):
-        if func in self.func_list:
-            index = self.func_list.index(func)
-            self.func_list.remove(func)
-            for func_ in self.func_list[index:]:
-                func_.set_position_in_card(func_.position - 1)
+        index = self._func_positions.get(func.name)
+        if index is None or self.func_list[index] is not func:
+            return
+
+        self.func_list.pop(index)
+        self._func_positions.pop(func.name)
+        for func_ in self.func_list[index:]:
+            func_.set_position_in_card(func_.position - 1)
+        self._reindex_funcs(index)
 
     def link(self, output: FuncOutput, input_: FuncInput):
         """ Remember a link between one output and input. """
@@ -312,12 +357,14 @@ class Card(ABC):
         link_ = Link.link(frm=output, to=input_)
         if link_ not in self._links:
             self._links.append(link_)
+        self._successor_bits = None
 
     def unlink(self, output: FuncOutput, input_: FuncInput):
         for link_ in self._links:
             if link_.frm == output and link_.to == input_:
                 link_.unlink()
                 self._links.remove(link_)
+                self._successor_bits = None
                 break
 
     def add_links(self, links: list[Link]):
@@ -326,6 +373,7 @@ class Card(ABC):
         for link in links:
             if link not in self._links:
                 self._links.append(link)
+        self._successor_bits = None
 
     def replace_output(self, origin: FuncOutput, replace: FuncOutput):
         """  Take over an origin output
@@ -344,6 +392,7 @@ class Card(ABC):
             origin_input = link.to
             link.unlink()
             self.link(replace, origin_input)
+        self._successor_bits = None
 
         return replaced_items
 
@@ -397,25 +446,54 @@ class Card(ABC):
 
         addon.replaced_items = []
 
+    def get_func_predecessors(self, func: Func):
+        """ Names of Func/Comp/Addon the func links its inputs from directly, inner links excluded. """
+
+        predecessor_names = set()
+        for input_ in func.inputs.values():
+            if not input_.is_from_func or not input_.link:
+                continue
+            predecessor_name, _, _ = self.map_pos_to_func_and_io_names(input_.link.frm.pos)
+            if predecessor_name != func.name:
+                predecessor_names.add(predecessor_name)
+        return predecessor_names
+
     def get_func_successors(self, func: Func):
+        """ Names of Func/Comp/Addon following the func, directly or not. """
 
-        def get_successor_funcs(func_: Func):
-            successor_funcs = []
+        if func.position is None or func.position >= len(self.func_list):
+            return []
 
-            linked_inputs = [link.to for output in func_.outputs.values() for link in output.links]
-            func_indexes = [input_.pos.func_position for input_ in linked_inputs]
-            linked_funcs = [self.func_list[idx] for idx in set(func_indexes)]
+        successor_bits = self._get_successor_bits()[func.position]
+        return [func_.name for position, func_ in enumerate(self.func_list) if successor_bits >> position & 1]
 
-            if not linked_funcs:
-                return []
-            else:
-                successor_funcs.extend(linked_funcs)
-                for linked_func in linked_funcs:
-                    successor_funcs.extend(get_successor_funcs(linked_func))
+    def _get_successor_bits(self):
+        """ Each func is walked once, the successors of a func shared by branches are taken from its bits. """
+
+        if self._successor_bits is not None:
+            return self._successor_bits
+
+        func_count = len(self.func_list)
+        successor_bits: list[int | None] = [None] * func_count
 
-            return successor_funcs
+        def walk(position):
+            if successor_bits[position] is None:
+                successor_bits[position] = 0
+                bits = 0
+                for output in self.func_list[position].outputs.values():
+                    for link in output.links:
+                        to_position = link.to.pos.func_position
+                        if to_position is None or to_position == position or not 0 <= to_position < func_count:
+                            continue
+                        bits |= (1 << to_position) | walk(to_position)
+                successor_bits[position] = bits
+            return successor_bits[position]
 
-        return list(set([func_.name for func_ in get_successor_funcs(func)]))
+        for position_ in range(func_count):
+            walk(position_)
+
+        self._successor_bits = successor_bits
+        return successor_bits
 
     def set_supported_addons(self, addon_names: [str]):
         """ Set supported addons of card, it will use default info of Addon, if you need custom them
@@ -452,18 +530,19 @@ class Card(ABC):
         func_index = pos.func_index
         param_pos = pos.param_pos
 
-        func = self.func_list[func_pos]
-        func_name = func.name
-
-        if isinstance(func, Comp):
-            func = list(func.func_list)[func_index]
+        holder = self.func_list[func_pos]
+        func = holder.func_list[func_index] if isinstance(holder, Comp) else holder
+        io_changes = holder.io_changes + func.io_changes
 
-        if is_output:
-            param_name = list(func.outputs.values())[param_pos].name
-            return func_name, func_index, param_name
+        key = (func_pos, func_index, param_pos, is_output)
+        cached = self._io_of_pos.get(key)
+        if cached is not None and cached[1] == io_changes:
+            io = cached[0]
         else:
-            param_name = list(func.inputs.values())[param_pos].name
-            return func_name, func_index, param_name
+            io = list((func.outputs if is_output else func.inputs).values())[param_pos]
+            self._io_of_pos[key] = (io, io_changes)
+
+        return holder.name, func_index, io.name
 
     def get_ksampler_funcs(self):
         """ Get the kSampler func to preview. """
@@ -479,6 +558,43 @@ class Card(ABC):
                 k_samplers.append(func)
         return k_samplers
 
+    @property
+    def batchable_param_names(self):
+        """ Param names of widgets whose values can differ between prompts running as one batch,
+            empty if any kSampler of the card can't run a batch.
+        """
+
+        k_samplers = self.get_ksampler_funcs()
+        if not k_samplers or not all(k_sampler.batchable_inputs for k_sampler in k_samplers):
+            return set()
+
+        param_names = set()
+        for comp in self.comps:
+            if isinstance(comp, Addon):
+                continue
+            for func in comp.func_list:
+                for input_name in func.batchable_inputs:
+                    input_ = func.inputs.get(input_name)
+                    if input_ is not None and input_.is_from_widget:
+                        param_names.add(input_.mapped_name)
+        return param_names
+
+    @property
+    def model_param_names(self):
+        """ Param names of base widgets which tell the model files the card loads. """
+
+        param_names = set()
+        for comp in self.comps:
+            if not isinstance(comp, Addon):
+                param_names |= comp.model_param_names
+        return param_names
+
+    @property
+    def addon_model_param_names(self):
+        """ Same as model_param_names, for each supported addon in type of addon_name: param_names. """
+
+        return {addon_name: addon.model_param_names for addon_name, addon in self.supported_addons.items()}
+
     def print_debug_info(self):
         print("Func/Comp/Addon info:")
         for func in self.func_list:
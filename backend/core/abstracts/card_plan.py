@@ -0,0 +1,210 @@
+import threading
+from collections import OrderedDict
+from typing import Type
+
+from misc.logger import logger
+from .addon import Addon
+from .card import Card
+from .comp import Comp
+from .func import Func
+
+
+class PlannedFunc:
+    """ A Func run by a Func/Comp/Addon of card, the smallest unit prompt worker fingerprints and caches outputs of,
+        see PromptWorker.calculate_fingerprints.
+    """
+
+    def __init__(self, func: Func, comp: Comp | None, index: int, comp_index: int | None,
+                 widget_inputs: list[tuple[str, str]], upstream_links: list[tuple[str, str, int, str]]):
+        self.func = func
+
+        self.comp = comp
+        """ The Comp running the func, None if the func is registered to card directly. """
+
+        self.index = index
+        """ Index of the func in func_list of the comp. """
+
+        self.comp_index = comp_index
+        """ Index of the comp in comp_list of an Addon, its inputs are addon_inputs[addon_name][comp_index],
+            None if the func is not of an Addon, then base_inputs are taken.
+        """
+
+        self.widget_inputs = widget_inputs
+        """ (input_name, mapped_name) of inputs the func takes from widgets. """
+
+        self.upstream_links = upstream_links
+        """ (input_name, upstream func_name, upstream index, upstream param_name) of inputs the func takes
+            from other Func/Comp/Addon of card, inner links are left out, funcs before in the Comp/Addon are
+            taken as its upstream anyway.
+        """
+
+
+class CardPlan:
+    """ A card with its addons created for one addon structure, plus what prompt worker needs to run it, worked out
+        once: predecessors of funcs, ksamplers, and funcs run by every Func/Comp/Addon with the widget inputs and
+        upstream links they take, for fingerprints.
+
+        Tasks with the same card and addon structure reuse the plan, so they skip constructing the card and
+        create_addons, only the inputs are validated and the prompt set per task, see CardPlans.
+        A card holds the prompt and sampler callbacks of the task it runs, so a plan runs one task at a time.
+    """
+
+    def __init__(self, card: Card, key: tuple):
+        self.card = card
+        self.key = key
+
+        self.func_list = list(card.func_list)
+        self.addons: list[Addon] = card.addons
+        self.k_samplers = card.get_ksampler_funcs()
+        self.batchable_param_names = card.batchable_param_names
+
+        self.predecessors: dict[str, set[str]] = {
+            func.name: card.get_func_predecessors(func) for func in self.func_list
+        }
+        """ func_name -> names of Func/Comp/Addon it links inputs from, inner links excluded. """
+
+        self.planned_funcs: dict[str, list[PlannedFunc]] = {}
+        """ func_name -> funcs it runs in order, a Func runs itself, a Comp runs its func_list,
+            an Addon runs func_list of its comps one by one.
+        """
+
+        for func in self.func_list:
+            if isinstance(func, Addon):
+                self.planned_funcs[func.name] = [
+                    self.plan_func(func_, func, comp, index, comp_index)
+                    for comp_index, comp in enumerate(func.comp_list)
+                    for index, func_ in enumerate(comp.func_list)
+                ]
+            elif isinstance(func, Comp):
+                self.planned_funcs[func.name] = [
+                    self.plan_func(func_, func, func, index) for index, func_ in enumerate(func.func_list)
+                ]
+            else:
+                self.planned_funcs[func.name] = [self.plan_func(func, func, None, 0)]
+
+        self.in_use = False
+
+    def plan_func(self, func: Func, card_func: Func, comp: Comp | None, index: int, comp_index: int | None = None):
+        """ card_func is the Func/Comp/Addon registered to card which runs the func. """
+
+        widget_inputs = []
+        upstream_links = []
+        for input_ in func.inputs.values():
+            if input_.is_from_widget:
+                widget_inputs.append((input_.name, input_.mapped_name))
+                continue
+            if not input_.link:
+                continue
+            frm_pos = input_.link.frm.pos
+            if frm_pos.func_position == card_func.position:  # inner link of Comp/Addon
+                continue
+            upstream_name, upstream_index, param_name = self.card.map_pos_to_func_and_io_names(frm_pos)
+            upstream_links.append((input_.name, upstream_name, upstream_index, param_name))
+
+        return PlannedFunc(func, comp, index, comp_index, widget_inputs, upstream_links)
+
+    @property
+    def last_func(self):
+        return self.func_list[-1] if self.func_list else None
+
+    def make_type_right_and_valid_addon_inputs(self, addon_inputs: dict):
+        """ Same validation create_addons does, for the addons created already. """
+
+        valid_errors = []
+        for addon in self.addons:
+            errors = addon.make_type_right_and_valid_inputs(addon_inputs)
+            if errors:
+                valid_errors.extend(errors)
+                logger.debug(f"Addon: {addon.name} validation error: {errors}")
+        return valid_errors
+
+    def reset(self):
+        """ Clear what the last task left in the card, prompt and callbacks are set again by the next task. """
+
+        for k_sampler in self.k_samplers:
+            k_sampler.resume_from = None
+            k_sampler.step_hook = None
+
+        for func in self.func_list:
+            if isinstance(func, Comp):
+                func.cached_outputs.clear_all()
+
+
+class CardPlans:
+    """ CardPlan of cards keyed by card name and addon structure, least recently used keys are dropped when
+        there are more than max_plans.
+    """
+
+    def __init__(self, max_plans: int):
+        self.max_plans = max_plans
+
+        self._plans: OrderedDict[tuple, list[CardPlan]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def addon_key(cls, addon_inputs: dict | None) -> tuple:
+        """ What decides the funcs and links of addons: which addons, how many comps each, and the comp selected
+            of switchable addons. Values of addon widgets are not in it, they are taken per task.
+        """
+
+        key = []
+        for addon_name, inputs_list in (addon_inputs or {}).items():
+            inputs_list = inputs_list or []
+            selected_comp_name = inputs_list[0].get('selected_comp_name') if inputs_list else None
+            key.append((addon_name, len(inputs_list), str(selected_comp_name)))
+        return tuple(sorted(key))
+
+    def acquire(self, card_name: str, card_class: Type[Card], addon_inputs: dict | None) -> tuple[CardPlan, list]:
+        """ Take a free plan of the card for the addon inputs, or build one, return it with validation errors of
+            addon inputs. Give it back by release after the task.
+        """
+
+        key = (card_name, self.addon_key(addon_inputs))
+
+        with self._lock:
+            plan = next((plan for plan in self._plans.get(key, []) if not plan.in_use), None)
+            if plan is not None:
+                plan.in_use = True
+                self._plans.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if plan is not None:
+            plan.reset()
+            return plan, plan.make_type_right_and_valid_addon_inputs(addon_inputs or {})
+
+        card = card_class()
+        errors = card.create_addons(addon_inputs or {})
+        plan = CardPlan(card, key)
+        plan.in_use = True
+
+        if not errors:  # addons are not all created if inputs are invalid.
+            with self._lock:
+                self._plans.setdefault(key, []).append(plan)
+                self._plans.move_to_end(key)
+                while len(self._plans) > self.max_plans:
+                    self._plans.popitem(last=False)
+
+        return plan, errors
+
+    def release(self, plan: CardPlan):
+        with self._lock:
+            plan.in_use = False
+
+    def clear_all(self):
+        with self._lock:
+            self._plans.clear()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'plans': sum(len(plans) for plans in self._plans.values()),
+                'keys': len(self._plans),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
@@ -23,6 +23,11 @@ class Comp(Func):
         self._widgets: dict[str: Widget] = {}
         """ Notice: the key of _widgets is for inner use only, use param_name in widget to make sure high level uniqueness. """
 
+        self.defaulted_param_names: set[str] = set()
+        """ Params taking the default value of their widgets when inputs miss them, e.g. opt-in widgets added later,
+            so prompts queued before and API clients not knowing them still pass validation.
+        """
+
         self.func_list: list[Func] = []
         """ A Comp can hold multiple Funcs, if you do that, remember to map Inputs and Outputs of Funcs and Comp,
             and connect the inner Inputs and Outputs manually, turn register_func's share_io off.
@@ -48,9 +53,41 @@ class Comp(Func):
 
         self.cached_outputs = OutputsCache()
 
+        self.func_fingerprints: dict[int, str | None] = {}
+        """ Index of func in func_list -> fingerprint of the func's outputs in this execution, set by prompt worker.
+            Outputs of the func are taken from func_outputs_cache by it instead of running the func if there.
+        """
+
+        self.func_outputs_cache = None
+        """ A ContentOutputsCache shared by prompts, None to run every func. """
+
         # todo?: when the comp is optional, design a mechanism to make it work with its backup outputs,
         #  or keep using addon as the Option solver
 
+    @property
+    def resource(self):
+        """ Funcs of a Comp run in order, so the Comp takes the busiest resource of them. """
+        resources = {func.resource for func in self.func_list}
+        for resource in ('device', 'cpu', 'disk'):
+            if resource in resources:
+                return resource
+        return 'device'
+
+    @property
+    def loads_models(self):
+        return any(func.loads_models for func in self.func_list)
+
+    @property
+    def model_param_names(self):
+        """ Param names of widgets which tell the model files the comp loads. """
+        param_names = set()
+        for func in self.func_list:
+            for input_name in func.model_inputs:
+                input_ = func.inputs.get(input_name)
+                if input_ is not None and input_.is_from_widget:
+                    param_names.add(input_.mapped_name)
+        return param_names
+
     @property
     def func_inputs(self):
         return {name: _input for name, _input in self._inputs.items() if _input.is_from_func}
@@ -82,10 +119,16 @@ class Comp(Func):
             }
         return result
 
-    def set_prompt(self, prompt):
+    def set_prompt(self, prompt, batch_prompts=None, task_ids=None):
         self.prompt = prompt
+        self.batch_prompts = batch_prompts
+        self.task_ids = task_ids
         for func in self.func_list:
-            func.set_prompt(prompt)
+            func.set_prompt(prompt, batch_prompts, task_ids)
+
+    def outputs_of_artworks(self, artworks: list) -> dict | None:
+        """ Outputs of a Comp are the ones of its last func. """
+        return self.func_list[-1].outputs_of_artworks(artworks) if self.func_list else None
 
     def set_position_in_card(self, position):
         """ A comp can hold funcs, which Func do not, so do it after it's origin manner. """
@@ -153,13 +196,17 @@ class Comp(Func):
         for name, widget in self._widgets.items():
             widget.param_name = name
 
-    def register_widget(self, widget):
-        """ Add a widget to comp, do when comp init, make sure it's after the Func which the widget's param belongs. """
+    def register_widget(self, widget, default_if_missing=False):
+        """ Add a widget to comp, do when comp init, make sure it's after the Func which the widget's param belongs.
+            default_if_missing lets inputs miss the param, see defaulted_param_names.
+        """
 
         assert widget.param_name in self._inputs.keys(), f"Widget's param_name: {widget.param_name} not found in inputs, register func first, or make sure widget's param_name is exactly same as param of the Func."
 
         self._widgets[widget.param_name] = widget
         self._inputs[widget.param_name].source = 'widget'
+        if default_if_missing:
+            self.defaulted_param_names.add(widget.param_name)
 
     def register_func(self, func: Func, share_io=True):
         """ Register a func in comp, share_io means the comp share inputs and outputs with the func,
@@ -245,6 +292,10 @@ class Comp(Func):
         """
         errors = []
 
+        for param_name in self.defaulted_param_names:
+            if param_name not in inputs:
+                inputs[param_name] = self.widgets[param_name].value
+
         widget_param_names = list(self.widgets.keys())
         for param_name, param_value in inputs.items():
             widget = self.widgets.get(param_name)
@@ -268,11 +319,14 @@ class Comp(Func):
             is_first = index == 0
             is_last = index == len(self.func_list) - 1
 
+            func_outputs = self.get_func_outputs_by_fingerprint(index)
+            if func_outputs is None:
+                upstream_outputs = cached_outputs if is_first else self.cached_outputs
+                func_outputs = func.execute(inputs, upstream_outputs, card, func_name)
+                self.put_func_outputs_by_fingerprint(index, func_outputs)
+
             if is_first:
-                func_outputs = func.execute(inputs, cached_outputs, card, func_name)
                 self.cached_outputs.sync_cache(cached_outputs)
-            else:
-                func_outputs = func.execute(inputs, self.cached_outputs, card, func_name)
 
             self.cached_outputs.cache_func_outputs(func_name, index, func_outputs)
 
@@ -281,6 +335,21 @@ class Comp(Func):
                 cached_outputs.cache_func_outputs(func_name, index, func_outputs)
                 return func_outputs
 
+    def get_func_outputs_by_fingerprint(self, index):
+        fingerprint = self.func_fingerprints.get(index)
+        if fingerprint is None or self.func_outputs_cache is None:
+            return None
+
+        cached = self.func_outputs_cache.get(fingerprint)
+        return cached.get(index) if cached is not None else None
+
+    def put_func_outputs_by_fingerprint(self, index, func_outputs: dict):
+        fingerprint = self.func_fingerprints.get(index)
+        if fingerprint is None or self.func_outputs_cache is None:
+            return
+
+        self.func_outputs_cache.put(fingerprint, {index: func_outputs})
+
     @classmethod
     def widgets_info_of_comps(cls, comps):
         return {**{key: value for comp in comps for key, value in comp.widgets_info.items()}}
@@ -298,6 +367,11 @@ class SwitchableComp(Comp):
         for comp in comp_list:
             self.comps[comp.name] = comp
 
+    @property
+    def model_param_names(self):
+        """ Any of the comps can be selected, so take all of them. """
+        return set().union(*(comp.model_param_names for comp in self.comps.values()))
+
     def select_comp(self, comp_name):
         self.selected_comp_name = comp_name
         selected_comp = self.comps.get(comp_name)
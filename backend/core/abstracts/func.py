@@ -12,6 +12,29 @@ from misc.logger import logger
 InputSource = Literal['widget', 'func']
 """ Input Source of a func param, widget means it comes from use input, other func otherwise. """
 
+FuncResource = Literal['device', 'disk', 'cpu']
+""" What a Func mostly waits on when it runs, 'device' means GPU or whatever torch device does the work,
+    'disk' for loaders reading files, 'cpu' for pure python/numpy work. Prompt worker uses it to decide
+    which funcs can run at the same time.
+"""
+
+
+class BatchedInputs(list):
+    """ Widget values of one param from several prompts, used when prompts of the same card run as one batch,
+        e.g. different seeds or positive prompts, the order is the order of prompts.
+    """
+
+    @property
+    def is_uniform(self):
+        return all(value == self[0] for value in self)
+
+
+def unbatch_if_uniform(value):
+    """ Take the single value out if all prompts of the batch share it, so it's comparable with an unbatched one. """
+    if isinstance(value, BatchedInputs) and value.is_uniform:
+        return value[0]
+    return value
+
 
 class FuncPos:
     """ Two dimension position, one for where it locates in cards, and the other is the index of the position,
@@ -176,6 +199,22 @@ class FuncOutput(FuncIO):
 
 
 class Func(ABC):
+    resource: FuncResource = 'device'
+    """ Override it in subclass if the Func is not mostly a device work, e.g. loaders. """
+
+    loads_models = False
+    """ Set True if the Func builds models through comfy model_management, e.g. checkpoint and CLIP loaders, which
+        may load or unload models on device, so it never runs at the same time as device funcs using them.
+    """
+
+    batchable_inputs: tuple[str, ...] = ()
+    """ Names of widget inputs can differ between prompts running as one batch, the Func must override run_batch
+        to support them.
+    """
+
+    model_inputs: tuple[str, ...] = ()
+    """ Names of widget inputs which tell the model file to load, queued tasks sharing them run together. """
+
     def __init__(self, name=None):
         self.name = name
 
@@ -185,12 +224,21 @@ class Func(ABC):
         self.index = 0
         """ The index of the Func in Comp or Addon, it is 0 if it's a func. """
 
+        self.io_changes = 0
+        """ Counts the inputs/outputs of the func replaced by share_io etc., IO a card cached of it is stale then. """
+
         self._inputs: Box = Box()
         self._outputs: Box = Box()
         """ Use Box just for dot access: SomeFunc.inputs.some_param_name for easy use. """
 
         self.prompt: Prompt | None = None
 
+        self.batch_prompts: list[Prompt] | None = None
+        """ Prompts of the tasks when they run as one batch, the order is same as values of BatchedInputs. """
+
+        self.task_ids: list[int] | None = None
+        """ Ids of the tasks of prompt or batch_prompts in the same order, artworks saved are tagged with them. """
+
     @property
     def inputs(self):
         return self._inputs
@@ -285,9 +333,39 @@ class Func(ABC):
         for input_ in self._inputs.values():
             input_.pos.func_pos.index = index
 
-    def set_prompt(self, prompt):
+    def set_prompt(self, prompt, batch_prompts=None, task_ids=None):
         """ Every Func/Comp/Addon holds the prompt, like ComfyUI's hidden input. """
         self.prompt = prompt
+        self.batch_prompts = batch_prompts
+        self.task_ids = task_ids
+
+    def get_prompt_index_of_batch_index(self, batch_index, batch_size):
+        """ Index in batch_prompts of the prompt an element of outputs belongs to, batch_size is the element count
+            of the outputs, it's always 0 when not running as a batch.
+        """
+        if not self.batch_prompts:
+            return 0
+
+        per_prompt = max(batch_size // len(self.batch_prompts), 1)
+        return min(batch_index // per_prompt, len(self.batch_prompts) - 1)
+
+    def get_prompt_of_batch_index(self, batch_index, batch_size):
+        """ The prompt an element of outputs belongs to, it's always self.prompt when not running as a batch. """
+        if not self.batch_prompts:
+            return self.prompt
+        return self.batch_prompts[self.get_prompt_index_of_batch_index(batch_index, batch_size)]
+
+    def get_task_id_of_batch_index(self, batch_index, batch_size):
+        """ Id of the task an element of outputs belongs to, None if the prompt is not of a task. """
+        if not self.task_ids:
+            return None
+        return self.task_ids[self.get_prompt_index_of_batch_index(batch_index, batch_size)]
+
+    def outputs_of_artworks(self, artworks: list) -> dict | None:
+        """ Outputs the func would return for artworks it saved, None if it saves no artworks, see
+            PromptWorker.finish_tasks_with_saved_artworks.
+        """
+        return None
 
     def set_input_name(self, origin_name, name):
         """ origin_name is set when the Func defined,
@@ -307,18 +385,21 @@ class Func(ABC):
 
         self._inputs = other_func.inputs
         self._outputs = other_func.outputs
+        self.io_changes += 1
 
     def share_inputs(self, other_func):
         """ Shallow copy of inputs. """
 
         assert isinstance(other_func.inputs, Box), f"Type of inputs of other func: {other_func} must be Box"
         self._inputs = other_func.inputs
+        self.io_changes += 1
 
     def share_outputs(self, other_func):
         """ Shallow copy of outputs. """
 
         assert isinstance(other_func.outputs, Box), f"Type of outputs of other func: {other_func} must be Box"
         self._outputs = other_func.outputs
+        self.io_changes += 1
 
     def get_func_inputs(self, inputs: dict, cached_outputs: OutputsCache, card):
         input_values = {}
@@ -359,12 +440,26 @@ class Func(ABC):
         """
 
         inputs = self.get_func_inputs(inputs, cached_outputs, card)
-        executed_outputs = self.run(**inputs)
+        if any(isinstance(value, BatchedInputs) for value in inputs.values()):
+            executed_outputs = self.run_batch(**inputs)
+        else:
+            executed_outputs = self.run(**inputs)
         return self.transform_outputs(executed_outputs)
 
     def run(self, *args, **kwargs):
         raise NotImplementedError()
 
+    def run_batch(self, **inputs):
+        """ Run with inputs of several prompts at once, values of batchable_inputs come in BatchedInputs.
+            The default works only when all prompts share the same values, override it to support batchable_inputs.
+        """
+        unbatched_inputs = {}
+        for name, value in inputs.items():
+            value = unbatch_if_uniform(value)
+            assert not isinstance(value, BatchedInputs), f"Func: {self.name} can't run a batch of different {name}."
+            unbatched_inputs[name] = value
+        return self.run(**unbatched_inputs)
+
     def __eq__(self, other):
         return self.name == other.name
 
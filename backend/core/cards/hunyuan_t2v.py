@@ -18,6 +18,7 @@ from core.funcs import Func_BasicGuider, Func_SamplerCustomAdvanced
 
 class HunyuanT2VCard(Card):
     name = 'HunyuanT2v'
+    preemptible = True
     meta_data = {
         'name': name,
         'display_name': "Hunyuan T2V",
@@ -16,6 +16,7 @@ from core.funcs import Func_VAEDecode, Func_SaveImage
 
 class LightricksI2VCard(Card):
     name = 'LightricksI2V'
+    preemptible = True
     meta_data = {
         'name': name,
         'display_name': "Lightricks I2V",
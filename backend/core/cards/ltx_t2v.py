@@ -15,6 +15,7 @@ from core.funcs import Func_VAEDecode
 
 class LightricksT2VCard(Card):
     name = 'LightricksT2V'
+    preemptible = True
     meta_data = {
         'name': name,
         'display_name': "Lightricks T2V",
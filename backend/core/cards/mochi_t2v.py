@@ -13,6 +13,7 @@ from core.funcs import Func_VAEDecode
 
 class MochiT2VCard(Card):
     name = 'MochiT2v'
+    preemptible = True
     meta_data = {
         'name': name,
         'display_name': "Mochi T2V",
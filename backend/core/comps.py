@@ -183,6 +183,38 @@ class Comp_EmptyLatentImage(Comp):
         self.register_widget(widget_height)
 
 
+def register_cfg_widgets(comp: Comp, skip_uncond_tail=0.0, uncond_reuse_interval=1, batched_cfg=False):
+    """ Widgets of the opt-in CFG modes of KSampler comps, see CfgOptions, prompts missing them take the defaults. """
+
+    widget_skip_uncond_tail = FloatWidget(
+        display_name='Skip Uncond Tail',
+        param_name='skip_uncond_tail',
+        default_value=skip_uncond_tail,
+        min=0.0,
+        max=1.0,
+        step=0.05,
+        round=2
+    )
+    comp.register_widget(widget_skip_uncond_tail, default_if_missing=True)
+
+    widget_uncond_reuse_interval = IntWidget(
+        display_name='Uncond Reuse Interval',
+        param_name='uncond_reuse_interval',
+        default_value=uncond_reuse_interval,
+        min=1,
+        max=10,
+        step=1
+    )
+    comp.register_widget(widget_uncond_reuse_interval, default_if_missing=True)
+
+    widget_batched_cfg = BoolWidget(
+        display_name='Batched CFG',
+        param_name='batched_cfg',
+        default_value=batched_cfg
+    )
+    comp.register_widget(widget_batched_cfg, default_if_missing=True)
+
+
 class Comp_KSampler(Comp):
     def __init__(self,
                  name="KSampler",
@@ -194,7 +226,10 @@ class Comp_KSampler(Comp):
                  sampler_name='euler',
                  scheduler_name='normal',
                  grouped_widgets=True,
-                 preview_steps=3
+                 preview_steps=3,
+                 skip_uncond_tail=0.0,
+                 uncond_reuse_interval=1,
+                 batched_cfg=False,
                  ):
         super().__init__(name=name, display_name=display_name, grouped_widgets=grouped_widgets)
 
@@ -256,6 +291,8 @@ class Comp_KSampler(Comp):
         )
         self.register_widget(widget_denoise)
 
+        register_cfg_widgets(self, skip_uncond_tail, uncond_reuse_interval, batched_cfg)
+
 
 class Comp_KSamplerAdvanced(Comp):
     def __init__(self,
@@ -271,6 +308,9 @@ class Comp_KSamplerAdvanced(Comp):
                  end_at_step=10000,
                  return_with_leftover_noise='disable',
                  preview_steps=3,
+                 skip_uncond_tail=0.0,
+                 uncond_reuse_interval=1,
+                 batched_cfg=False,
                  ):
         super().__init__(name=name, display_name=display_name, grouped_widgets=True)
 
@@ -357,6 +397,8 @@ class Comp_KSamplerAdvanced(Comp):
         )
         self.register_widget(widget_return_with_leftover_noise)
 
+        register_cfg_widgets(self, skip_uncond_tail, uncond_reuse_interval, batched_cfg)
+
 
 class Comp_CLIPSetLastLayer(Comp):
     def __init__(self, name="Clip Skip", display_name='Clip Skip'):
@@ -20,13 +20,18 @@ import comfy.model_patcher
 import comfy.controlnet
 import comfy.model_sampling
 from comfy.taesd.taesd import TAESD
-from core.abstracts.func import Func, IOInfo
+from core.abstracts.func import Func, IOInfo, BatchedInputs
 from data_type.whatsai_artwork import Artwork
 from data_type.whatsai_model_dir import ModelDir
 from data_type.whatsai_model_info import ModelInfo
 from core.extras import tae_model_info_list
-from misc.helpers import pillow, get_meta_info, conditioning_set_values
+from core.model_loaders import load_checkpoint, load_clip, load_diffusion_model
+from misc.helpers import pillow, get_meta_info, conditioning_set_values, repeat_conds_per_task
 from misc.logger import logger
+from misc.cfg_options import CFG_OPTIONS_KEY, CfgOptions
+from misc.cond_cache import CondCache
+from misc.lora_fusion import LoraFusion
+from misc.state_dict_cache import StateDictCache, file_key
 
 try:
     from spandrel_extra_arches import EXTRA_REGISTRY
@@ -39,6 +44,10 @@ except Exception as e:
 
 
 class Func_CheckpointLoaderSimple(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('checkpoint_id',)
+
     def __init__(self, name="Checkpoint Loader"):
         super().__init__(name=name)
 
@@ -53,20 +62,17 @@ class Func_CheckpointLoaderSimple(Func):
         )
 
     def run(self, checkpoint_id):
-        checkpoint_path = ModelInfo.get(checkpoint_id).local_path
+        model_info = ModelInfo.get(checkpoint_id)
         embedding_directories = ModelDir.get_dirs('embedding')
 
-        out = comfy.sd.load_checkpoint_guess_config(
-            checkpoint_path,
-            output_vae=True,
-            output_clip=True,
-            embedding_directory=embedding_directories
-        )
-
-        return out[:3]
+        return load_checkpoint(model_info.local_path, embedding_directory=embedding_directories,
+                               sha_256=model_info.sha_256)[:3]
 
 
 class Func_VAELoader(Func):
+    resource = 'disk'
+    model_inputs = ('vae_id',)
+
     def __init__(self, name="Load VAE"):
         super().__init__(name=name)
 
@@ -93,7 +99,7 @@ class Func_VAELoader(Func):
             sd = self.load_taesd(vae_model_info)
         else:
             vae_path = vae_model_info.local_path
-            sd = comfy.utils.load_torch_file(vae_path)
+            sd = StateDictCache.load_torch_file(vae_path)
 
         vae = comfy.sd.VAE(sd=sd)
         return (vae,)
@@ -102,11 +108,11 @@ class Func_VAELoader(Func):
         encoder_path, decoder_path = vae_model.local_path.split('|')
         name = Path(encoder_path).stem.replace('_encoder', '')
         sd = {}
-        enc = comfy.utils.load_torch_file(encoder_path)
+        enc = StateDictCache.load_torch_file(encoder_path)
         for k in enc:
             sd["taesd_encoder.{}".format(k)] = enc[k]
 
-        dec = comfy.utils.load_torch_file(decoder_path)
+        dec = StateDictCache.load_torch_file(decoder_path)
         for k in dec:
             sd["taesd_decoder.{}".format(k)] = dec[k]
 
@@ -126,6 +132,8 @@ class Func_VAELoader(Func):
 
 
 class Func_CLIPTextEncode(Func):
+    batchable_inputs = ('text',)
+
     def __init__(self, name="ClipTextEncoder"):
         super().__init__(name=name)
 
@@ -140,8 +148,23 @@ class Func_CLIPTextEncode(Func):
         )
 
     def run(self, clip, text):
-        tokens = clip.tokenize(text)
-        output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
+        output = CondCache.encode(clip, text)
+        cond = output.pop("cond")
+        return ([[cond, output]],)
+
+    def run_batch(self, clip, text: BatchedInputs):
+        """ Encode text of each prompt, stack them in batch dim, so each sample of the batch get its own cond. """
+        if text.is_uniform:
+            return self.run(clip, text[0])
+
+        outputs = CondCache.encode_batch(clip, list(text))
+
+        output = {**outputs[0]}
+        for key, value in outputs[0].items():
+            values = [output_.get(key) for output_ in outputs]
+            if all(isinstance(value_, Tensor) for value_ in values):
+                output[key] = stack_in_batch_dim(values)
+
         cond = output.pop("cond")
         return ([[cond, output]],)
 
@@ -167,21 +190,103 @@ class Func_EmptyLatentImage(Func):
         return ({"samples": latent},)
 
 
+def stack_in_batch_dim(tensors: list[Tensor]):
+    """ Stack cond tensors of prompts in batch dim, token dim of crossattn conds are repeated to their lcm
+        like ComfyUI's CONDCrossAttn.concat do, so prompts of different length can be stacked.
+    """
+    if tensors[0].ndim == 3:
+        token_len = 1
+        for tensor in tensors:
+            token_len = math.lcm(token_len, tensor.shape[1])
+        tensors = [tensor.repeat(1, token_len // tensor.shape[1], 1) for tensor in tensors]
+    return torch.cat(tensors, dim=0)
+
+
+class SamplingCheckpoint:
+    """ Where a paused sampling resumes: step of the sampler's sigmas and latent x at it, x is in model space.
+        It resumes by sampling from sigmas[step:] with an empty latent and noise of x / sigmas[step],
+        noise_scaling of both eps and flow models maps them back to x.
+    """
+
+    def __init__(self, step: int, x: Tensor):
+        self.step = step
+        self.x = x
+
+    def resume(self, sigmas: Tensor, latent_image: Tensor):
+        """ Return noise, latent_image and sigmas to sample with. """
+        sigmas = sigmas[self.step:]
+        noise = (self.x / sigmas[0]).to(dtype=latent_image.dtype, device='cpu')
+        return noise, torch.zeros_like(noise), sigmas
+
+
+class SamplingPreempted(Exception):
+    """ Raised in sampler callback to pause the sampling, the task holds the checkpoint to resume later. """
+
+    def __init__(self, func_name: str, checkpoint: SamplingCheckpoint):
+        super().__init__(f"Sampling of {func_name} paused at step {checkpoint.step}")
+        self.func_name = func_name
+        self.checkpoint = checkpoint
+
+
+def check_sampling_step(func, step, x, latent: dict):
+    """ Called every sampling step, pause the sampling if func's step_hook asks to and it can be resumed,
+        raise if processing is interrupted, e.g. the task is canceled.
+        step 0 is never paused, resuming at the max sigma of eps models would scale noise differently.
+    """
+    if func.step_hook is not None and func.step_hook() and step > 0 and "noise_mask" not in latent:
+        offset = func.resume_from.step if func.resume_from else 0
+        raise SamplingPreempted(func.name, SamplingCheckpoint(offset + step, x.detach().cpu()))
+    comfy.model_management.throw_exception_if_processing_interrupted()
+
+
 def common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent, denoise=1.0,
-                    disable_noise=False, start_step=None, last_step=None, force_full_denoise=False, callback=None):
+                    disable_noise=False, start_step=None, last_step=None, force_full_denoise=False, callback=None,
+                    resume_from: SamplingCheckpoint | None = None, skip_uncond_tail=0.0, uncond_reuse_interval=1,
+                    batched_cfg=False):
+    """ seed can be BatchedInputs, then the latent is repeated for each seed and sampled as one batch,
+        noise of each is same as it's sampled alone.
+        resume_from continues a paused sampling, its step counts from start_step.
+        skip_uncond_tail, uncond_reuse_interval and batched_cfg are CFG modes of the run, see CfgOptions.
+    """
     latent_image = latent["samples"]
     latent_image = comfy.sample.fix_empty_latent_channels(model, latent_image)
 
+    seeds = list(seed) if isinstance(seed, BatchedInputs) else [seed]
+    seed = seeds[0]
+
     if disable_noise:
         noise = torch.zeros(latent_image.size(), dtype=latent_image.dtype, layout=latent_image.layout, device="cpu")
+        noise = noise.repeat(len(seeds), *([1] * (noise.ndim - 1)))
     else:
         batch_inds = latent["batch_index"] if "batch_index" in latent else None
-        noise = comfy.sample.prepare_noise(latent_image, seed, batch_inds)
+        noise = torch.cat([comfy.sample.prepare_noise(latent_image, seed_, batch_inds) for seed_ in seeds])
+
+    if len(seeds) > 1:
+        positive = repeat_conds_per_task(positive, len(seeds), latent_image.shape[0])
+        negative = repeat_conds_per_task(negative, len(seeds), latent_image.shape[0])
+        latent_image = latent_image.repeat(len(seeds), *([1] * (latent_image.ndim - 1)))
+
+    if resume_from is not None:
+        sigmas = comfy.samplers.KSampler(model, steps=steps, device=model.load_device, sampler=sampler_name,
+                                         scheduler=scheduler, denoise=denoise, model_options=model.model_options).sigmas
+        start_step = (start_step or 0) + resume_from.step
+        noise, latent_image, _ = SamplingCheckpoint(start_step, resume_from.x).resume(sigmas, latent_image)
 
     noise_mask = None
     if "noise_mask" in latent:
         noise_mask = latent["noise_mask"]
 
+    if skip_uncond_tail > 0 or uncond_reuse_interval > 1 or batched_cfg:
+        sigmas = comfy.samplers.KSampler(model, steps=steps, device=model.load_device, sampler=sampler_name,
+                                         scheduler=scheduler, denoise=denoise, model_options=model.model_options).sigmas
+        if last_step is not None and last_step < len(sigmas) - 1:
+            sigmas = sigmas[:last_step + 1]
+        if start_step is not None and start_step < len(sigmas) - 1:
+            sigmas = sigmas[start_step:]
+
+        model = model.clone()
+        model.model_options[CFG_OPTIONS_KEY] = CfgOptions(sigmas, skip_uncond_tail, uncond_reuse_interval, batched_cfg)
+
     disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
     samples = comfy.sample.sample(model, noise, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
                                   denoise=denoise, disable_noise=disable_noise, start_step=start_step,
@@ -275,6 +380,12 @@ def get_previewer(preview_method, device, latent_format):
 
 
 class Func_KSampler(Func):
+    batchable_inputs = ('seed',)
+    step_hook = None
+    """ Called every sampling step, return True to pause the sampling, see check_sampling_step. """
+    resume_from: SamplingCheckpoint | None = None
+    """ Set to resume a paused sampling. """
+
     def __init__(self,
                  name='kSample',
                  preview_method=LatentPreviewMethod.Auto,
@@ -298,6 +409,9 @@ class Func_KSampler(Func):
             IOInfo(name='sampler_name', data_type='STRING'),
             IOInfo(name='scheduler', data_type='STRING'),
             IOInfo(name='denoise', data_type='FLOAT'),
+            IOInfo(name='skip_uncond_tail', data_type='FLOAT'),
+            IOInfo(name='uncond_reuse_interval', data_type='INT'),
+            IOInfo(name='batched_cfg', data_type='BOOLEAN'),
         )
 
         self.set_outputs(
@@ -307,12 +421,13 @@ class Func_KSampler(Func):
     def set_callback(self, cb):
         self.callback = cb
 
-    def get_callback(self):
+    def get_callback(self, latent: dict):
         if not self.callback:
             return None
 
         def _callback(step, x0, x, total_steps):
             """ Return step, total_steps, and preview_bytes. """
+            check_sampling_step(self, step, x, latent)
             step += 1
             if step == 1 or step == total_steps or step % self.preview_steps == 0:
                 preview_bytes = self.previewer.decode_latent_to_preview_base64(x0)
@@ -331,16 +446,31 @@ class Func_KSampler(Func):
             negative,
             latent_image,
             denoise=1.0,
+            skip_uncond_tail=0.0,
+            uncond_reuse_interval=1,
+            batched_cfg=False,
             ):
 
         if not self.previewer:
             self.previewer = get_previewer(self.preview_method, model.load_device, model.model.latent_format)
 
         return common_ksampler(model, seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
-                               denoise=denoise, callback=self.get_callback())
+                               denoise=denoise, callback=self.get_callback(latent_image), resume_from=self.resume_from,
+                               skip_uncond_tail=skip_uncond_tail, uncond_reuse_interval=uncond_reuse_interval,
+                               batched_cfg=batched_cfg)
+
+    def run_batch(self, **inputs):
+        """ Every prompt of the batch gets one sample with its own seed, common_ksampler takes care of it. """
+        return self.run(**inputs)
 
 
 class Func_KSamplerAdvanced(Func):
+    batchable_inputs = ('noise_seed',)
+    step_hook = None
+    """ Called every sampling step, return True to pause the sampling, see check_sampling_step. """
+    resume_from: SamplingCheckpoint | None = None
+    """ Set to resume a paused sampling. """
+
     def __init__(self,
                  name='KSamplerAdvanced',
                  preview_method=LatentPreviewMethod.Auto,
@@ -365,6 +495,9 @@ class Func_KSamplerAdvanced(Func):
             IOInfo(name='start_at_step', data_type='INT'),
             IOInfo(name='end_at_step', data_type='INT'),
             IOInfo(name='return_with_leftover_noise', data_type='STRING'),
+            IOInfo(name='skip_uncond_tail', data_type='FLOAT'),
+            IOInfo(name='uncond_reuse_interval', data_type='INT'),
+            IOInfo(name='batched_cfg', data_type='BOOLEAN'),
         )
 
         self.set_outputs(
@@ -374,12 +507,13 @@ class Func_KSamplerAdvanced(Func):
     def set_callback(self, cb):
         self.callback = cb
 
-    def get_callback(self):
+    def get_callback(self, latent: dict):
         if not self.callback:
             return None
 
         def _callback(step, x0, x, total_steps):
             """ Return step, total_steps, and preview_bytes. """
+            check_sampling_step(self, step, x, latent)
             step += 1
             if step == 1 or step == total_steps or step % self.preview_steps == 0:
                 preview_bytes = self.previewer.decode_latent_to_preview_base64(x0)
@@ -388,7 +522,8 @@ class Func_KSamplerAdvanced(Func):
         return _callback
 
     def run(self, model, add_noise, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative,
-            latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0, callback=None):
+            latent_image, start_at_step, end_at_step, return_with_leftover_noise, denoise=1.0, callback=None,
+            skip_uncond_tail=0.0, uncond_reuse_interval=1, batched_cfg=False):
 
         if not self.previewer:
             self.previewer = get_previewer(self.preview_method, model.load_device, model.model.latent_format)
@@ -409,7 +544,13 @@ class Func_KSamplerAdvanced(Func):
         return common_ksampler(model, noise_seed, steps, cfg, sampler_name, scheduler, positive, negative, latent_image,
                                denoise=denoise, disable_noise=disable_noise, start_step=start_at_step,
                                last_step=end_at_step, force_full_denoise=force_full_denoise,
-                               callback=self.get_callback())
+                               callback=self.get_callback(latent_image), resume_from=self.resume_from,
+                               skip_uncond_tail=skip_uncond_tail, uncond_reuse_interval=uncond_reuse_interval,
+                               batched_cfg=batched_cfg)
+
+    def run_batch(self, **inputs):
+        """ Every prompt of the batch gets one sample with its own seed, common_ksampler takes care of it. """
+        return self.run(**inputs)
 
 
 class Func_VAEDecode(Func):
@@ -489,6 +630,8 @@ class Func_VAEEncode(Func):
 
 
 class Func_SaveImage(Func):
+    resource = 'cpu'
+
     def __init__(self, name="Save Image"):
         super().__init__(name=name)
 
@@ -508,12 +651,15 @@ class Func_SaveImage(Func):
         results = list()
         assert self.prompt, "Prompt must be set where func registered."
 
+        task_artwork_count = len(images) // len(self.batch_prompts) if self.batch_prompts else len(images)
         for (batch_number, image) in enumerate(images):
+            prompt = self.get_prompt_of_batch_index(batch_number, len(images))
+
             i = 255. * image.cpu().numpy()
             img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
 
             metadata = PngInfo()
-            metadata.add_text("prompt", json.dumps(self.prompt.model_dump()))
+            metadata.add_text("prompt", json.dumps(prompt.model_dump()))
 
             file_path = Artwork.create_file_path(media_type='image')
             img.save(file_path, pnginfo=metadata, compress_level=self.compress_level)
@@ -522,15 +668,20 @@ class Func_SaveImage(Func):
 
             artwork = Artwork.add_art_work(
                 file_path=file_path,
-                card_name=self.prompt.card_name,
+                card_name=prompt.card_name,
                 media_type='image',
                 meta_info=meta_info,
-                prompt=self.prompt,
+                prompt=prompt,
+                task_id=self.get_task_id_of_batch_index(batch_number, len(images)),
+                task_artwork_count=task_artwork_count,
             )
             results.append(artwork)
 
         return ({"images": results},)
 
+    def outputs_of_artworks(self, artworks: list) -> dict | None:
+        return self.transform_outputs(({"images": artworks},))
+
 
 class Func_CLIPSetLastLayer(Func):
     def __init__(self, name="Clip Skip"):
@@ -552,6 +703,10 @@ class Func_CLIPSetLastLayer(Func):
 
 
 class Func_LoraLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('lora_id',)
+
     def __init__(self, name="LoRA Loader"):
         super().__init__(name=name)
 
@@ -572,15 +727,35 @@ class Func_LoraLoader(Func):
             return model, clip
 
         lora_path = ModelInfo.get(lora_id).local_path
+        lora_key = file_key(lora_path)
+
+        # the stack of LoRAs on model and clip may be fused already, then the file is not loaded.
+        model_lora = LoraFusion.get(model, lora_key, weight) if model is not None else None
+        clip_lora = None
+        if clip is not None:
+            clip_patcher = LoraFusion.get(clip.patcher, lora_key, weight)
+            if clip_patcher is not None:
+                clip_lora = clip.clone()
+                clip_lora.patcher = clip_patcher
+
+        if (model is not None and model_lora is None) or (clip is not None and clip_lora is None):
+            lora = StateDictCache.load_torch_file(lora_path, safe_load=True)
+            patched_model, patched_clip = comfy.sd.load_lora_for_models(
+                model if model_lora is None else None, clip if clip_lora is None else None, lora, weight, weight
+            )
+            if patched_model is not None:
+                model_lora = LoraFusion.fuse(model, patched_model, lora_key, weight)
+            if patched_clip is not None:
+                patched_clip.patcher = LoraFusion.fuse(clip.patcher, patched_clip.patcher, lora_key, weight)
+                clip_lora = patched_clip
 
-        # todo: support cache management for this func inner logic.
-        lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
-
-        model_lora, clip_lora = comfy.sd.load_lora_for_models(model, clip, lora, weight, weight)
         return model_lora, clip_lora
 
 
 class Func_UpscaleModelLoader(Func):
+    resource = 'disk'
+    model_inputs = ('upscale_model_id',)
+
     def __init__(self, name="Load Upscale Model"):
         super().__init__(name=name)
 
@@ -595,7 +770,7 @@ class Func_UpscaleModelLoader(Func):
     def run(self, upscale_model_id):
         model_path = ModelInfo.get(upscale_model_id).local_path
 
-        sd = comfy.utils.load_torch_file(model_path, safe_load=True)
+        sd = StateDictCache.load_torch_file(model_path, safe_load=True)
         if "module.layers.0.residual_group.blocks.0.norm1.weight" in sd:
             sd = comfy.utils.state_dict_prefix_replace(sd, {"module.": ""})
         out = ModelLoader().load_from_state_dict(sd).eval()
@@ -678,6 +853,8 @@ class Func_LatentScale(Func):
 
 
 class Func_LoadImage(Func):
+    resource = 'disk'
+
     def __init__(self, name="Load Image"):
         super().__init__(name=name)
 
@@ -734,6 +911,9 @@ class Func_LoadImage(Func):
 
 
 class Func_HypernetLoader(Func):
+    resource = 'disk'
+    model_inputs = ('hypernet_id',)
+
     def __init__(self, name="Hypernet Loader"):
         super().__init__(name=name)
 
@@ -757,7 +937,7 @@ class Func_HypernetLoader(Func):
         return (model_hypernet,)
 
     def load_hypernetwork_patch(self, path, strength):
-        sd = comfy.utils.load_torch_file(path, safe_load=True)
+        sd = StateDictCache.load_torch_file(path, safe_load=True)
         activation_func = sd.get('activation_func', 'linear')
         is_layer_norm = sd.get('is_layer_norm', False)
         use_dropout = sd.get('use_dropout', False)
@@ -899,6 +1079,8 @@ class Func_VAEEncodeForInpaint(Func):
 
 
 class Func_ImagePadForOutpaint(Func):
+    resource = 'cpu'
+
     def __init__(self, name="Image Pad For Outpainting"):
         super().__init__(name=name)
 
@@ -962,6 +1144,10 @@ class Func_ImagePadForOutpaint(Func):
 
 
 class Func_ControlNetLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('controlnet_id',)
+
     def __init__(self, name="ControlNet Loader"):
         super().__init__(name=name)
 
@@ -1012,6 +1198,10 @@ class Func_ControlNetApply(Func):
 
 
 class Func_ClipLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('clip_id',)
+
     def __init__(self, name="CLIP Loader"):
         super().__init__(name=name)
 
@@ -1041,12 +1231,15 @@ class Func_ClipLoader(Func):
         else:
             clip_type = comfy.sd.CLIPType.STABLE_DIFFUSION
 
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path],
-                                  embedding_directory=embedding_directories, clip_type=clip_type)
+        clip = load_clip([clip_path], embedding_directory=embedding_directories, clip_type=clip_type)
         return (clip,)
 
 
 class Func_DualCLIPLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('clip_id1', 'clip_id2')
+
     def __init__(self, name="Dual CLIP Loader"):
         super().__init__(name=name)
         self.set_inputs(
@@ -1072,12 +1265,15 @@ class Func_DualCLIPLoader(Func):
         elif type == "flux":
             clip_type = comfy.sd.CLIPType.FLUX
 
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2],
-                                  embedding_directory=embedding_directories, clip_type=clip_type)
+        clip = load_clip([clip_path1, clip_path2], embedding_directory=embedding_directories, clip_type=clip_type)
         return (clip,)
 
 
 class Func_TripleCLIPLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('clip_id1', 'clip_id2', 'clip_id3')
+
     def __init__(self, name='Triple CLIP Loader'):
         super().__init__(name=name)
         self.set_inputs(
@@ -1096,12 +1292,15 @@ class Func_TripleCLIPLoader(Func):
         clip_path3 = ModelInfo.get(clip_id3).local_path
         embedding_directories = ModelDir.get_dirs('embedding')
 
-        clip = comfy.sd.load_clip(ckpt_paths=[clip_path1, clip_path2, clip_path3],
-                                  embedding_directory=embedding_directories)
+        clip = load_clip([clip_path1, clip_path2, clip_path3], embedding_directory=embedding_directories)
         return (clip,)
 
 
 class Func_UNETLoader(Func):
+    resource = 'disk'
+    loads_models = True
+    model_inputs = ('unet_id',)
+
     def __init__(self, name='UNET Loader'):
         super().__init__(name=name)
         self.set_inputs(
@@ -1114,14 +1313,14 @@ class Func_UNETLoader(Func):
         )
 
     def run(self, unet_id, weight_dtype):
-        unet_path = ModelInfo.get(unet_id).local_path
+        model_info = ModelInfo.get(unet_id)
         model_options = {}
         if weight_dtype == "fp8_e4m3fn":
             model_options["dtype"] = torch.float8_e4m3fn
         elif weight_dtype == "fp8_e5m2":
             model_options["dtype"] = torch.float8_e5m2
 
-        model = comfy.sd.load_diffusion_model(unet_path, model_options=model_options)
+        model = load_diffusion_model(model_info.local_path, model_options=model_options, sha_256=model_info.sha_256)
         return (model,)
 
 
@@ -1143,6 +1342,11 @@ class Func_FluxGuidance(Func):
 
 
 class Func_SamplerCustomAdvanced(Func):
+    step_hook = None
+    """ Called every sampling step, return True to pause the sampling, see check_sampling_step. """
+    resume_from: SamplingCheckpoint | None = None
+    """ Set to resume a paused sampling. """
+
     def __init__(self, name="SamplerCustomAdvanced", preview_method=LatentPreviewMethod.Auto,
                  preview_steps=3):
         super().__init__(name)
@@ -1169,12 +1373,13 @@ class Func_SamplerCustomAdvanced(Func):
     def set_callback(self, cb):
         self.callback = cb
 
-    def get_callback(self):
+    def get_callback(self, latent: dict):
         if not self.callback:
             return None
 
         def _callback(step, x0, x, total_steps):
             """ Return step, total_steps, and preview_bytes. """
+            check_sampling_step(self, step, x, latent)
 
             self.x0_output_dict["x0"] = x0
 
@@ -1203,9 +1408,13 @@ class Func_SamplerCustomAdvanced(Func):
         if "noise_mask" in latent:
             noise_mask = latent["noise_mask"]
 
+        noise_image = noise.generate_noise(latent)
+        if self.resume_from is not None:
+            noise_image, latent_image, sigmas = self.resume_from.resume(sigmas, latent_image)
+
         disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
-        samples = guider.sample(noise.generate_noise(latent), latent_image, sampler, sigmas, denoise_mask=noise_mask,
-                                callback=self.get_callback(), disable_pbar=disable_pbar, seed=noise.seed)
+        samples = guider.sample(noise_image, latent_image, sampler, sigmas, denoise_mask=noise_mask,
+                                callback=self.get_callback(latent), disable_pbar=disable_pbar, seed=noise.seed)
         samples = samples.to(comfy.model_management.intermediate_device())
 
         out = latent.copy()
@@ -1503,6 +1712,10 @@ class Noise_EmptyNoise:
 
 
 class Func_SamplerCustom(Func):
+    step_hook = None
+    """ Called every sampling step, return True to pause the sampling, see check_sampling_step. """
+    resume_from: SamplingCheckpoint | None = None
+    """ Set to resume a paused sampling. """
 
     def __init__(self, name="SamplerCustom", preview_method=LatentPreviewMethod.Auto,
                  preview_steps=3):
@@ -1535,12 +1748,13 @@ class Func_SamplerCustom(Func):
     def set_callback(self, cb):
         self.callback = cb
 
-    def get_callback(self):
+    def get_callback(self, latent: dict):
         if not self.callback:
             return None
 
         def _callback(step, x0, x, total_steps):
             """ Return step, total_steps, and preview_bytes. """
+            check_sampling_step(self, step, x, latent)
 
             self.x0_output_dict["x0"] = x0
 
@@ -1571,9 +1785,12 @@ class Func_SamplerCustom(Func):
         if "noise_mask" in latent:
             noise_mask = latent["noise_mask"]
 
+        if self.resume_from is not None:
+            noise, latent_image, sigmas = self.resume_from.resume(sigmas, latent_image)
+
         disable_pbar = not comfy.utils.PROGRESS_BAR_ENABLED
         samples = comfy.sample.sample_custom(model, noise, cfg, sampler, sigmas, positive, negative, latent_image,
-                                             noise_mask=noise_mask, callback=self.get_callback(),
+                                             noise_mask=noise_mask, callback=self.get_callback(latent),
                                              disable_pbar=disable_pbar, seed=noise_seed)
 
         out = latent.copy()
@@ -1587,6 +1804,8 @@ class Func_SamplerCustom(Func):
 
 
 class Func_SaveAnimatedWEBP(Func):
+    resource = 'cpu'
+
     def __init__(self, name='SaveAnimatedWEBP'):
         super().__init__(name=name)
 
@@ -1620,14 +1839,18 @@ class Func_SaveAnimatedWEBP(Func):
             img = Image.fromarray(np.clip(i, 0, 255).astype(np.uint8))
             pil_images.append(img)
 
-        metadata = pil_images[0].getexif()
-        metadata[0x0110] = "prompt:{}".format(json.dumps(self.prompt.model_dump()))
-
         if num_frames == 0:
-            num_frames = len(pil_images)
+            # frames of prompts running as one batch are concatenated, one video per prompt.
+            num_frames = len(pil_images) // len(self.batch_prompts) if self.batch_prompts else len(pil_images)
 
         c = len(pil_images)
+        videos = len(range(0, c, num_frames))
+        task_artwork_count = videos // len(self.batch_prompts) if self.batch_prompts else videos
         for i in range(0, c, num_frames):
+            prompt = self.get_prompt_of_batch_index(i, c)
+            metadata = pil_images[i].getexif()
+            metadata[0x0110] = "prompt:{}".format(json.dumps(prompt.model_dump()))
+
             file_path = Artwork.create_file_path(media_type='image', ext='.webp')
             pil_images[i].save(file_path, save_all=True, duration=int(1000.0 / fps),
                                append_images=pil_images[i + 1:i + num_frames], exif=metadata, lossless=lossless,
@@ -1636,15 +1859,20 @@ class Func_SaveAnimatedWEBP(Func):
             meta_info = get_meta_info(file_path)
             artwork = Artwork.add_art_work(
                 file_path=file_path,
-                card_name=self.prompt.card_name,
+                card_name=prompt.card_name,
                 media_type='image',
                 meta_info=meta_info,
-                prompt=self.prompt,
+                prompt=prompt,
+                task_id=self.get_task_id_of_batch_index(i, c),
+                task_artwork_count=task_artwork_count,
             )
             results.append(artwork)
 
         return ({"images": results},)
 
+    def outputs_of_artworks(self, artworks: list) -> dict | None:
+        return self.transform_outputs(({"images": artworks},))
+
 
 class Func_LTXVImgToVideo(Func):
     def __init__(self, name='LTXVImgToVideo'):
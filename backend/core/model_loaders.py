@@ -0,0 +1,162 @@
+""" Checkpoint and diffusion model loaders taking the model detection saved by earlier loads of the file, so they
+    skip comfy model_detection. comfy.sd loaders build the model, model_config_from_unet they call is substituted
+    while they run, see detection_of_file. A file loaded the first time is detected by comfy once and its detection
+    is saved for the next times, see ModelDetection.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import torch
+
+import comfy.model_detection
+import comfy.sd
+import comfy.supported_models
+import comfy.utils
+from data_type.whatsai_model_detection import ModelDetection
+from misc.cond_batch_planner import CondBatchPlanner
+from misc.logger import logger
+from misc.lora_fusion import LoraFusion
+from misc.state_dict_cache import StateDictCache, file_key
+
+
+detection_lock = threading.Lock()
+""" One loader substitutes model_config_from_unet at a time. """
+
+
+def save_detection(path: str, kind: str, sha_256: str | None, unet_prefix: str, model_config,
+                   parameters: int, weight_dtype: torch.dtype | None):
+    unet_config = {
+        key: value for key, value in model_config.unet_config.items() if key not in model_config.unet_extra_config
+    }
+    try:
+        json.dumps(unet_config)
+    except TypeError as e:
+        logger.debug(f"Unet config of {path} can not be saved: {e}")
+        return
+
+    stat = os.stat(path)
+    ModelDetection(
+        local_path=path,
+        kind=kind,
+        mtime=stat.st_mtime,
+        size=stat.st_size,
+        sha_256=sha_256,
+        architecture=model_config.__class__.__name__,
+        unet_config=unet_config,
+        unet_prefix=unet_prefix,
+        parameters=parameters,
+        weight_dtype=str(weight_dtype).removeprefix('torch.') if weight_dtype is not None else None,
+    ).save()
+
+
+def model_config_of(detection: ModelDetection, sd: dict, unet_prefix: str):
+    """ Model config of the detection, as model_config_from_unet returns it, None if comfy has no such model now. """
+
+    model_config_class = getattr(comfy.supported_models, detection.architecture, None)
+    if model_config_class is None:
+        return None
+    model_config = model_config_class(detection.unet_config)
+
+    scaled_fp8_key = f"{unet_prefix}scaled_fp8"
+    if scaled_fp8_key in sd:
+        model_config.scaled_fp8 = sd.pop(scaled_fp8_key).dtype
+        if model_config.scaled_fp8 == torch.float32:
+            model_config.scaled_fp8 = torch.float8_e4m3fn
+    return model_config
+
+
+@contextmanager
+def detection_of_file(path: str, kind: str, sha_256: str | None):
+    """ comfy.model_detection.model_config_from_unet called first by the comfy.sd loader run in the context returns
+        the model config of the detection saved of the file, or detects it and saves the detection. Later calls,
+        e.g. on diffusers weights converted, and calls of other threads are left to comfy.
+    """
+
+    detection = ModelDetection.get_of_file(path, kind, sha_256)
+    original = None
+    thread_id = threading.get_ident()
+    calls = 0
+
+    def model_config_from_unet(state_dict, unet_key_prefix, *args, **kwargs):
+        nonlocal calls
+        if threading.get_ident() != thread_id:
+            return original(state_dict, unet_key_prefix, *args, **kwargs)
+
+        calls += 1
+        if calls > 1:
+            return original(state_dict, unet_key_prefix, *args, **kwargs)
+
+        model_config = model_config_of(detection, state_dict, unet_key_prefix) if detection else None
+        if model_config is not None:
+            return model_config
+
+        parameters = comfy.utils.calculate_parameters(state_dict, unet_key_prefix)
+        weight_dtype = comfy.utils.weight_dtype(state_dict, unet_key_prefix)
+        model_config = original(state_dict, unet_key_prefix, *args, **kwargs)
+        if model_config is not None:
+            save_detection(path, kind, sha_256, unet_key_prefix, model_config, parameters, weight_dtype)
+        return model_config
+
+    with detection_lock:
+        original = comfy.model_detection.model_config_from_unet
+        comfy.model_detection.model_config_from_unet = model_config_from_unet
+        try:
+            yield
+        finally:
+            comfy.model_detection.model_config_from_unet = original
+
+
+def prepare_patchers(path: str, model, clip=None, *options):
+    """ LoRAs on models of the file are fused by LoraFusion, options changing the weights loaded go in the key.
+        Cond batches of sampling the model are planned by CondBatchPlanner.
+    """
+    if model is not None:
+        LoraFusion.tag(model, (file_key(path), 'model', *map(str, options)))
+        CondBatchPlanner.install(model)
+    if clip is not None:
+        LoraFusion.tag(clip.patcher, (file_key(path), 'clip', *map(str, options)))
+
+
+def load_clip(paths: list[str], embedding_directory=None, clip_type=comfy.sd.CLIPType.STABLE_DIFFUSION):
+    """ Same as comfy.sd.load_clip, through the state dict cache. """
+
+    clip = comfy.sd.load_text_encoder_state_dicts(
+        [StateDictCache.load_torch_file(path, safe_load=True) for path in paths],
+        embedding_directory=embedding_directory, clip_type=clip_type
+    )
+    LoraFusion.tag(clip.patcher, (tuple(file_key(path) for path in paths), 'clip', str(clip_type)))
+    return clip
+
+
+def load_checkpoint(path: str, output_vae=True, output_clip=True, output_clipvision=False, embedding_directory=None,
+                    output_model=True, model_options=None, te_model_options=None, sha_256: str | None = None):
+    """ Returns (model, clip, vae, clipvision) as comfy.sd.load_checkpoint_guess_config does. """
+
+    model_options = model_options or {}
+    te_model_options = te_model_options or {}
+    sd = StateDictCache.load_torch_file(path)
+    with detection_of_file(path, 'checkpoint', sha_256):
+        out = comfy.sd.load_state_dict_guess_config(sd, output_vae, output_clip, output_clipvision,
+                                                    embedding_directory, output_model, model_options,
+                                                    te_model_options=te_model_options)
+    if out is None:
+        raise RuntimeError(f"ERROR: Could not detect model type of: {path}")
+
+    model, clip = out[:2]
+    prepare_patchers(path, model, clip, model_options.get("dtype"), te_model_options.get("dtype"))
+    return out
+
+
+def load_diffusion_model(path: str, model_options: dict, sha_256: str | None = None):
+    """ Returns the model as comfy.sd.load_diffusion_model does. """
+
+    sd = StateDictCache.load_torch_file(path)
+    with detection_of_file(path, 'diffusion_model', sha_256):
+        model = comfy.sd.load_diffusion_model_state_dict(sd, model_options=model_options)
+    if model is None:
+        raise RuntimeError(f"ERROR: Could not detect model type of: {path}")
+
+    prepare_patchers(path, model, None, model_options.get("dtype"))
+    return model
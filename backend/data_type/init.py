@@ -5,19 +5,23 @@ from data_type.whatsai_model_dir import ModelDir
 from data_type.whatsai_model_download_task import ModelDownloadTask
 from data_type.whatsai_model_downloading_info import ModelDownloadingInfo
 from data_type.whatsai_model_info import ModelInfo
+from data_type.whatsai_model_detection import ModelDetection
 from data_type.civitai_model_version import CivitaiModelVersion
 from data_type.whatsai_model_type import ModelType
 from data_type.whatsai_task import Task
+from data_type.whatsai_task_profile import TaskProfile
 
 
 def initialize_dbs():
     ModelType.init()
     ModelDir.init()
     ModelInfo.init()
+    ModelDetection.init()
     CivitaiModelVersion.init()
     ModelDownloadTask.init()
     ModelDownloadingInfo.init()
     Task.init()
+    TaskProfile.init()
     CardDataModel.init()
     InputFile.init()
     Artwork.init()
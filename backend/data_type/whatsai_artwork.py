@@ -34,6 +34,12 @@ class Artwork(PyDBModel):
     created_time_stamp: Optional[int] = None
     created_datetime_str: Optional[str] = None
 
+    task_id: Optional[int] = None
+    """ Id of the task saved it, a task run again after a crash finishes with artworks of it. """
+
+    task_artwork_count: Optional[int] = None
+    """ How many artworks the task saves in all, artworks of a task cut off halfway are not enough to finish it. """
+
     @classmethod
     def init(cls):
         conn = cls.conn()
@@ -50,13 +56,21 @@ class Artwork(PyDBModel):
                         prompt TEXT,
                         thumb TEXT,
                         created_time_stamp INTEGER,
-                        created_datetime_str TEXT
+                        created_datetime_str TEXT,
+                        task_id INTEGER,
+                        task_artwork_count INTEGER
                         )
                 """
             )
+            # tables created before artworks are tagged with tasks.
+            columns = [row[1] for row in cur.execute("PRAGMA table_info(artwork)").fetchall()]
+            for column in ('task_id', 'task_artwork_count'):
+                if column not in columns:
+                    cur.execute(f"ALTER TABLE artwork ADD COLUMN {column} INTEGER")
             cur.execute("CREATE INDEX IF NOT EXISTS artwork_idx_path ON artwork(file_path)")
             cur.execute("CREATE INDEX IF NOT EXISTS artwork_idx_card_name ON artwork(card_name)")
             cur.execute("CREATE INDEX IF NOT EXISTS artwork_idx_prompt ON artwork(prompt)")
+            cur.execute("CREATE INDEX IF NOT EXISTS artwork_idx_task_id ON artwork(task_id)")
 
             conn.commit()
 
@@ -69,12 +83,12 @@ class Artwork(PyDBModel):
                 (
                     id, file_path, media_type, meta_info, liked, 
                     shared, card_name, prompt, thumb, created_time_stamp,
-                    created_datetime_str
+                    created_datetime_str, task_id, task_artwork_count
                 )
                 VALUES (
                     ?, ?, ?, ?, ?,  
                     ?, ?, ?, ?, ?,
-                    ?
+                    ?, ?, ?
                 )
                 """,
                 self.to_tuple(with_id=True),
@@ -131,6 +145,23 @@ class Artwork(PyDBModel):
             rows = cur.fetchall()
             return [cls.from_row(row) for row in rows]
 
+    @classmethod
+    def get_artworks_of_task(cls, task_id: int):
+        """ Artworks the task saved, in the order saved. """
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(" SELECT * FROM artwork WHERE task_id = ? ORDER BY id", (task_id,))
+            rows = cur.fetchall()
+            return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def untag_task(cls, task_id: int):
+        """ Artworks stay, but are not of the task any more, e.g. the ones of a run cut off halfway. """
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute("UPDATE artwork SET task_id = NULL, task_artwork_count = NULL WHERE task_id = ?", (task_id,))
+            conn.commit()
+
     @classmethod
     def add_art_work(cls,
                      file_path: str,
@@ -139,6 +170,8 @@ class Artwork(PyDBModel):
                      auto_thumb=True,
                      meta_info=None,
                      prompt=None,
+                     task_id=None,
+                     task_artwork_count=None,
                      ):
         if not Path(file_path).exists():
             logger.debug('Add artwork failed: {} file not exists.'.format(file_path))
@@ -166,7 +199,9 @@ class Artwork(PyDBModel):
             prompt=prompt,
             thumb=thumb,
             created_time_stamp=time_stamp,
-            created_datetime_str=datetime_str
+            created_datetime_str=datetime_str,
+            task_id=task_id,
+            task_artwork_count=task_artwork_count
         )
         artwork.save()
         return artwork
@@ -213,6 +248,8 @@ class Artwork(PyDBModel):
             prompt=json.loads(row[7]),
             thumb=json.loads(row[8]),
             created_time_stamp=row[9],
-            created_datetime_str=row[10]
+            created_datetime_str=row[10],
+            task_id=row[11],
+            task_artwork_count=row[12]
         )
         return model_info
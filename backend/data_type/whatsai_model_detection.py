@@ -0,0 +1,134 @@
+import json
+import os
+from contextlib import closing
+from typing import Optional
+
+from data_type.base_data_model import PyDBModel
+from misc.helpers import get_now_timestamp_and_str
+
+
+class ModelDetection(PyDBModel):
+    """ What comfy model detection found out of a model file, saved so loading the file again skips detection,
+        see core.model_loaders. A row is taken only if mtime and size of the file are not changed.
+    """
+
+    local_path: str
+    kind: str
+    """ 'checkpoint' or 'diffusion_model', the unet is taken at different prefixes of them. """
+
+    mtime: float
+    size: int
+    sha_256: Optional[str] = None
+
+    architecture: str
+    """ Name of the model config class in comfy.supported_models, e.g. SDXL, Flux. """
+
+    unet_config: dict
+    """ Unet config detected, unet_extra_config of the class is left out, the class adds it back. """
+
+    unet_prefix: str
+    parameters: int
+    weight_dtype: Optional[str] = None
+    """ Most used dtype of unet weights in file, e.g. 'float16'. """
+
+    created_time_stamp: Optional[int] = None
+    created_datetime_str: Optional[str] = None
+
+    @classmethod
+    def init(cls):
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS model_detection
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        local_path TEXT,
+                        kind TEXT,
+                        mtime REAL,
+                        size INTEGER,
+                        sha_256 TEXT,
+                        architecture TEXT,
+                        unet_config TEXT,
+                        unet_prefix TEXT,
+                        parameters INTEGER,
+                        weight_dtype TEXT,
+                        created_time_stamp INTEGER,
+                        created_datetime_str TEXT,
+                        UNIQUE (local_path, kind)
+                        )"""
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS model_detection_idx_sha_256 ON model_detection(sha_256)")
+
+            conn.commit()
+
+    def save(self):
+        if not self.created_time_stamp:
+            self.created_time_stamp, self.created_datetime_str = get_now_timestamp_and_str()
+
+        conn = self.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    INSERT OR REPLACE INTO model_detection
+                        (id, local_path, kind, mtime, size, sha_256, architecture, unet_config, unet_prefix,
+                        parameters, weight_dtype, created_time_stamp, created_datetime_str)
+                    VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                self.to_tuple(with_id=True),
+            )
+            if not self.id:
+                self.id = cur.lastrowid
+            conn.commit()
+
+    def to_tuple(self, with_id=False):
+        model_dict = self.model_dump()
+        model_dict['unet_config'] = json.dumps(model_dict['unet_config'])
+
+        if not with_id:
+            model_dict.pop('id')
+        return tuple(model_dict.values())
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        return cls(
+            id=row[0],
+            local_path=row[1],
+            kind=row[2],
+            mtime=row[3],
+            size=row[4],
+            sha_256=row[5],
+            architecture=row[6],
+            unet_config=json.loads(row[7]),
+            unet_prefix=row[8],
+            parameters=row[9],
+            weight_dtype=row[10],
+            created_time_stamp=row[11],
+            created_datetime_str=row[12],
+        )
+
+    @classmethod
+    def get_of_file(cls, local_path: str, kind: str, sha_256: str | None = None):
+        """ Detection of the file as it is now, or of a file with the same sha_256, None if not detected yet. """
+
+        stat = os.stat(local_path)
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT * FROM model_detection WHERE local_path = ? AND kind = ?", (local_path, kind))
+            row = cur.fetchone()
+            if row is not None and (row[3], row[4]) == (stat.st_mtime, stat.st_size):
+                return cls.from_row(row)
+
+            if sha_256:
+                cur.execute("SELECT * FROM model_detection WHERE sha_256 = ? AND kind = ?", (sha_256, kind))
+                row = cur.fetchone()
+                if row is not None:
+                    return cls.from_row(row)
+        return None
+
+    @classmethod
+    def get_all(cls):
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute("SELECT * FROM model_detection ORDER BY created_time_stamp desc")
+            rows = cur.fetchall()
+            return [cls.from_row(row) for row in rows]
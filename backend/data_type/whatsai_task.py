@@ -1,4 +1,5 @@
 import json
+import time
 from contextlib import closing
 from enum import Enum
 from typing import Literal, Optional
@@ -18,6 +19,13 @@ class TaskStatus(Enum):
     done = 'done'
 
 
+class TaskPriority(Enum):
+    """ Priority class of a task in TaskQueue, tasks of higher class always go first. """
+    high = 'high'
+    normal = 'normal'
+    low = 'low'
+
+
 class Task(PyDBModel):
     client_id: str
     status: str
@@ -33,10 +41,36 @@ class Task(PyDBModel):
 
     # redundant fields
     field0: Optional[str] = None
+    """ Holds priority of task, see priority. """
     field1: Optional[str] = None
+    """ Holds id of the worker which claimed the task, see claim. """
     field2: Optional[str] = None
+    """ Holds timestamp the lease of the claimed task expires at, the worker renews it by heartbeat. """
     field3: Optional[str] = None
+    """ Holds how many times the task has been started, more than once means it's run again after a crash. """
     field4: Optional[str] = None
+    """ Holds sampling checkpoint of the task paused for a higher priority one, see sampling_checkpoint. """
+
+    @property
+    def priority(self) -> str:
+        return self.field0 or TaskPriority.normal.value
+
+    @property
+    def worker_id(self) -> str | None:
+        return self.field1
+
+    @property
+    def lease_expires_at(self) -> float | None:
+        return float(self.field2) if self.field2 else None
+
+    @property
+    def attempts(self) -> int:
+        return int(self.field3) if self.field3 else 0
+
+    @property
+    def sampling_checkpoint(self) -> dict | None:
+        """ In type of {'func_name': sampler func paused, 'step': step paused at, 'path': file of latent saved} """
+        return json.loads(self.field4) if self.field4 else None
 
     @classmethod
     def init(cls):
@@ -64,6 +98,7 @@ class Task(PyDBModel):
                         )"""
             )
             cur.execute("CREATE INDEX IF NOT EXISTS prompt_task_idx_card_name ON prompt_task(card_name)")
+            cur.execute("CREATE INDEX IF NOT EXISTS prompt_task_idx_status ON prompt_task(status)")
 
             conn.commit()
 
@@ -166,6 +201,7 @@ class Task(PyDBModel):
         query = """
                     SELECT * FROM prompt_task
                         WHERE status IN ({})
+                        ORDER BY id
                 """.format(
             ",".join("?" * len(unfinished_status))
         )
@@ -185,3 +221,193 @@ class Task(PyDBModel):
                 "DELETE FROM prompt_task WHERE id = ? ", (id,)
             )
             conn.commit()
+
+    @classmethod
+    def get_queued_tasks(cls, limit=20, card_name=None):
+        """ Queued tasks in the order to run: higher priority first, then first in first out. """
+
+        query = """
+                    SELECT * FROM prompt_task
+                        WHERE status = ? {}
+                        ORDER BY CASE field0 WHEN 'high' THEN 0 WHEN 'low' THEN 2 ELSE 1 END, id
+                        LIMIT ?
+                """.format("AND card_name = ?" if card_name else "")
+        params = (TaskStatus.queued.value, card_name, limit) if card_name else (TaskStatus.queued.value, limit)
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+
+        return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def claim(cls, id, worker_id: str, lease_seconds: float):
+        """ Atomically take a queued task for the worker, return the claimed task, or None if another worker
+            got it first or it's not queued any more.
+        """
+
+        lease_expires_at = time.time() + lease_seconds
+        updated_time_stamp, updated_datetime_str = get_now_timestamp_and_str()
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    UPDATE prompt_task 
+                        SET status = ?, field1 = ?, field2 = ?, updated_time_stamp = ?, updated_datetime_str = ?
+                        WHERE id = ? AND status = ?
+                """,
+                (TaskStatus.processing.value, worker_id, str(lease_expires_at), updated_time_stamp,
+                 updated_datetime_str, id, TaskStatus.queued.value)
+            )
+            claimed = cur.rowcount == 1
+            conn.commit()
+
+        return cls.get(id) if claimed else None
+
+    @classmethod
+    def renew_leases(cls, ids: list[int], worker_id: str, lease_seconds: float):
+        """ Heartbeat of the worker, extend leases of tasks it's processing. """
+
+        if not ids:
+            return
+
+        lease_expires_at = time.time() + lease_seconds
+        query = """
+                    UPDATE prompt_task SET field2 = ?
+                        WHERE field1 = ? AND status = ? AND id IN ({})
+                """.format(",".join("?" * len(ids)))
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(query, (str(lease_expires_at), worker_id, TaskStatus.processing.value, *ids))
+            conn.commit()
+
+    @classmethod
+    def requeue_expired_leases(cls):
+        """ Put tasks back to queue whose worker stopped heartbeat, e.g. crashed, return count of them. """
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    UPDATE prompt_task SET status = ?, field1 = NULL, field2 = NULL
+                        WHERE status = ? AND field2 IS NOT NULL AND CAST(field2 AS REAL) < ?
+                """,
+                (TaskStatus.queued.value, TaskStatus.processing.value, time.time())
+            )
+            count = cur.rowcount
+            conn.commit()
+        return count
+
+    @classmethod
+    def requeue_unleased_tasks(cls):
+        """ Put processing tasks without lease back to queue, they are left by a prompt worker thread of the server
+            process, which is gone if the server restarted. Return count of them.
+        """
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                "UPDATE prompt_task SET status = ? WHERE status = ? AND field2 IS NULL",
+                (TaskStatus.queued.value, TaskStatus.processing.value)
+            )
+            count = cur.rowcount
+            conn.commit()
+        return count
+
+    @classmethod
+    def update_preview_info(cls, id, preview_info: dict):
+        """ Update preview_info only, it's written every few sampling steps, other columns may be changed
+            by others meanwhile, e.g. status by cancel.
+        """
+
+        updated_time_stamp, updated_datetime_str = get_now_timestamp_and_str()
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    UPDATE prompt_task SET preview_info = ?, updated_time_stamp = ?, updated_datetime_str = ?
+                        WHERE id = ?
+                """,
+                (json.dumps(preview_info), updated_time_stamp, updated_datetime_str, id)
+            )
+            conn.commit()
+
+    @classmethod
+    def get_statuses(cls, ids: list[int]) -> dict[int, str]:
+        if not ids:
+            return {}
+
+        query = "SELECT id, status FROM prompt_task WHERE id IN ({})".format(",".join("?" * len(ids)))
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(query, ids)
+            rows = cur.fetchall()
+        return {id_: status for id_, status in rows}
+
+    @classmethod
+    def start(cls, id, attempts: int):
+        """ Mark the task processing if it's queued, or claimed by a worker, return False if it's not, e.g. canceled
+            after it's got from queue, only status and attempts are written, not the row the worker holds.
+        """
+
+        updated_time_stamp, updated_datetime_str = get_now_timestamp_and_str()
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    UPDATE prompt_task 
+                        SET status = ?, field3 = ?, updated_time_stamp = ?, updated_datetime_str = ?
+                        WHERE id = ? AND status IN (?, ?)
+                """,
+                (TaskStatus.processing.value, str(attempts), updated_time_stamp, updated_datetime_str, id,
+                 TaskStatus.queued.value, TaskStatus.processing.value)
+            )
+            started = cur.rowcount == 1
+            conn.commit()
+        return started
+
+    @classmethod
+    def cancel(cls, id):
+        """ Cancel the task if it's queued or processing, the processing one is interrupted by its worker,
+            return True if canceled.
+        """
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                "UPDATE prompt_task SET status = ? WHERE id = ? AND status IN (?, ?)",
+                (TaskStatus.canceled.value, id, TaskStatus.queued.value, TaskStatus.processing.value)
+            )
+            canceled = cur.rowcount == 1
+            conn.commit()
+        return canceled
+
+    @classmethod
+    def cancel_queued(cls, id):
+        """ Cancel the task if it's still queued, return True if so. """
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                "UPDATE prompt_task SET status = ? WHERE id = ? AND status = ?",
+                (TaskStatus.canceled.value, id, TaskStatus.queued.value)
+            )
+            canceled = cur.rowcount == 1
+            conn.commit()
+        return canceled
+
+    @classmethod
+    def count_queued(cls):
+        """ Count of queued tasks in type of (priority, client_id): count. """
+
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                " SELECT field0, client_id, COUNT(*) FROM prompt_task WHERE status = ? GROUP BY field0, client_id",
+                (TaskStatus.queued.value,)
+            )
+            rows = cur.fetchall()
+        return {(priority or TaskPriority.normal.value, client_id): count for priority, client_id, count in rows}
@@ -0,0 +1,153 @@
+import json
+from contextlib import closing
+from typing import Optional
+
+from pydantic import BaseModel
+
+from data_type.base_data_model import PyDBModel
+from misc.helpers import get_now_timestamp_and_str
+
+
+class FuncProfile(BaseModel):
+    """ One execution of a Func/Comp/Addon in a task, or a hit of outputs cache if cached. """
+
+    func_name: str
+    func_class: str
+    resource: str
+    cached: bool = False
+    error: Optional[str] = None
+
+    thread_name: Optional[str] = None
+    start_time: float = 0
+    """ Seconds since epoch. """
+
+    wall_seconds: float = 0
+    cpu_seconds: float = 0
+    """ CPU time of the thread running the func, time waiting for device is not counted. """
+
+    cuda_seconds: Optional[float] = None
+    """ Time between the func's start and end on the CUDA stream, None if CUDA is not available. """
+
+    peak_memory_bytes: Optional[int] = None
+    """ Peak of device memory allocated while running, funcs running at the same time share it. """
+
+    host_to_device_bytes: int = 0
+    device_to_host_bytes: int = 0
+    """ Bytes of model weights loaded to / offloaded from device while running. """
+
+
+class TaskProfile(PyDBModel):
+    task_id: int
+    card_name: str
+    func_profiles: list[FuncProfile] = []
+    created_time_stamp: Optional[int] = None
+    created_datetime_str: Optional[str] = None
+
+    @classmethod
+    def init(cls):
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """CREATE TABLE IF NOT EXISTS task_profile
+                        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        task_id INTEGER,
+                        card_name TEXT,
+                        func_profiles TEXT,
+                        created_time_stamp INTEGER,
+                        created_datetime_str TEXT
+                        )"""
+            )
+            cur.execute("CREATE INDEX IF NOT EXISTS task_profile_idx_task_id ON task_profile(task_id)")
+
+            conn.commit()
+
+    def save(self):
+        if not self.created_time_stamp:
+            self.created_time_stamp, self.created_datetime_str = get_now_timestamp_and_str()
+
+        conn = self.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(
+                """
+                    INSERT OR REPLACE INTO task_profile
+                        (id, task_id, card_name, func_profiles, created_time_stamp, created_datetime_str)
+                    VALUES
+                        (?, ?, ?, ?, ?, ?)
+                """,
+                self.to_tuple(with_id=True),
+            )
+            if not self.id:
+                self.id = cur.lastrowid
+            conn.commit()
+
+    def to_tuple(self, with_id=False):
+        model_dict = self.model_dump()
+        model_dict['func_profiles'] = json.dumps(model_dict.get('func_profiles', []))
+
+        if with_id:
+            return tuple(model_dict.values())
+        else:
+            model_dict.pop('id')
+            return tuple(model_dict.values())
+
+    @classmethod
+    def from_row(cls, row: tuple):
+        return cls(
+            id=row[0],
+            task_id=row[1],
+            card_name=row[2],
+            func_profiles=json.loads(row[3]),
+            created_time_stamp=row[4],
+            created_datetime_str=row[5],
+        )
+
+    @classmethod
+    def get_profiles_of_task(cls, task_id):
+        """ A task may run several times, e.g. recovered or resumed after preempted, profiles are in run order. """
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute(" SELECT * FROM task_profile WHERE task_id = ? ORDER BY id", (task_id,))
+            rows = cur.fetchall()
+            return [cls.from_row(row) for row in rows]
+
+    @classmethod
+    def remove_profiles_of_task(cls, task_id):
+        conn = cls.conn()
+        with closing(conn.cursor()) as cur:
+            cur.execute("DELETE FROM task_profile WHERE task_id = ?", (task_id,))
+            conn.commit()
+
+    @classmethod
+    def to_chrome_trace(cls, profiles: list['TaskProfile']):
+        """ Chrome trace event format, open it in chrome://tracing or https://ui.perfetto.dev.
+            Every thread running funcs is a track, cache hits are instant events.
+        """
+
+        events = []
+        thread_ids = {}
+        for profile in profiles:
+            for func_profile in profile.func_profiles:
+                thread_name = func_profile.thread_name or 'PromptWorker'
+                if thread_name not in thread_ids:
+                    thread_ids[thread_name] = len(thread_ids)
+                    events.append({
+                        'name': 'thread_name', 'ph': 'M', 'pid': profile.task_id, 'tid': thread_ids[thread_name],
+                        'args': {'name': thread_name}
+                    })
+
+                args = func_profile.model_dump(exclude={'func_name', 'thread_name', 'start_time'})
+                event = {
+                    'name': func_profile.func_name,
+                    'cat': 'cache' if func_profile.cached else func_profile.resource,
+                    'pid': profile.task_id,
+                    'tid': thread_ids[thread_name],
+                    'ts': func_profile.start_time * 1e6,
+                    'args': args,
+                }
+                if func_profile.cached:
+                    event.update(ph='i', s='t')
+                else:
+                    event.update(ph='X', dur=func_profile.wall_seconds * 1e6)
+                events.append(event)
+
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
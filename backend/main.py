@@ -4,9 +4,10 @@ import threading
 import uvicorn
 from data_type.init import initialize_dbs
 from misc.logger import Logger
-from misc.arg_parser import is_prod, host, port
+from misc.arg_parser import is_prod, host, port, prompt_workers, prompt_worker_devices
 from model_download_worker import ModelDownloadWorker
 from prompt_worker import PromptWorker
+from prompt_worker_pool import start_prompt_worker_pool
 from misc.whatsai_dirs import init_file_paths
 
 
@@ -38,7 +39,10 @@ if __name__ == '__main__':
     init_file_paths()
     initialize_dbs()
 
-    start_prompt_worker()
+    if prompt_workers > 0:
+        start_prompt_worker_pool(prompt_workers, prompt_worker_devices)
+    else:
+        start_prompt_worker()
     start_download_worker()
 
     start_server()
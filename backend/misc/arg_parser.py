@@ -4,6 +4,31 @@ parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument("--prod", action='store_true')
 parser.add_argument("--port", type=int, default=8172)
 parser.add_argument("--host", type=str, default='127.0.0.1')
+parser.add_argument("--host-cache-gb", type=float, default=None)
+parser.add_argument("--outputs-cache-gb", type=float, default=None)
+parser.add_argument("--model-residency-gb", type=float, default=None)
+parser.add_argument("--model-residency-policy", type=str, default='lru', choices=['lru', 'lfu'])
+parser.add_argument("--device-concurrency", type=int, default=1)
+parser.add_argument("--disk-concurrency", type=int, default=2)
+parser.add_argument("--cpu-concurrency", type=int, default=2)
+parser.add_argument("--max-batch-size", type=int, default=4)
+parser.add_argument("--max-tasks-per-client", type=int, default=0)
+parser.add_argument("--model-affinity-window", type=int, default=16)
+parser.add_argument("--model-affinity-max-skips", type=int, default=4)
+parser.add_argument("--prompt-workers", type=int, default=0)
+parser.add_argument("--prompt-worker-devices", type=str, default=None)
+parser.add_argument("--task-lease-seconds", type=float, default=60)
+parser.add_argument("--no-task-recovery", action='store_true')
+parser.add_argument("--func-profile", action='store_true')
+parser.add_argument("--max-card-plans", type=int, default=32)
+parser.add_argument("--prefetch-window", type=int, default=4)
+parser.add_argument("--prefetch-gb", type=float, default=None)
+parser.add_argument("--state-dict-cache-gb", type=float, default=None)
+parser.add_argument("--no-lazy-safetensors", action='store_true')
+parser.add_argument("--lora-fusion-gb", type=float, default=None)
+parser.add_argument("--pin-memory", action='store_true')
+parser.add_argument("--cond-cache-gb", type=float, default=1)
+parser.add_argument("--cond-cache-disk-gb", type=float, default=0)
 
 args = parser.parse_args()
 
@@ -11,6 +36,99 @@ port = args.port
 is_prod = args.prod
 host = args.host
 
+host_cache_gb = args.host_cache_gb
+""" Host memory in GB shared by the caches whose own budget is not set, None means half of the RAM.
+    Model residency takes half of it, outputs cache a quarter, state dict cache and LoRA fusion an eighth each.
+"""
+
+outputs_cache_gb = args.outputs_cache_gb
+""" Memory budget of prompt worker's outputs cache in GB, None means its share of host_cache_gb.
+    Outputs holding models are not counted, they are kept by model residency.
+"""
+
+model_residency_gb = args.model_residency_gb
+""" Memory budget of models kept loaded across prompts in GB, None means its share of host_cache_gb. """
+
+model_residency_policy = args.model_residency_policy
+""" Which models to drop first when over the budget, 'lru' for least recently used, 'lfu' for least used. """
+
+device_concurrency = args.device_concurrency
+""" How many device funcs of a card can run at the same time, e.g. text encoders of positive and negative prompt. """
+
+disk_concurrency = args.disk_concurrency
+""" How many disk funcs of a card can run at the same time, e.g. loaders of model files. """
+
+cpu_concurrency = args.cpu_concurrency
+""" How many cpu funcs of a card can run at the same time, e.g. saving images. """
+
+max_batch_size = args.max_batch_size
+""" At most how many queued tasks of the same card can run as one batch, set 1 to turn batching off. """
+
+max_tasks_per_client = args.max_tasks_per_client
+""" At most how many tasks of one client can be processing at the same time, 0 means no limit. """
+
+model_affinity_window = args.model_affinity_window
+""" How many queued tasks to look ahead for one using the loaded models, 0 or 1 turns model affinity off. """
+
+model_affinity_max_skips = args.model_affinity_max_skips
+""" How many times a queued task can be passed over for model affinity before it must run. """
+
+prompt_workers = args.prompt_workers
+""" How many prompt worker processes to run sharing the prompt_task table as queue,
+    0 means a single prompt worker thread in the server process.
+"""
+
+prompt_worker_devices = args.prompt_worker_devices.split(',') if args.prompt_worker_devices else []
+""" Comma separated CUDA devices, e.g. "0,1", prompt worker processes take them in turn. """
+
+task_lease_seconds = args.task_lease_seconds
+""" How long a prompt worker process keeps a claimed task without heartbeat before it's put back to queue. """
+
+recover_tasks = not args.no_task_recovery
+""" Put undone tasks back to queue when prompt worker starts, including the ones interrupted by restart or crash. """
+
+profile_funcs = args.func_profile
+""" Record time, memory and cache hits of every func executed in prompt tasks, see TaskProfile, off by default,
+    as measuring memory resets peak stats and synchronizes the device around every func.
+"""
+
+max_card_plans = args.max_card_plans
+""" At most how many card plans, one per card and addon structure, prompt worker keeps for reuse. """
+
+prefetch_window = args.prefetch_window
+""" How many queued tasks to read model files of ahead into page cache, 0 turns prefetch off. """
+
+prefetch_gb = args.prefetch_gb
+""" At most how many GB of model files to prefetch for the queued tasks, None means a quarter of available RAM. """
+
+state_dict_cache_gb = args.state_dict_cache_gb
+""" Memory budget of state dicts of model files kept in host memory for loading them again in GB,
+    None means its share of host_cache_gb, 0 turns it off.
+"""
+
+lazy_safetensors = not args.no_lazy_safetensors
+""" Map safetensors files into memory instead of reading them, tensors are read from page cache when touched and
+    the pages are shared by prompt worker processes loading the same file.
+"""
+
+lora_fusion_gb = args.lora_fusion_gb
+""" Memory budget of weight deltas of LoRA stacks fused ahead in GB, None means its share of host_cache_gb,
+    0 turns it off.
+"""
+
+pin_memory = args.pin_memory
+""" Keep cached state dicts and fused LoRA deltas in pinned memory when CUDA is available, so copying them to device
+    is a DMA copy, pinned memory can't be swapped out or given back to the system under pressure.
+"""
+
+cond_cache_gb = args.cond_cache_gb
+""" Memory budget of text encoder outputs kept for prompts encoded again in GB, 0 turns it off. """
+
+cond_cache_disk_gb = args.cond_cache_disk_gb
+""" Disk budget of text encoder outputs kept across restarts and shared by prompt worker processes in GB,
+    0 turns it off.
+"""
+
 log_sink_to_file = True if is_prod else False
 """ loguru sink config, setting True will save logs into file. """
 
@@ -0,0 +1,84 @@
+""" Opt-in CFG modes of a sampling run, trading a little quality for fewer model evaluations of the uncond:
+    skip it on the last steps, reuse the one of an earlier step, and run cond and uncond in one model call per step.
+    Set on model_options by common_ksampler, taken by CondBatchPlanner.calc_cond_batch.
+"""
+import threading
+
+import torch
+
+CFG_OPTIONS_KEY = 'whatsai_cfg_options'
+""" Key of CfgOptions in model_options. """
+
+
+class CfgOptions:
+    lock = threading.Lock()
+
+    computed = 0
+    reused = 0
+    skipped = 0
+    """ Uncond predictions of all runs by how they are got. """
+
+    def __init__(self, sigmas: torch.Tensor, skip_uncond_tail=0.0, uncond_reuse_interval=1, batched_cfg=False):
+        self.sigmas = sigmas.detach().float().cpu()
+        """ Sigmas of the steps sampled, to tell which step a model call is of. """
+
+        self.skip_uncond_tail = skip_uncond_tail
+        """ Fraction of the last steps taking the cond prediction alone, as if cfg is 1. """
+
+        self.uncond_reuse_interval = max(int(uncond_reuse_interval), 1)
+        """ Uncond is predicted every so many steps, steps between take the noise it predicted. """
+
+        self.batched_cfg = batched_cfg
+        """ Cond and uncond go in one model call, not split by the free memory estimate of comfy. """
+
+        self.uncond_eps: torch.Tensor | None = None
+        """ Noise the last uncond prediction tells, (x - uncond) / sigma. """
+
+        self.uncond_step: int | None = None
+
+    @property
+    def is_active(self):
+        return self.skip_uncond_tail > 0 or self.uncond_reuse_interval > 1 or self.batched_cfg
+
+    def step_of(self, timestep: torch.Tensor) -> int:
+        """ Step of the sigma nearest to timestep, model calls between sigmas of 2nd order samplers go to one. """
+        return int(torch.argmin((self.sigmas - float(timestep[0])).abs()))
+
+    def calc_cond_batch(self, calc, conds: list, x_in: torch.Tensor, timestep: torch.Tensor) -> list[torch.Tensor]:
+        """ calc(conds) predicts conds as comfy calc_cond_batch does, conds are [cond, uncond] of sampling_function,
+            uncond is None when cfg is 1.
+        """
+
+        if len(conds) != 2 or conds[1] is None or not (self.skip_uncond_tail > 0 or self.uncond_reuse_interval > 1):
+            return calc(conds)
+
+        steps = len(self.sigmas) - 1
+        step = self.step_of(timestep)
+        if self.skip_uncond_tail > 0 and step >= steps - round(steps * self.skip_uncond_tail):
+            out = calc([conds[0], None])
+            out[1] = out[0]
+            with self.lock:
+                CfgOptions.skipped += 1
+            return out
+
+        sigma = timestep.reshape([-1] + [1] * (x_in.ndim - 1))
+        if self.uncond_eps is not None and self.uncond_eps.shape == x_in.shape \
+                and step - self.uncond_step < self.uncond_reuse_interval:
+            out = calc([conds[0], None])
+            out[1] = x_in - self.uncond_eps.to(x_in) * sigma
+            with self.lock:
+                CfgOptions.reused += 1
+            return out
+
+        out = calc(conds)
+        if self.uncond_reuse_interval > 1 and bool((sigma > 0).all()):
+            self.uncond_eps = (x_in - out[1]) / sigma
+            self.uncond_step = step
+        with self.lock:
+            CfgOptions.computed += 1
+        return out
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {'computed': cls.computed, 'reused': cls.reused, 'skipped': cls.skipped}
@@ -0,0 +1,210 @@
+""" Text encoding of many prompts in one forward of each text encoder, instead of one forward per prompt.
+    comfy text encoder wrappers, e.g. SDXLClipModel, call encode_token_weights of their inner encoders, SDClipModel of
+    CLIP or T5, and combine the outputs. The wrapper is run for every prompt with inner encoders answering from
+    outputs encoded for all prompts together, an encoder not encoded yet records its tokens and stops the run, then
+    tokens recorded of all prompts are encoded in one batch and the prompts are run again.
+    The wrapper run is a shallow copy holding proxies of inner encoders, see detached, so clones of the CLIP sharing
+    the encoders encode as usual meanwhile.
+"""
+import copy
+
+import torch
+
+import comfy.model_management
+from comfy.sd1_clip import ClipTokenWeightEncoder, gen_empty_tokens
+
+max_batch_rows = 32
+""" At most so many chunks of tokens in one forward, to bound memory taken by activations. """
+
+
+class TokensRecorded(Exception):
+    """ Raised by an inner encoder after recording tokens of a prompt, nothing is encoded for it yet. """
+
+
+class EncoderProxy:
+    """ In place of an inner encoder in the wrapper run, other attributes are the ones of the encoder. """
+
+    def __init__(self, encoder: ClipTokenWeightEncoder, encode_token_weights):
+        self.encoder = encoder
+        self.encode_token_weights = encode_token_weights
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+
+def batchable_encoders(clip) -> list[ClipTokenWeightEncoder]:
+    """ Inner encoders taking the encode_token_weights of comfy ClipTokenWeightEncoder, others are left as they are. """
+    return [
+        module for module in clip.cond_stage_model.modules()
+        if isinstance(module, ClipTokenWeightEncoder)
+        and type(module).encode_token_weights is ClipTokenWeightEncoder.encode_token_weights
+    ]
+
+
+def detached(module: torch.nn.Module, proxies: dict[int, EncoderProxy]):
+    """ Shallow copy of module with proxies, id of encoder -> its proxy, in place of the encoders, modules holding
+        them are copied the same way. Proxies are set in __dict__ of copies, _modules shared with the originals is
+        not changed.
+    """
+
+    if id(module) in proxies:
+        return proxies[id(module)]
+
+    changed = {}
+    for name, child in module._modules.items():
+        if child is not None:
+            detached_child = detached(child, proxies)
+            if detached_child is not child:
+                changed[name] = detached_child
+    if not changed:
+        return module
+
+    module_copy = copy.copy(module)
+    module_copy.__dict__.update(changed)
+    return module_copy
+
+
+def copy_output(output: tuple) -> tuple:
+    """ Wrappers may change outputs in place, each run of them gets its own copy. """
+
+    def copy(value):
+        if isinstance(value, torch.Tensor):
+            return value.clone()
+        if isinstance(value, dict):
+            return {key: copy(item) for key, item in value.items()}
+        return value
+
+    return tuple(copy(value) for value in output)
+
+
+def encode_token_weights_batch(encoder: ClipTokenWeightEncoder, token_weight_pairs_list: list) -> list[tuple]:
+    """ Same as [encoder.encode_token_weights(pairs) for pairs in token_weight_pairs_list], chunks of all prompts and
+        the empty tokens their weights are relative to are encoded in batches of rows of the same length.
+    """
+
+    empty_tokens = getattr(encoder, 'gen_empty_tokens', gen_empty_tokens)
+    rows = []
+    row_of = {}
+    prompts = []
+    for token_weight_pairs in token_weight_pairs_list:
+        chunks = [[token for token, _ in chunk] for chunk in token_weight_pairs]
+        max_token_len = max((len(chunk) for chunk in chunks), default=0)
+        has_weights = any(weight != 1.0 for chunk in token_weight_pairs for _, weight in chunk)
+
+        chunk_rows = []
+        for chunk in chunks:
+            chunk_rows.append(len(rows))
+            rows.append(chunk)
+        empty_row = None
+        if has_weights or len(chunks) == 0:
+            empty = empty_tokens(encoder.special_tokens, max_token_len)
+            empty_key = repr(empty)
+            if empty_key not in row_of:
+                row_of[empty_key] = len(rows)
+                rows.append(empty)
+            empty_row = row_of[empty_key]
+        prompts.append((token_weight_pairs, chunk_rows, empty_row))
+
+    row_lengths = {}
+    for index, row in enumerate(rows):
+        row_lengths.setdefault(len(row), []).append(index)
+
+    outs, pooleds, extras = [None] * len(rows), [None] * len(rows), [None] * len(rows)
+    for indexes in row_lengths.values():
+        for start in range(0, len(indexes), max_batch_rows):
+            batch = indexes[start:start + max_batch_rows]
+            o = encoder.encode([rows[index] for index in batch])
+            for position, index in enumerate(batch):
+                outs[index] = o[0][position:position + 1]
+                pooleds[index] = o[1][position:position + 1] if o[1] is not None else None
+                if len(o) > 2:
+                    extras[index] = {
+                        key: value[position:position + 1] if key == 'attention_mask' else value
+                        for key, value in o[2].items()
+                    }
+
+    intermediate_device = comfy.model_management.intermediate_device()
+    outputs = []
+    for token_weight_pairs, chunk_rows, empty_row in prompts:
+        first_row = chunk_rows[0] if chunk_rows else empty_row
+        first_pooled = pooleds[first_row].to(intermediate_device) if pooleds[first_row] is not None else None
+
+        output = []
+        for k, row in enumerate(chunk_rows):
+            z = outs[row].clone()
+            if empty_row is not None:
+                z_empty = outs[empty_row][0]
+                for j in range(z.shape[1]):
+                    weight = token_weight_pairs[k][j][1]
+                    if weight != 1.0:
+                        z[0][j] = (z[0][j] - z_empty[j]) * weight + z_empty[j]
+            output.append(z)
+
+        if len(output) == 0:
+            r = (outs[empty_row].to(intermediate_device), first_pooled)
+        else:
+            r = (torch.cat(output, dim=-2).to(intermediate_device), first_pooled)
+
+        if extras[first_row] is not None:
+            extra = dict(extras[first_row])
+            if 'attention_mask' in extra:
+                masks = [extras[row]['attention_mask'] for row in chunk_rows] or [extra['attention_mask'][:0]]
+                extra['attention_mask'] = torch.cat(masks).flatten().unsqueeze(dim=0).to(intermediate_device)
+            r = r + (extra,)
+        outputs.append(r)
+    return outputs
+
+
+def encode_batch(clip, tokens_list: list) -> list[dict]:
+    """ Same as [clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True) for tokens in tokens_list]. """
+
+    if len(tokens_list) <= 1:
+        return [clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True) for tokens in tokens_list]
+
+    clip.cond_stage_model.reset_clip_options()
+    if clip.layer_idx is not None:
+        clip.cond_stage_model.set_clip_options({"layer": clip.layer_idx})
+    clip.load_model()
+
+    encoders = batchable_encoders(clip)
+    encoded = {}  # (encoder index, prompt index) -> output of the encoder for tokens of the prompt.
+    recorded = {}  # encoder index -> {prompt index: tokens the encoder is called with}, of the current round.
+    running = [0]  # index of the prompt the wrapper runs for.
+
+    def answer(encoder_index: int):
+        def encode_token_weights(token_weight_pairs):
+            output = encoded.get((encoder_index, running[0]))
+            if output is not None:
+                return copy_output(output)
+            recorded.setdefault(encoder_index, {})[running[0]] = token_weight_pairs
+            raise TokensRecorded()
+        return encode_token_weights
+
+    wrapper = detached(clip.cond_stage_model, {
+        id(encoder): EncoderProxy(encoder, answer(encoder_index)) for encoder_index, encoder in enumerate(encoders)
+    })
+
+    outputs = [None] * len(tokens_list)
+    pending = list(range(len(tokens_list)))
+    while pending:
+        recorded.clear()
+        for prompt_index in list(pending):
+            running[0] = prompt_index
+            try:
+                outputs[prompt_index] = wrapper.encode_token_weights(tokens_list[prompt_index])
+                pending.remove(prompt_index)
+            except TokensRecorded:
+                continue
+
+        for encoder_index, token_weight_pairs_of in recorded.items():
+            batch_outputs = encode_token_weights_batch(encoders[encoder_index], list(token_weight_pairs_of.values()))
+            for prompt_index, output in zip(token_weight_pairs_of, batch_outputs):
+                encoded[(encoder_index, prompt_index)] = output
+
+    results = []
+    for o in outputs:
+        out = {"cond": o[0], "pooled_output": o[1]}
+        if len(o) > 2:
+            out.update(o[2])
+        results.append(clip.add_hooks_to_dict(out))
+    return results
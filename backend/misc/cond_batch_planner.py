@@ -0,0 +1,217 @@
+""" Cond batches of a sampling run planned once, comfy _calc_cond_batch groups conds, computes their areas and masks
+    and concatenates them on every step, while they only change when conds go in or out of their timestep range.
+    Installed on model patchers as comfy calc_cond_batch wrapper, see CondBatchPlanner.install.
+"""
+import threading
+
+import torch
+
+import comfy.patcher_extension
+from comfy import model_management
+from comfy.samplers import can_concat_cond, cond_cat, get_area_and_mult
+from misc.cfg_options import CFG_OPTIONS_KEY, CfgOptions
+
+WRAPPER_KEY = 'whatsai_cond_batch_planner'
+
+
+def is_active(cond: dict, timestep) -> bool:
+    """ Whether get_area_and_mult takes the cond at timestep. """
+
+    if 'timestep_start' in cond and timestep[0] > cond['timestep_start']:
+        return False
+    if 'timestep_end' in cond and timestep[0] < cond['timestep_end']:
+        return False
+    return True
+
+
+def narrow_area(tensor: torch.Tensor, area: list[int] | None) -> torch.Tensor:
+    if area is None:
+        return tensor
+    dims = len(area) // 2
+    for i in range(dims):
+        tensor = tensor.narrow(i + 2, area[i + dims], area[i])
+    return tensor
+
+
+class CondBatch:
+    def __init__(self, cond_objs: list[tuple]):
+        """ cond_objs are (cond_obj of get_area_and_mult, index of conds it is of) concatable in one batch. """
+
+        self.areas = [p.area for p, _ in cond_objs]
+        self.mults = [p.mult for p, _ in cond_objs]
+        self.cond_or_uncond = [index for _, index in cond_objs]
+        self.uuids = [p.uuid for p, _ in cond_objs]
+        self.control = cond_objs[-1][0].control
+        self.patches = cond_objs[-1][0].patches
+
+        self.c = cond_cat([p.conditioning for p, _ in cond_objs])
+        """ Conditioning of the batch concatenated, on device, kept for every step. """
+
+
+class CondBatchPlan:
+    def __init__(self, model, conds: list[list[dict] | None], active: list[list[int]], x_in: torch.Tensor,
+                 timestep, single_batch=False):
+        """ Group conds active the same way comfy _calc_cond_batch does, memory free is taken at planning.
+            single_batch puts conds which can be concatenated in one batch whatever memory is free.
+        """
+
+        to_run = []
+        for i, indexes in enumerate(active):
+            for j in indexes:
+                p = get_area_and_mult(conds[i][j], x_in, timestep)
+                if p is not None:
+                    to_run.append((p, i))
+
+        self.counts = [torch.ones_like(x_in) * 1e-37 for _ in conds]
+        """ Sum of mults of each cond index, what comfy divides outputs by. """
+
+        for p, i in to_run:
+            narrow_area(self.counts[i], p.area).add_(p.mult)
+
+        self.batches: list[CondBatch] = []
+        while len(to_run) > 0:
+            first = to_run[0]
+            first_shape = first[0].input_x.shape
+            to_batch_temp = [x for x in range(len(to_run)) if can_concat_cond(to_run[x][0], first[0])]
+            to_batch_temp.reverse()
+            to_batch = to_batch_temp[:1]
+
+            if single_batch:
+                to_batch = to_batch_temp
+            else:
+                free_memory = model_management.get_free_memory(x_in.device)
+                for i in range(1, len(to_batch_temp) + 1):
+                    batch_amount = to_batch_temp[:len(to_batch_temp) // i]
+                    input_shape = [len(batch_amount) * first_shape[0]] + list(first_shape)[1:]
+                    if model.memory_required(input_shape) * 1.5 < free_memory:
+                        to_batch = batch_amount
+                        break
+
+            self.batches.append(CondBatch([to_run.pop(x) for x in to_batch]))
+
+    def run(self, model, x_in: torch.Tensor, timestep, model_options) -> list[torch.Tensor]:
+        """ Same as comfy _calc_cond_batch, with the batches planned. """
+
+        model.current_patcher.prepare_state(timestep)
+        out_conds = [torch.zeros_like(x_in) for _ in self.counts]
+
+        for batch in self.batches:
+            batch_chunks = len(batch.cond_or_uncond)
+            input_x = torch.cat([narrow_area(x_in, area) for area in batch.areas])
+            timestep_ = torch.cat([timestep] * batch_chunks)
+
+            transformer_options = model.current_patcher.apply_hooks(hooks=None)
+            if 'transformer_options' in model_options:
+                transformer_options = comfy.patcher_extension.merge_nested_dicts(transformer_options,
+                                                                                 model_options['transformer_options'],
+                                                                                 copy_dict1=False)
+            if batch.patches is not None:
+                cur_patches = transformer_options.get("patches", {}).copy()
+                for name, patches in batch.patches.items():
+                    cur_patches[name] = cur_patches.get(name, []) + patches
+                transformer_options["patches"] = cur_patches
+
+            transformer_options["cond_or_uncond"] = batch.cond_or_uncond[:]
+            transformer_options["uuids"] = batch.uuids[:]
+            transformer_options["sigmas"] = timestep
+
+            c = {**batch.c, 'transformer_options': transformer_options}
+            if batch.control is not None:
+                c['control'] = batch.control.get_control(input_x, timestep_, c, batch_chunks, transformer_options)
+
+            if 'model_function_wrapper' in model_options:
+                output = model_options['model_function_wrapper'](model.apply_model, {
+                    "input": input_x, "timestep": timestep_, "c": c, "cond_or_uncond": batch.cond_or_uncond
+                }).chunk(batch_chunks)
+            else:
+                output = model.apply_model(input_x, timestep_, **c).chunk(batch_chunks)
+
+            for o in range(batch_chunks):
+                narrow_area(out_conds[batch.cond_or_uncond[o]], batch.areas[o]).add_(output[o] * batch.mults[o])
+
+        return [out_cond / count for out_cond, count in zip(out_conds, self.counts)]
+
+
+class CondBatchPlanner:
+    conds: list | None = None
+    """ Conds of the sampling run the plans are of, the list of cond and uncond is the same object every step. """
+
+    plans: dict[tuple, CondBatchPlan] = {}
+    """ (model, shape, dtype, device of x, conds active) -> plan, of the conds only, dropped when a new run starts. """
+
+    lock = threading.Lock()
+
+    planned = 0
+    reused = 0
+
+    @classmethod
+    def install(cls, patcher):
+        """ Called on model patchers fresh from loaders, clones of them keep it, so comfy sees the same wrappers on
+            them and keeps their weights loaded.
+        """
+        patcher.remove_wrappers_with_key(comfy.patcher_extension.WrappersMP.CALC_COND_BATCH, WRAPPER_KEY)
+        patcher.add_wrapper_with_key(comfy.patcher_extension.WrappersMP.CALC_COND_BATCH, WRAPPER_KEY,
+                                     cls.calc_cond_batch)
+
+    @classmethod
+    def is_plannable(cls, conds: list[list[dict] | None]) -> bool:
+        """ Default conds take what other conds leave of the mask, hooked conds change by keyframes of steps,
+            they are left to comfy.
+        """
+        return all(
+            'default' not in cond and cond.get('hooks') is None
+            for cond_list in conds if cond_list is not None for cond in cond_list
+        )
+
+    @classmethod
+    def calc_cond_batch(cls, executor, model, conds, x_in: torch.Tensor, timestep, model_options):
+        """ Takes the place of comfy _calc_cond_batch if it is the last wrapper, wrappers after it run as they are.
+            CfgOptions of the run in model_options decide which conds are predicted.
+        """
+
+        cfg_options: CfgOptions | None = model_options.get(CFG_OPTIONS_KEY)
+        if cfg_options is None:
+            return cls.calc(executor, model, conds, x_in, timestep, model_options)
+
+        def calc(conds_):
+            return cls.calc(executor, model, conds_, x_in, timestep, model_options, cfg_options.batched_cfg)
+        return cfg_options.calc_cond_batch(calc, conds, x_in, timestep)
+
+    @classmethod
+    def calc(cls, executor, model, conds, x_in: torch.Tensor, timestep, model_options, single_batch=False):
+        if executor.idx + 1 != len(executor.wrappers) or not cls.is_plannable(conds):
+            return executor(model, conds, x_in, timestep, model_options)
+
+        active = [
+            [j for j, cond in enumerate(cond_list) if is_active(cond, timestep)] if cond_list is not None else []
+            for cond_list in conds
+        ]
+        key = (id(model), tuple(x_in.shape), x_in.dtype, x_in.device, tuple(map(tuple, active)), single_batch)
+
+        with cls.lock:
+            if cls.conds is None or len(cls.conds) != len(conds) \
+                    or any(a is not b for a, b in zip(cls.conds, conds) if a is not None and b is not None):
+                cls.conds = list(conds)
+                cls.plans = {}
+            else:  # uncond left out of some steps is the same run.
+                cls.conds = [b if b is not None else a for a, b in zip(cls.conds, conds)]
+
+            plan = cls.plans.get(key)
+            if plan is None:
+                plan = cls.plans[key] = CondBatchPlan(model, conds, active, x_in, timestep, single_batch)
+                cls.planned += 1
+            else:
+                cls.reused += 1
+
+        return plan.run(model, x_in, timestep, model_options)
+
+    @classmethod
+    def clear_all(cls):
+        with cls.lock:
+            cls.conds = None
+            cls.plans = {}
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {'plans': len(cls.plans), 'planned': cls.planned, 'reused': cls.reused}
@@ -0,0 +1,274 @@
+""" Outputs of text encoders kept for prompts encoded again, e.g. the same negative prompt or prompt template, in
+    memory and optionally on disk, shared by prompt worker processes and kept across restarts.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import safetensors.torch
+import torch
+
+from misc import arg_parser
+from misc.clip_batch import encode_batch
+from misc.logger import logger
+from misc.lora_fusion import LoraFusion
+from misc.state_dict_cache import LazyStateDict, state_dict_bytes
+from misc.token_cache import TokenCache
+from misc.whatsai_dirs import cond_cache_dir
+
+
+def update_hash(hasher, value):
+    """ Hash tokens of comfy tokenizers, ids and weights, or tensors of embeddings in place of ids. """
+
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu().contiguous()
+        hasher.update(f'tensor{value.dtype}{tuple(value.shape)}'.encode('utf-8'))
+        hasher.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(value, dict):
+        hasher.update(b'{')
+        for key in sorted(value):
+            hasher.update(repr(key).encode('utf-8'))
+            update_hash(hasher, value[key])
+        hasher.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b'[')
+        for item in value:
+            update_hash(hasher, item)
+        hasher.update(b']')
+    else:
+        hasher.update(repr(value).encode('utf-8'))
+
+
+def compact(tensor: torch.Tensor) -> torch.Tensor:
+    """ float32 in float16 if it fits. """
+    if tensor.dtype == torch.float32:
+        half = tensor.half()
+        if torch.isfinite(half).all():
+            return half
+    return tensor
+
+
+class CondCache:
+    budget_bytes = int(arg_parser.cond_cache_gb * 1024 ** 3)
+    disk_budget_bytes = int(arg_parser.cond_cache_disk_gb * 1024 ** 3)
+
+    entries: OrderedDict[str, tuple[dict, dict]] = OrderedDict()
+    """ key -> (outputs in compact dtypes, dtypes of them when encoded), least recently used first. """
+
+    entry_bytes: dict[str, int] = {}
+    total_bytes = 0
+
+    disk_bytes: int | None = None
+    """ Bytes of files in cond_cache_dir, scanned when first needed, other processes write there too. """
+
+    lock = threading.Lock()
+
+    hits = 0
+    disk_hits = 0
+    misses = 0
+
+    @classmethod
+    def key(cls, clip, tokens) -> str | None:
+        """ Hash of the encoder weights with LoRAs on them, layer taken, device, and tokens, None if the weights are
+            not known, e.g. patched by something not fused, or hooks change conds.
+        """
+
+        weights_key = LoraFusion.weights_key(clip.patcher)
+        if weights_key is None or clip.apply_hooks_to_conds is not None:
+            return None
+
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps([weights_key, clip.layer_idx, str(clip.patcher.load_device)], default=str)
+                      .encode('utf-8'))
+        update_hash(hasher, tokens)
+        return hasher.hexdigest()
+
+    @classmethod
+    def encode(cls, clip, text: str) -> dict:
+        """ Same as clip.encode_from_tokens(clip.tokenize(text), return_pooled=True, return_dict=True). """
+
+        tokens = TokenCache.tokenize(clip, text)
+        key = cls.key(clip, tokens) if cls.budget_bytes > 0 or cls.disk_budget_bytes > 0 else None
+
+        if key is not None:
+            cached = cls.get(key)
+            if cached is not None:
+                return cached
+
+        output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
+        if key is not None:
+            cls.put(key, output)
+        return output
+
+    @classmethod
+    def encode_batch(cls, clip, texts: list[str]) -> list[dict]:
+        """ Same as [cls.encode(clip, text) for text in texts], prompts not cached are encoded in one batch. """
+
+        TokenCache.prefetch(clip, texts)
+        unique_texts = list(dict.fromkeys(texts))
+        tokens_of = {text: TokenCache.tokenize(clip, text) for text in unique_texts}
+        use_cache = cls.budget_bytes > 0 or cls.disk_budget_bytes > 0
+        keys = {text: cls.key(clip, tokens_of[text]) if use_cache else None for text in unique_texts}
+
+        outputs = {}
+        for text in unique_texts:
+            if keys[text] is not None:
+                cached = cls.get(keys[text])
+                if cached is not None:
+                    outputs[text] = cached
+
+        missing = [text for text in unique_texts if text not in outputs]
+        for text, output in zip(missing, encode_batch(clip, [tokens_of[text] for text in missing])):
+            if keys[text] is not None:
+                cls.put(keys[text], output)
+            outputs[text] = output
+
+        # a text repeated gets its own tensors, so a task changing its cond in place doesn't change the others.
+        results = []
+        returned = set()
+        for text in texts:
+            output = outputs[text]
+            if text in returned:
+                output = {name: value.clone() if isinstance(value, torch.Tensor) else value
+                          for name, value in output.items()}
+            returned.add(text)
+            results.append(output)
+        return results
+
+    @classmethod
+    def get(cls, key: str) -> dict | None:
+        with cls.lock:
+            entry = cls.entries.get(key)
+            if entry is not None:
+                cls.entries.move_to_end(key)
+                cls.hits += 1
+
+        if entry is None and cls.disk_budget_bytes > 0:
+            entry = cls.load(key)
+            if entry is not None:
+                with cls.lock:
+                    cls.disk_hits += 1
+                cls.keep(key, *entry)
+
+        if entry is None:
+            with cls.lock:
+                cls.misses += 1
+            return None
+
+        values, dtypes = entry
+        return {
+            name: value.to(getattr(torch, dtypes[name]), copy=True) if isinstance(value, torch.Tensor) else value
+            for name, value in values.items()
+        }
+
+    @classmethod
+    def put(cls, key: str, output: dict):
+        if not all(value is None or isinstance(value, torch.Tensor) for value in output.values()):
+            return
+
+        values = {name: compact(value.detach().cpu()) if value is not None else None for name, value in output.items()}
+        dtypes = {
+            name: str(value.dtype).removeprefix('torch.') for name, value in output.items() if value is not None
+        }
+        cls.keep(key, values, dtypes)
+        if cls.disk_budget_bytes > 0:
+            cls.save(key, values, dtypes)
+
+    @classmethod
+    def keep(cls, key: str, values: dict, dtypes: dict):
+        size = state_dict_bytes(values)
+        if cls.budget_bytes <= 0 or size > cls.budget_bytes:
+            return
+
+        with cls.lock:
+            if key in cls.entries:
+                cls.total_bytes -= cls.entry_bytes[key]
+            cls.entries[key] = (values, dtypes)
+            cls.entries.move_to_end(key)
+            cls.entry_bytes[key] = size
+            cls.total_bytes += size
+            while cls.total_bytes > cls.budget_bytes and cls.entries:
+                evicted_key, _ = cls.entries.popitem(last=False)
+                cls.total_bytes -= cls.entry_bytes.pop(evicted_key)
+
+    @classmethod
+    def path_of(cls, key: str):
+        return cond_cache_dir / f'{key}.safetensors'
+
+    @classmethod
+    def load(cls, key: str) -> tuple[dict, dict] | None:
+        """ Tensors are views of the file mapped into memory. """
+
+        path = cls.path_of(key)
+        try:
+            sd = LazyStateDict(str(path))
+            os.utime(path)  # files least recently used are removed first.
+        except (OSError, ValueError):
+            return None
+
+        none_names = json.loads(sd.metadata.get('none_names', '[]'))
+        values = {**dict(sd), **{name: None for name in none_names}}
+        return values, json.loads(sd.metadata['dtypes'])
+
+    @classmethod
+    def save(cls, key: str, values: dict, dtypes: dict):
+        path = cls.path_of(key)
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+
+        tensors = {name: value.contiguous() for name, value in values.items() if value is not None}
+        metadata = {
+            'dtypes': json.dumps(dtypes),
+            'none_names': json.dumps([name for name, value in values.items() if value is None]),
+        }
+        try:
+            safetensors.torch.save_file(tensors, str(tmp_path), metadata=metadata)
+            size = tmp_path.stat().st_size
+            tmp_path.replace(path)
+        except OSError as e:
+            logger.warning(f"Save cond to {path} failed: {e}")
+            return
+
+        with cls.lock:
+            if cls.disk_bytes is None:
+                cls.disk_bytes = sum(file.stat().st_size for file in cond_cache_dir.glob('*.safetensors'))
+            else:
+                cls.disk_bytes += size
+            if cls.disk_bytes > cls.disk_budget_bytes:
+                cls.evict_files()
+
+    @classmethod
+    def evict_files(cls):
+        """ Remove files least recently used until a tenth under the budget, call it with lock held. """
+
+        files = []
+        for file in cond_cache_dir.glob('*.safetensors'):
+            try:
+                stat = file.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+        files.sort()
+
+        cls.disk_bytes = sum(size for _, size, _ in files)
+        for _, size, file in files:
+            if cls.disk_bytes <= cls.disk_budget_bytes * 0.9:
+                break
+            try:
+                file.unlink()
+                cls.disk_bytes -= size
+            except OSError:  # mapped by another process on Windows, or removed by it already.
+                continue
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {
+                'entries': len(cls.entries),
+                'bytes': cls.total_bytes,
+                'disk_bytes': cls.disk_bytes or 0,
+                'hits': cls.hits,
+                'disk_hits': cls.disk_hits,
+                'misses': cls.misses,
+            }
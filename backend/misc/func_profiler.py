@@ -0,0 +1,73 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+
+import comfy.model_management
+from data_type.whatsai_task_profile import FuncProfile
+
+
+def loaded_model_bytes():
+    """ Bytes of model weights on device now. """
+    loaded_bytes = 0
+    for loaded_model in list(comfy.model_management.current_loaded_models):
+        if loaded_model.model is not None:
+            loaded_bytes += loaded_model.model_loaded_memory()
+    return loaded_bytes
+
+
+@contextmanager
+def profile_func(func, profiles: list[FuncProfile]):
+    """ Measure the func running in the context and append its FuncProfile to profiles. """
+
+    profile = FuncProfile(
+        func_name=func.name,
+        func_class=func.__class__.__name__,
+        resource=func.resource,
+        thread_name=threading.current_thread().name,
+        start_time=time.time(),
+    )
+
+    use_cuda = torch.cuda.is_available()
+    if use_cuda:
+        start_event = torch.cuda.Event(enable_timing=True)
+        end_event = torch.cuda.Event(enable_timing=True)
+        torch.cuda.reset_peak_memory_stats()
+        start_event.record()
+
+    model_bytes = loaded_model_bytes()
+    start_counter = time.perf_counter()
+    start_thread_time = time.thread_time()
+
+    try:
+        yield profile
+    except Exception as e:
+        profile.error = str(e)
+        raise
+    finally:
+        profile.wall_seconds = time.perf_counter() - start_counter
+        profile.cpu_seconds = time.thread_time() - start_thread_time
+
+        moved_bytes = loaded_model_bytes() - model_bytes
+        profile.host_to_device_bytes = max(moved_bytes, 0)
+        profile.device_to_host_bytes = max(-moved_bytes, 0)
+
+        if use_cuda:
+            end_event.record()
+            end_event.synchronize()
+            profile.cuda_seconds = start_event.elapsed_time(end_event) / 1000
+            profile.peak_memory_bytes = torch.cuda.max_memory_allocated()
+
+        profiles.append(profile)
+
+
+def cached_func_profile(func) -> FuncProfile:
+    return FuncProfile(
+        func_name=func.name,
+        func_class=func.__class__.__name__,
+        resource=func.resource,
+        cached=True,
+        thread_name=threading.current_thread().name,
+        start_time=time.time(),
+    )
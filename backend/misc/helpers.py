@@ -294,6 +294,22 @@ def conditioning_set_values(conditioning, values={}):
     return c
 
 
+def repeat_conds_per_task(conditioning, tasks: int, per_task: int):
+    """ Conds of a batch of tasks have one sample per task, [c0, c1], while the latent has per_task samples of each,
+        [t0b0, t0b1, t1b0, t1b1], repeat each task's sample in place to [c0, c0, c1, c1], comfy repeat_to_batch_size
+        would tile it to [c0, c1, c0, c1]. Tensors not batched per task are left to comfy.
+    """
+    if tasks <= 1 or per_task <= 1:
+        return conditioning
+
+    def repeat(value):
+        if getattr(value, 'shape', None) is not None and len(value.shape) > 0 and value.shape[0] == tasks:
+            return value.repeat_interleave(per_task, dim=0)
+        return value
+
+    return [[repeat(t[0]), {k: repeat(v) for k, v in t[1].items()}] for t in conditioning]
+
+
 # from ComfyUI
 def pillow(fn, arg):
     prev_value = None
@@ -19,6 +19,7 @@ from misc.helpers import async_get, gen_file_sha256, async_head, download_image,
     get_file_created_timestamp_and_datetime, get_file_size_in_kb, sync_get, sync_head, sync_download_image, \
     sync_gen_file_sha256
 from misc.json_cache import JsonCache
+from misc import metrics
 from misc.logger import logger
 from misc.whatsai_dirs import model_info_images_dir
 from data_type.whatsai_model_dir import ModelDir
@@ -486,6 +487,7 @@ def download_model_worker(model_downloading_info: ModelDownloadingInfo, task: Mo
 
             # update record to tell frontend
             if tmp_downloaded_size > size_to_update:
+                metrics.model_download_bytes_total.inc(tmp_downloaded_size)
                 update_downloading_record(
                     model_downloading_info,
                     consumed_downloaded_time,
@@ -499,6 +501,7 @@ def download_model_worker(model_downloading_info: ModelDownloadingInfo, task: Mo
             if task_canceled:
                 logger.debug(f"task canceled {task.id}")
                 return False, None
+        metrics.model_download_bytes_total.inc(tmp_downloaded_size)
 
     # finish downloading
     os.rename(downloading_path, local_path)
@@ -0,0 +1,244 @@
+""" Weight deltas of LoRA stacks fused once and kept on host, so a stack used again patches every weight by one
+    precomputed diff instead of reloading the LoRA files and computing the patches of every LoRA in it.
+    Deltas are computed in batched matmuls on device, see LoraFusion.compute_deltas.
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from contextlib import nullcontext
+
+import torch
+
+import comfy.lora
+import comfy.model_patcher
+from misc import arg_parser
+from misc.logger import logger
+from misc.state_dict_cache import StateDictCache, state_dict_bytes, host_budget_bytes
+
+WEIGHTS_KEY = 'whatsai_weights_key'
+""" Attachment of ModelPatcher, ((base key, lora stack), patches_uuid) telling what weights the patches make. """
+
+DORA_SCALE_INDEX = {'lora': 4, 'lokr': 8, 'loha': 7}
+""" Index of DoRA scale in patches of types adding a diff not depending on the weight, glora multiplies the weight. """
+
+
+def is_additive(patch) -> bool:
+    """ Whether the patch adds a diff not depending on the weight, only such patches can be fused ahead. """
+
+    strength, v, strength_model, offset, function = patch
+    if strength_model != 1.0 or offset is not None or function is not None or isinstance(v, list):
+        return False
+    if len(v) == 1:
+        return True
+
+    patch_type, v = v
+    if patch_type == 'diff':
+        return not (len(v) > 1 and v[1].get('pad_weight'))
+    if patch_type not in DORA_SCALE_INDEX or v[DORA_SCALE_INDEX[patch_type]] is not None:
+        return False
+    return patch_type != 'lora' or v[5] is None  # reshaped lora pads the weight.
+
+
+def is_plain_lora(patch) -> bool:
+    """ A lora patch adding strength * alpha * up @ down, no mid weight, DoRA scale or reshape. """
+
+    strength, v, strength_model, offset, function = patch
+    if strength_model != 1.0 or offset is not None or function is not None or isinstance(v, list) or len(v) != 2:
+        return False
+    patch_type, v = v
+    return patch_type == 'lora' and v[3] is None and v[4] is None and v[5] is None
+
+
+class FusedLora:
+    def __init__(self, deltas: dict[str, torch.Tensor]):
+        self.deltas = deltas
+        """ weight key -> what the whole stack adds to the weight of base model. """
+
+        self.patches_uuid = uuid.uuid4()
+        """ Same for every patcher made of it, so comfy keeps the weights patched on device for the next one. """
+
+        self.size = state_dict_bytes(deltas)
+
+
+class LoraFusion:
+    budget_bytes = host_budget_bytes(arg_parser.lora_fusion_gb, 1 / 8)
+    """ At most how many bytes of fused deltas to keep, least recently used stacks are dropped to fit it. """
+
+    entries: OrderedDict[tuple, FusedLora] = OrderedDict()
+    """ (base key, ((lora file key, strength), ...)) -> deltas of the stack on the base, least recently used first. """
+
+    chunk_bytes = 512 * 1024 ** 2
+    """ Deltas are computed for keys of at most so many fp32 bytes at a time, to bound device memory taken. """
+
+    total_bytes = 0
+    lock = threading.Lock()
+
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def tag(cls, patcher, base_key: tuple):
+        """ Mark a patcher fresh from a loader with what it loads, e.g. file key and dtype, LoRAs on it are fused. """
+        patcher.set_attachments(WEIGHTS_KEY, ((base_key, ()), patcher.patches_uuid))
+
+    @classmethod
+    def weights_key(cls, patcher) -> tuple | None:
+        """ None if the patcher is not tagged, or patched by something else since, e.g. a LoRA not fused. """
+        attachment = patcher.get_attachment(WEIGHTS_KEY)
+        if attachment is None or attachment[1] != patcher.patches_uuid:
+            return None
+        return attachment[0]
+
+    @classmethod
+    def get(cls, base, lora_key: tuple, strength: float):
+        """ Clone of base patched by the fused deltas of its stack plus the lora, None if not fused yet. """
+
+        weights_key = cls.weights_key(base)
+        if weights_key is None or cls.budget_bytes <= 0:
+            return None
+        key = (weights_key[0], weights_key[1] + ((lora_key, strength),))
+
+        with cls.lock:
+            fused = cls.entries.get(key)
+            if fused is None:
+                cls.misses += 1
+                return None
+            cls.entries.move_to_end(key)
+            cls.hits += 1
+        return cls.apply(base, key, fused)
+
+    @classmethod
+    def fuse(cls, base, patched, lora_key: tuple, strength: float):
+        """ Fuse patches of patched, base plus the lora patched by comfy, return a patcher applying the fused deltas,
+            or patched untagged if they can not be fused.
+        """
+
+        weights_key = cls.weights_key(base)
+        additive = all(is_additive(patch) for patches in patched.patches.values() for patch in patches)
+        if weights_key is None or cls.budget_bytes <= 0 or not additive:
+            patched.remove_attachments(WEIGHTS_KEY)
+            return patched
+        key = (weights_key[0], weights_key[1] + ((lora_key, strength),))
+
+        fused = FusedLora(StateDictCache.pin(cls.compute_deltas(patched)))
+        if fused.size <= cls.budget_bytes:
+            with cls.lock:
+                if key in cls.entries:
+                    cls.total_bytes -= cls.entries[key].size
+                cls.entries[key] = fused
+                cls.total_bytes += fused.size
+                while cls.total_bytes > cls.budget_bytes and cls.entries:
+                    _, evicted = cls.entries.popitem(last=False)
+                    cls.total_bytes -= evicted.size
+        return cls.apply(base, key, fused)
+
+    @classmethod
+    def compute_deltas(cls, patched) -> dict[str, torch.Tensor]:
+        """ What all patches of patched add to each weight, patches are additive so the weights are not read.
+            Keys are taken in chunks, plain lora patches of a chunk with the same shapes of up and down are
+            multiplied in one batched matmul on load device. With CUDA, up and down of the next chunk are copied to
+            device on a side stream while the chunk computes. Other patches are computed by comfy key by key.
+        """
+
+        device = torch.device(patched.load_device)
+        copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+        chunks = [[]]
+        chunk_bytes = 0
+        for name in patched.patches:
+            weight = comfy.model_patcher.get_key_weight(patched.model, name)[0]
+            if chunk_bytes >= cls.chunk_bytes:
+                chunks.append([])
+                chunk_bytes = 0
+            chunks[-1].append((name, weight.shape, weight.dtype))
+            chunk_bytes += weight.nelement() * 4
+
+        deltas = {}
+        groups = cls.upload_lora_mats(patched, chunks[0], device, copy_stream)
+        for index, chunk in enumerate(chunks):
+            if copy_stream is not None:
+                torch.cuda.current_stream(device).wait_stream(copy_stream)
+            next_groups = cls.upload_lora_mats(patched, chunks[index + 1], device, copy_stream) \
+                if index + 1 < len(chunks) else None
+            deltas.update(cls.compute_chunk(patched, chunk, groups, device))
+            groups = next_groups
+        return deltas
+
+    @classmethod
+    def upload_lora_mats(cls, patched, chunk: list, device: torch.device, copy_stream):
+        """ (up shape, down shape) -> (weight keys, ups, downs, scales) of plain lora patches of keys in chunk,
+            stacked on host and copied to device, on copy_stream if given.
+        """
+
+        stacks = {}
+        for name, _, _ in chunk:
+            for patch in patched.patches[name]:
+                if not is_plain_lora(patch):
+                    continue
+                strength, (_, v) = patch[0], patch[1]
+                up, down = v[0].flatten(start_dim=1), v[1].flatten(start_dim=1)
+                alpha = v[2] / down.shape[0] if v[2] is not None else 1.0
+                stack = stacks.setdefault((tuple(up.shape), tuple(down.shape)), ([], [], [], []))
+                stack[0].append(name)
+                stack[1].append(up)
+                stack[2].append(down)
+                stack[3].append(strength * alpha)
+
+        groups = {}
+        with torch.cuda.stream(copy_stream) if copy_stream is not None else nullcontext():
+            for shapes, (names, ups, downs, scales) in stacks.items():
+                tensors = [torch.stack(ups), torch.stack(downs), torch.tensor(scales, dtype=torch.float32)]
+                if copy_stream is not None and arg_parser.pin_memory:
+                    tensors = [tensor.pin_memory() for tensor in tensors]
+                groups[shapes] = (names, *[tensor.to(device, non_blocking=True) for tensor in tensors])
+        return groups
+
+    @classmethod
+    def compute_chunk(cls, patched, chunk: list, groups: dict, device: torch.device):
+        stream = torch.cuda.current_stream(device) if device.type == 'cuda' else None
+
+        deltas = {name: torch.zeros(shape, dtype=torch.float32, device=device) for name, shape, _ in chunk}
+        for names, ups, downs, scales in groups.values():
+            if stream is not None:  # they are made on the copy stream, keep their memory until used here.
+                for tensor in (ups, downs, scales):
+                    tensor.record_stream(stream)
+
+            products = torch.bmm(ups.float(), downs.float()) * scales.view(-1, 1, 1)
+            for name, product in zip(names, products):
+                if product.nelement() != deltas[name].nelement():
+                    logger.error(f"LoRA of {name} does not match its weight {tuple(deltas[name].shape)}, skipped.")
+                    continue
+                deltas[name] += product.reshape(deltas[name].shape)
+
+        compact_deltas = {}
+        for name, _, dtype in chunk:
+            others = [patch for patch in patched.patches[name] if not is_plain_lora(patch)]
+            delta = comfy.lora.calculate_weight(others, deltas.pop(name), name) if others else deltas.pop(name)
+            compact_dtype = torch.float16 if dtype in (torch.float16, torch.float32) else torch.bfloat16
+            compact_deltas[name] = delta.to(device='cpu', dtype=compact_dtype)
+        return compact_deltas
+
+    @classmethod
+    def apply(cls, base, key: tuple, fused: FusedLora):
+        patcher = base.clone()
+        patcher.patches = {name: [(1.0, ('diff', (delta,)), 1.0, None, None)] for name, delta in fused.deltas.items()}
+        patcher.patches_uuid = fused.patches_uuid
+        patcher.set_attachments(WEIGHTS_KEY, (key, patcher.patches_uuid))
+        return patcher
+
+    @classmethod
+    def clear_all(cls):
+        with cls.lock:
+            cls.entries.clear()
+            cls.total_bytes = 0
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {
+                'entries': len(cls.entries),
+                'bytes': cls.total_bytes,
+                'budget_bytes': cls.budget_bytes,
+                'hits': cls.hits,
+                'misses': cls.misses,
+            }
@@ -0,0 +1,322 @@
+""" Runtime metrics in Prometheus text format, served at /metrics.
+    Prompt worker processes of a pool dump their snapshots to metrics_dir, the server merges them in with
+    a worker label, see MetricsRegistry.
+"""
+import json
+import math
+import threading
+import time
+from typing import Callable
+
+from misc.whatsai_dirs import metrics_dir
+
+
+def format_labels(labels: dict):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value: float):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type_ = 'untyped'
+
+    def __init__(self, name: str, help_: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_
+        self.label_names = label_names
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+
+        MetricsRegistry.register(self)
+
+    def label_values(self, labels: dict) -> tuple:
+        assert set(labels.keys()) == set(self.label_names), \
+            f"Metric {self.name} takes labels {self.label_names}, got {tuple(labels.keys())}"
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> list[tuple[str, dict, float]]:
+        """ In type of (name, labels, value). """
+        with self.lock:
+            return [
+                (self.name, dict(zip(self.label_names, label_values)), value)
+                for label_values, value in self.values.items()
+            ]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    type_ = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set_total(self, value: float, **labels):
+        """ For counters kept elsewhere, e.g. hits of outputs cache, copy them in by collectors. """
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Gauge(Metric):
+    type_ = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    type_ = 'histogram'
+
+    default_buckets = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+    def __init__(self, name: str, help_: str, label_names: tuple[str, ...] = (), buckets=default_buckets):
+        super().__init__(name, help_, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.))
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for label_values, (counts, total) in self.values.items():
+                labels = dict(zip(self.label_names, label_values))
+                for upper_bound, count in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', {**labels, 'le': format_value(upper_bound)}, count))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, counts[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    metrics: dict[str, Metric] = {}
+
+    collectors: list[Callable] = []
+    """ Called before every snapshot to refresh gauges of state kept elsewhere, e.g. loaded models. """
+
+    snapshot_max_age_seconds = 60
+    """ Snapshots of worker processes older than it are ignored, the worker is likely gone. """
+
+    @classmethod
+    def register(cls, metric: Metric):
+        assert metric.name not in cls.metrics, f"Metric {metric.name} registered already."
+        cls.metrics[metric.name] = metric
+
+    @classmethod
+    def add_collector(cls, collector: Callable):
+        cls.collectors.append(collector)
+
+    @classmethod
+    def snapshot(cls):
+        """ All metrics in type of {name: {'type', 'help', 'samples'}}, can be dumped in json. """
+        for collector in cls.collectors:
+            collector()
+
+        return {
+            name: {'type': metric.type_, 'help': metric.help, 'samples': metric.samples()}
+            for name, metric in cls.metrics.items()
+        }
+
+    @classmethod
+    def dump_snapshot(cls, worker_id: str):
+        """ Used by prompt worker processes to share their metrics with the server process. """
+        path = metrics_dir / f'{worker_id}.json'
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(cls.snapshot()))
+        tmp_path.replace(path)
+
+    @classmethod
+    def load_worker_snapshots(cls):
+        snapshots = {}
+        now = time.time()
+        for path in metrics_dir.glob('*.json'):
+            try:
+                if now - path.stat().st_mtime > cls.snapshot_max_age_seconds:
+                    continue
+                snapshots[path.stem] = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    @classmethod
+    def render(cls):
+        """ Metrics of this process merged with snapshots of worker processes in Prometheus text format. """
+
+        merged = {}
+        snapshots = {None: cls.snapshot(), **cls.load_worker_snapshots()}
+        for worker_id, snapshot in snapshots.items():
+            for name, metric in snapshot.items():
+                merged_metric = merged.setdefault(name, {'type': metric['type'], 'help': metric['help'], 'samples': []})
+                for sample_name, labels, value in metric['samples']:
+                    if worker_id is not None:
+                        labels = {'worker': worker_id, **labels}
+                    merged_metric['samples'].append((sample_name, labels, value))
+
+        lines = []
+        for name, metric in merged.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for sample_name, labels, value in metric['samples']:
+                lines.append(f"{sample_name}{format_labels(labels)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+task_latency_seconds = Histogram(
+    'whatsai_task_latency_seconds',
+    'Seconds from a prompt task put to it ends.',
+    ('card_name', 'status'),
+)
+
+task_run_seconds = Histogram(
+    'whatsai_task_run_seconds',
+    'Seconds a prompt task runs in worker.',
+    ('card_name', 'status'),
+)
+
+tasks_total = Counter(
+    'whatsai_tasks_total',
+    'Prompt tasks ended.',
+    ('card_name', 'status'),
+)
+
+queue_depth = Gauge(
+    'whatsai_queue_depth',
+    'Prompt tasks waiting in queue.',
+    ('priority',),
+)
+
+sampler_steps_total = Counter(
+    'whatsai_sampler_steps_total',
+    'Sampling steps done.',
+    ('card_name',),
+)
+
+sampler_steps_per_second = Gauge(
+    'whatsai_sampler_steps_per_second',
+    'Sampling speed of the last sampling of the card.',
+    ('card_name',),
+)
+
+outputs_cache_requests_total = Counter(
+    'whatsai_outputs_cache_requests_total',
+    'Lookups of prompt worker outputs cache.',
+    ('result',),
+)
+
+outputs_cache_bytes = Gauge(
+    'whatsai_outputs_cache_bytes',
+    'Estimated bytes held by prompt worker outputs cache.',
+)
+
+model_residency_bytes = Gauge(
+    'whatsai_model_residency_bytes',
+    'Bytes of models kept loaded across prompts by model residency.',
+)
+
+model_residency_evictions_total = Counter(
+    'whatsai_model_residency_evictions_total',
+    'Loader outputs dropped by model residency to fit its budget.',
+)
+
+state_dict_cache_requests_total = Counter(
+    'whatsai_state_dict_cache_requests_total',
+    'Loads of model files through the host state dict cache.',
+    ('result',),
+)
+
+state_dict_cache_bytes = Gauge(
+    'whatsai_state_dict_cache_bytes',
+    'Bytes of state dicts of model files kept in host memory.',
+)
+
+cond_cache_requests_total = Counter(
+    'whatsai_cond_cache_requests_total',
+    'Lookups of text encoder outputs cache, result is hit, disk_hit or miss.',
+    ('result',),
+)
+
+cond_cache_bytes = Gauge(
+    'whatsai_cond_cache_bytes',
+    'Bytes of text encoder outputs cached, in memory or on disk.',
+    ('kind',),
+)
+
+token_cache_requests_total = Counter(
+    'whatsai_token_cache_requests_total',
+    'Lookups of memoized prompt tokenization.',
+    ('result',),
+)
+
+cond_batch_plans_total = Counter(
+    'whatsai_cond_batch_plans_total',
+    'Sampling steps by cond batch plan, result is planned or reused.',
+    ('result',),
+)
+
+cfg_uncond_predictions_total = Counter(
+    'whatsai_cfg_uncond_predictions_total',
+    'Uncond predictions of sampling steps by CFG mode, result is computed, reused or skipped.',
+    ('result',),
+)
+
+lora_fusion_requests_total = Counter(
+    'whatsai_lora_fusion_requests_total',
+    'Lookups of fused LoRA stacks.',
+    ('result',),
+)
+
+lora_fusion_bytes = Gauge(
+    'whatsai_lora_fusion_bytes',
+    'Bytes of fused LoRA weight deltas kept in host memory.',
+)
+
+model_prefetch_bytes_total = Counter(
+    'whatsai_model_prefetch_bytes_total',
+    'Bytes of model files read ahead for queued tasks.',
+)
+
+loaded_model_bytes = Gauge(
+    'whatsai_loaded_model_bytes',
+    'Bytes of models loaded by comfy model management, loaded is on device, total is the full model.',
+    ('model', 'device', 'kind'),
+)
+
+device_memory_bytes = Gauge(
+    'whatsai_device_memory_bytes',
+    'Memory of torch device.',
+    ('device', 'kind'),
+)
+
+ram_bytes = Gauge(
+    'whatsai_ram_bytes',
+    'Memory of the host.',
+    ('kind',),
+)
+
+model_download_bytes_total = Counter(
+    'whatsai_model_download_bytes_total',
+    'Bytes of model files downloaded.',
+)
@@ -0,0 +1,104 @@
+""" Read model files of queued tasks ahead while the current task runs, so their loaders read from page cache
+    instead of waiting on disk.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Callable
+
+import psutil
+
+from data_type.whatsai_model_info import ModelInfo
+from misc import arg_parser
+from misc import metrics
+from misc.logger import logger
+
+
+class ModelPrefetcher:
+    window = arg_parser.prefetch_window
+    """ How many queued tasks to look ahead. """
+
+    budget_bytes = int(arg_parser.prefetch_gb * 1024 ** 3) if arg_parser.prefetch_gb is not None \
+        else psutil.virtual_memory().available // 4
+    """ At most how many bytes of files to read ahead for the tasks in window, files of later tasks are left. """
+
+    interval = 1.
+    """ Seconds between looks at the queue. """
+
+    refresh_seconds = 300.
+    """ A file read ahead is read again after it, the page cache may have dropped it. """
+
+    chunk_bytes = 16 * 1024 ** 2
+
+    prefetched: OrderedDict[str, tuple[float, int, float]] = OrderedDict()
+    """ path -> (mtime, size, time.monotonic when read) of files read ahead, least recently first. """
+
+    @classmethod
+    def run(cls, upcoming_model_keys: Callable[[int], list[frozenset[str]]]):
+        """ upcoming_model_keys(count) gives model ids of the next count tasks in queue, see TaskQueue. """
+        logger.debug("ModelPrefetcher start to run.")
+
+        while True:
+            try:
+                cls.prefetch(upcoming_model_keys(cls.window))
+            except Exception as e:
+                logger.error(f"Prefetch models failed: {e}")
+            time.sleep(cls.interval)
+
+    @classmethod
+    def resolve_paths(cls, model_keys: list[frozenset[str]]) -> list[str]:
+        """ Local paths of model ids, in the order of tasks. """
+        paths = []
+        for model_key in model_keys:
+            for model_id in sorted(model_key):
+                model_info = ModelInfo.get(model_id)
+                if model_info and model_info.local_path and model_info.local_path not in paths:
+                    paths.append(model_info.local_path)
+        return paths
+
+    @classmethod
+    def prefetch(cls, model_keys: list[frozenset[str]]):
+        planned_bytes = 0
+        for path in cls.resolve_paths(model_keys):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            planned_bytes += stat.st_size
+            if planned_bytes > cls.budget_bytes:
+                break
+
+            prefetched = cls.prefetched.get(path)
+            if prefetched and prefetched[:2] == (stat.st_mtime, stat.st_size) \
+                    and time.monotonic() - prefetched[2] < cls.refresh_seconds:
+                cls.prefetched.move_to_end(path)
+                continue
+
+            start_time = time.monotonic()
+            read_bytes = cls.read_into_page_cache(path, stat.st_size)
+            metrics.model_prefetch_bytes_total.inc(read_bytes)
+            logger.debug(f"Prefetched {path} {read_bytes} bytes in {time.monotonic() - start_time:.2f}s")
+
+            cls.prefetched[path] = (stat.st_mtime, stat.st_size, time.monotonic())
+            cls.prefetched.move_to_end(path)
+            while len(cls.prefetched) > max(cls.window, 1) * 8:
+                cls.prefetched.popitem(last=False)
+
+    @classmethod
+    def read_into_page_cache(cls, path: str, size: int) -> int:
+        """ Ask the kernel to read the file ahead if it can, or read it through, return bytes asked or read. """
+
+        with open(path, 'rb', buffering=0) as f:
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                return size
+
+            read_bytes = 0
+            buffer = bytearray(cls.chunk_bytes)
+            while True:
+                count = f.readinto(buffer)
+                if not count:
+                    break
+                read_bytes += count
+            return read_bytes
@@ -0,0 +1,206 @@
+""" State dicts of model files kept in host memory after loading, so a model loaded again, e.g. swapping back to
+    a checkpoint used a few tasks ago, skips reading and parsing its file. Tensors are in pinned memory with
+    --pin-memory when CUDA is available, so copying them to device is a DMA copy.
+    Safetensors files are mapped into memory instead, see LazyStateDict.
+"""
+import json
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import psutil
+import torch
+
+import comfy.utils
+from misc import arg_parser
+from misc.logger import logger
+
+
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64, 'F32': torch.float32, 'F16': torch.float16, 'BF16': torch.bfloat16,
+    'I64': torch.int64, 'I32': torch.int32, 'I16': torch.int16, 'I8': torch.int8, 'U8': torch.uint8,
+    'BOOL': torch.bool,
+    'F8_E4M3': getattr(torch, 'float8_e4m3fn', None), 'F8_E5M2': getattr(torch, 'float8_e5m2', None),
+}
+
+
+def host_budget_bytes(budget_gb: float | None, share: float) -> int:
+    """ Budget of a host memory cache, budget_gb if it's set, or its share of host_cache_gb, so the caches together
+        take no more than it.
+    """
+    if budget_gb is not None:
+        return int(budget_gb * 1024 ** 3)
+
+    total = arg_parser.host_cache_gb * 1024 ** 3 if arg_parser.host_cache_gb is not None \
+        else psutil.virtual_memory().total / 2
+    return int(total * share)
+
+
+def state_dict_bytes(sd: dict) -> int:
+    return sum(value.nelement() * value.element_size() for value in sd.values() if isinstance(value, torch.Tensor))
+
+
+def file_key(path: str) -> tuple[str, float, int]:
+    """ Tells a file from others and from itself changed. """
+    stat = os.stat(path)
+    return os.path.realpath(path), stat.st_mtime, stat.st_size
+
+
+def is_safetensors(path: str):
+    return path.lower().endswith(('.safetensors', '.sft'))
+
+
+class LazyStateDict(Mapping):
+    """ State dict of a safetensors file mapped into memory, only the header is parsed when opened.
+        A tensor is a view of the mapped file made when its key is looked up, its data is read from page cache
+        when touched, e.g. copied into model parameters in the dtype and device of them, so the file is never
+        materialized in full. Pages are shared by processes mapping the same file, written pages are copied.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+        header_bytes = comfy.utils.safetensors_header(path)
+        if header_bytes is None:
+            raise ValueError(f"Header of {path} is too large.")
+
+        header = json.loads(header_bytes)
+        self.metadata: dict[str, str] = header.pop('__metadata__', None) or {}
+        """ __metadata__ of the file, the str -> str dict saved with tensors. """
+
+        self._data_start = 8 + len(header_bytes)
+        self._specs: dict[str, tuple[torch.dtype, list[int], int, int]] = {}
+        """ key -> (dtype, shape, begin, end), offsets are of the file. """
+
+        for key, info in header.items():
+            dtype = SAFETENSORS_DTYPES.get(info['dtype'])
+            if dtype is None:
+                raise ValueError(f"Dtype {info['dtype']} of {key} in {path} is not supported.")
+            begin, end = info['data_offsets']
+            self._specs[key] = (dtype, info['shape'], self._data_start + begin, self._data_start + end)
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def __getitem__(self, key: str) -> torch.Tensor:
+        dtype, shape, begin, end = self._specs[key]
+        if begin == end:
+            return torch.empty(shape, dtype=dtype)
+
+        element_size = torch.empty((), dtype=dtype).element_size()
+        if begin % element_size:  # a view must be aligned to its dtype, copy the bytes out.
+            return torch.frombuffer(bytearray(self._mmap[begin:end]), dtype=dtype).reshape(shape)
+        return torch.frombuffer(self._mmap, dtype=dtype, count=(end - begin) // element_size,
+                                offset=begin).reshape(shape)
+
+    def __iter__(self):
+        return iter(self._specs)
+
+    def __len__(self):
+        return len(self._specs)
+
+    def __contains__(self, key):
+        return key in self._specs
+
+
+class StateDictCache:
+    budget_bytes = host_budget_bytes(arg_parser.state_dict_cache_gb, 1 / 8)
+    """ At most how many bytes of state dicts to keep, least recently used ones are dropped to fit it. """
+
+    max_entries = 64
+    """ Lazy state dicts take no budget but hold their file mapped, so the number of entries is limited too. """
+
+    entries: OrderedDict[tuple[str, float, int], dict | LazyStateDict] = OrderedDict()
+    """ (real path, mtime, size) of file -> its state dict, least recently used first. """
+
+    entry_bytes: dict[tuple[str, float, int], int] = {}
+    total_bytes = 0
+    lock = threading.Lock()
+
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def load_torch_file(cls, path: str, safe_load=False) -> dict:
+        """ Same as comfy.utils.load_torch_file but takes the state dict cached if the file is not changed.
+            Returns a shallow copy, comfy pops keys of state dicts while loading them, tensors are shared and
+            only read, models copy them into their own parameters.
+        """
+
+        lazy = arg_parser.lazy_safetensors and is_safetensors(path)
+        if cls.budget_bytes <= 0 and not lazy:
+            return comfy.utils.load_torch_file(path, safe_load=safe_load)
+
+        key = file_key(path)
+
+        with cls.lock:
+            sd = cls.entries.get(key)
+            if sd is not None:
+                cls.entries.move_to_end(key)
+                cls.hits += 1
+                return dict(sd)
+            cls.misses += 1
+
+        sd = None
+        if lazy:
+            try:
+                sd = LazyStateDict(path)
+                size = 0  # its data is in page cache, not held by the process.
+            except ValueError as e:  # e.g. U32 or F8 dtypes unmapped here, or a header too large to parse.
+                logger.warning(f"{e} It is loaded in full.")
+        if sd is None:
+            sd = comfy.utils.load_torch_file(path, safe_load=safe_load)
+            size = state_dict_bytes(sd)
+            if size > cls.budget_bytes:
+                return sd
+            sd = cls.pin(sd)
+
+        with cls.lock:
+            if key not in cls.entries:
+                cls.entries[key] = sd
+                cls.entry_bytes[key] = size
+                cls.total_bytes += size
+            cls.entries.move_to_end(key)
+            cls.evict()
+        return dict(sd)
+
+    @classmethod
+    def pin(cls, sd: dict) -> dict:
+        if not arg_parser.pin_memory or not torch.cuda.is_available():
+            return sd
+
+        try:
+            return {
+                name: value.pin_memory() if isinstance(value, torch.Tensor) and value.device.type == 'cpu' else value
+                for name, value in sd.items()
+            }
+        except RuntimeError as e:  # e.g. pinned memory is limited by the system.
+            logger.warning(f"Pin state dict failed, keep it in pageable memory: {e}")
+            return sd
+
+    @classmethod
+    def evict(cls):
+        """ Call it with lock held. """
+        while (cls.total_bytes > cls.budget_bytes or len(cls.entries) > cls.max_entries) and cls.entries:
+            key, _ = cls.entries.popitem(last=False)
+            cls.total_bytes -= cls.entry_bytes.pop(key)
+
+    @classmethod
+    def clear_all(cls):
+        with cls.lock:
+            cls.entries.clear()
+            cls.entry_bytes.clear()
+            cls.total_bytes = 0
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {
+                'entries': len(cls.entries),
+                'bytes': cls.total_bytes,
+                'budget_bytes': cls.budget_bytes,
+                'hits': cls.hits,
+                'misses': cls.misses,
+            }
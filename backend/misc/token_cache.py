@@ -0,0 +1,250 @@
+""" Tokenization of prompts memoized per tokenizer, comfy SDTokenizer parses weights, looks up embeddings from disk
+    and runs the HF tokenizer word by word on every call. Words of many prompts can be tokenized in one HF tokenizer
+    call ahead, see TokenCache.prefetch.
+"""
+import copy
+import os
+import re
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import comfy.sd1_clip
+from comfy.sd1_clip import SDTokenizer, escape_important, unescape_important, token_weights
+
+
+class WordTokenizer:
+    """ In place of the HF tokenizer of a SDTokenizer in copies of it, memoizes ids of words it is called with,
+        see TokenCache.detached.
+    """
+
+    max_words = 65536
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.ids: OrderedDict[str, list[int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __call__(self, word: str):
+        with self.lock:
+            ids = self.ids.get(word)
+            if ids is not None:
+                self.ids.move_to_end(word)
+                return {"input_ids": ids}
+
+        ids = list(self.tokenizer(word)["input_ids"])
+        self.remember({word: ids})
+        return {"input_ids": ids}
+
+    def prefetch(self, words: list[str]):
+        """ Tokenize words not seen yet in one call, tokenizers not taking a list are left to tokenize them later. """
+
+        with self.lock:
+            missing = list(dict.fromkeys(word for word in words if word not in self.ids))
+        if not missing:
+            return
+
+        try:
+            batch = self.tokenizer(missing)["input_ids"]
+        except Exception:
+            return
+        if len(batch) == len(missing) and all(isinstance(ids, list) for ids in batch):
+            self.remember(dict(zip(missing, batch)))
+
+    def remember(self, ids_of_words: dict[str, list[int]]):
+        with self.lock:
+            self.ids.update(ids_of_words)
+            for word in ids_of_words:
+                self.ids.move_to_end(word)
+            while len(self.ids) > self.max_words:
+                self.ids.popitem(last=False)
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+class EmbeddingIndex:
+    """ comfy load_embed memoized, it searches embedding dirs and loads the file on every embedding in prompts.
+        What is loaded is dropped when files are added, removed or renamed in the dirs, and the version changes.
+    """
+
+    refresh_seconds = 5.
+    """ Dirs are checked for changes at most once in it. """
+
+    version = 0
+
+    max_embeds = 256
+    """ Embeddings loaded are kept, least recently used are dropped. """
+
+    embeds: OrderedDict[tuple, object] = OrderedDict()
+    dir_mtimes: dict[tuple, dict[str, float]] = {}
+    checked_time: dict[tuple, float] = {}
+    lock = threading.Lock()
+
+    original_load_embed = staticmethod(comfy.sd1_clip.load_embed)
+
+    @classmethod
+    def install(cls):
+        """ Put load_embed in place of the comfy one, SDTokenizer looks up embeddings by it, called at startup. """
+        comfy.sd1_clip.load_embed = cls.load_embed
+
+    @classmethod
+    def dirs_of(cls, embedding_directory) -> tuple[str, ...]:
+        if isinstance(embedding_directory, (str, os.PathLike)):
+            embedding_directory = [embedding_directory]
+        return tuple(str(directory) for directory in embedding_directory)
+
+    @classmethod
+    def load_embed(cls, embedding_name, embedding_directory, embedding_size, embed_key=None):
+        dirs = cls.dirs_of(embedding_directory)
+        cls.refresh(dirs)
+
+        key = (embedding_name, dirs, embedding_size, embed_key)
+        with cls.lock:
+            if key in cls.embeds:
+                cls.embeds.move_to_end(key)
+                return cls.embeds[key]
+
+        embed = cls.original_load_embed(embedding_name, list(dirs), embedding_size, embed_key)
+        with cls.lock:
+            cls.embeds[key] = embed
+            while len(cls.embeds) > cls.max_embeds:
+                cls.embeds.popitem(last=False)
+        return embed
+
+    @classmethod
+    def refresh(cls, dirs: tuple[str, ...]):
+        if time.monotonic() - cls.checked_time.get(dirs, -cls.refresh_seconds) < cls.refresh_seconds:
+            return
+
+        mtimes = {}
+        for directory in comfy.sd1_clip.expand_directory_list(list(dirs)):
+            try:
+                mtimes[directory] = os.stat(directory).st_mtime
+            except OSError:
+                continue
+
+        with cls.lock:
+            cls.checked_time[dirs] = time.monotonic()
+            if cls.dir_mtimes.get(dirs) != mtimes:
+                if dirs in cls.dir_mtimes:
+                    cls.embeds = OrderedDict((key, embed) for key, embed in cls.embeds.items() if key[1] != dirs)
+                    cls.version += 1
+                cls.dir_mtimes[dirs] = mtimes
+
+
+class TokenCache:
+    max_prompts = 1024
+    """ Prompts memoized per tokenizer, least recently used are dropped. """
+
+    memos: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+    """ tokenizer of CLIP -> {(text, return_word_ids, embedding version): tokens}, clones of a CLIP share it. """
+
+    word_tokenizers: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+    """ SDTokenizer -> WordTokenizer of its HF tokenizer, kept here so the SDTokenizer shared by clones of a CLIP
+        is not changed.
+    """
+
+    lock = threading.Lock()
+
+    hits = 0
+    misses = 0
+
+    @classmethod
+    def memo_key(cls, sd_tokenizers: list[SDTokenizer], text: str, return_word_ids: bool):
+        """ Tokens of text with embeddings are memoized until files in embedding dirs change. """
+
+        has_embedding = False
+        for sd_tokenizer in sd_tokenizers:
+            if sd_tokenizer.embedding_identifier in text and sd_tokenizer.embedding_directory is not None:
+                EmbeddingIndex.refresh(EmbeddingIndex.dirs_of(sd_tokenizer.embedding_directory))
+                has_embedding = True
+        return text, return_word_ids, EmbeddingIndex.version if has_embedding else None
+
+    @classmethod
+    def tokenize(cls, clip, text: str, return_word_ids=False):
+        """ Same as clip.tokenize, tokens returned are a copy, lists of them can be changed. """
+
+        tokenizer = clip.tokenizer
+        key = cls.memo_key(cls.sd_tokenizers(tokenizer), text, return_word_ids)
+        with cls.lock:
+            memo = cls.memos.setdefault(tokenizer, OrderedDict())
+            tokens = memo.get(key)
+            if tokens is not None:
+                memo.move_to_end(key)
+                cls.hits += 1
+            else:
+                cls.misses += 1
+
+        if tokens is None:
+            tokens = cls.detached(tokenizer).tokenize_with_weights(text, return_word_ids)
+            with cls.lock:
+                memo[key] = tokens
+                while len(memo) > cls.max_prompts:
+                    memo.popitem(last=False)
+
+        return {name: [list(batch) for batch in batches] for name, batches in tokens.items()}
+
+    @classmethod
+    def prefetch(cls, clip, texts: list[str]):
+        """ Tokenize words of prompts not memoized in one HF tokenizer call per tokenizer, before tokenizing them
+            one by one, e.g. prompts of a batch.
+        """
+
+        tokenizer = clip.tokenizer
+        sd_tokenizers = cls.sd_tokenizers(tokenizer)
+        with cls.lock:
+            memo = cls.memos.get(tokenizer, {})
+            texts = [text for text in dict.fromkeys(texts) if cls.memo_key(sd_tokenizers, text, False) not in memo]
+
+        for sd_tokenizer in sd_tokenizers:
+            words = [word for text in texts for word in cls.split_words(sd_tokenizer, text)]
+            cls.word_tokenizer(sd_tokenizer).prefetch(words)
+
+    @classmethod
+    def sd_tokenizers(cls, tokenizer) -> list[SDTokenizer]:
+        """ SDTokenizer of each text encoder of the tokenizer. """
+        return [value for value in vars(tokenizer).values() if isinstance(value, SDTokenizer)]
+
+    @classmethod
+    def word_tokenizer(cls, sd_tokenizer: SDTokenizer) -> WordTokenizer:
+        with cls.lock:
+            word_tokenizer = cls.word_tokenizers.get(sd_tokenizer)
+            if word_tokenizer is None:
+                word_tokenizer = cls.word_tokenizers[sd_tokenizer] = WordTokenizer(sd_tokenizer.tokenizer)
+            return word_tokenizer
+
+    @classmethod
+    def detached(cls, tokenizer):
+        """ Shallow copy of the tokenizer for one call, its SDTokenizers are copies with WordTokenizer in place of
+            their HF tokenizers.
+        """
+
+        tokenizer_copy = copy.copy(tokenizer)
+        for name, value in vars(tokenizer).items():
+            if isinstance(value, SDTokenizer):
+                sd_tokenizer_copy = copy.copy(value)
+                sd_tokenizer_copy.tokenizer = cls.word_tokenizer(value)
+                setattr(tokenizer_copy, name, sd_tokenizer_copy)
+        return tokenizer_copy
+
+    @classmethod
+    def split_words(cls, sd_tokenizer: SDTokenizer, text: str) -> list[str]:
+        """ Words SDTokenizer.tokenize_with_weights passes to its HF tokenizer, embeddings and text left over after
+            them are left out, they are tokenized when the prompt is.
+        """
+
+        words = []
+        identifier = sd_tokenizer.embedding_identifier
+        for segment, _ in token_weights(escape_important(text), 1.0):
+            split = re.split(' {0}|\n{0}'.format(identifier), unescape_important(segment))
+            words.extend(word for word in split[:1] if word != "")
+            if sd_tokenizer.embedding_directory is None:
+                words.extend(f"{identifier}{word}" for word in split[1:])
+        return words
+
+    @classmethod
+    def stats(cls):
+        with cls.lock:
+            return {'hits': cls.hits, 'misses': cls.misses}
@@ -12,6 +12,9 @@ sqlite_dir = base_dir / '_db'
 model_info_images_dir = base_dir / 'files' / 'model_info_images'
 media_files_dir = base_dir / 'files' / 'media_files'
 cache_dir = base_dir / '_whatsai_cache'
+sampling_checkpoint_dir = cache_dir / 'sampling_checkpoints'
+metrics_dir = cache_dir / 'metrics'
+cond_cache_dir = cache_dir / 'conds'
 model_base_dir_name = base_dir / 'models'
 
 output_dir = base_dir / 'output'
@@ -26,6 +29,9 @@ file_dirs_to_init = [
     media_files_dir,
     model_base_dir_name,
     cache_dir,
+    sampling_checkpoint_dir,
+    metrics_dir,
+    cond_cache_dir,
     img_dir,
     video_dir,
     audio_dir,
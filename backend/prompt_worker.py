@@ -1,18 +1,46 @@
+import hashlib
+import json
+import os
+import socket
 import threading
+import time
 import traceback
-
+from collections import Counter, OrderedDict, deque
+from itertools import islice
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import psutil
+import safetensors.torch
 import torch
 
 import comfy.model_management
-from core.abstracts import Addon, Comp
-from core.abstracts.cache import OutputsCache
-from core.abstracts.func import Func, FuncInput
+from core.abstracts import Addon
+from core.abstracts.cache import OutputsCache, ContentOutputsCache, ModelResidency
+from core.abstracts.func import Func, BatchedInputs, unbatch_if_uniform
 from core.abstracts.card import Card
+from core.abstracts.card_plan import CardPlan, CardPlans, PlannedFunc
+from core.funcs import SamplingCheckpoint, SamplingPreempted
+from data_type.whatsai_artwork import Artwork
 from data_type.whatsai_card import CardDataModel, Prompt
+from misc import arg_parser
 from misc.helpers import get_now_timestamp_and_str
 from data_type.whatsai_task import Task
-from data_type.whatsai_task import TaskStatus
+from data_type.whatsai_task import TaskStatus, TaskPriority
+from data_type.whatsai_task_profile import FuncProfile, TaskProfile
+from misc.func_profiler import profile_func, cached_func_profile
+from misc.model_prefetcher import ModelPrefetcher
+from misc.cfg_options import CfgOptions
+from misc.cond_batch_planner import CondBatchPlanner
+from misc.cond_cache import CondCache
+from misc.lora_fusion import LoraFusion
+from misc.state_dict_cache import StateDictCache, host_budget_bytes
+from misc.token_cache import EmbeddingIndex, TokenCache
+from misc import metrics
+from misc.metrics import MetricsRegistry
 from misc.logger import logger
+from misc.whatsai_dirs import sampling_checkpoint_dir
 
 
 # frontend uses loop instead of socket, so it's not import here, maybe socket is a better way though.
@@ -28,17 +56,78 @@ class EventTypes:
     UNENCODED_PREVIEW_IMAGE = 12
 
 
+def higher_priorities(priority: str) -> list[str]:
+    priorities = [priority_.value for priority_ in TaskPriority]
+    return priorities[:priorities.index(TaskPriority(priority).value)]
+
+
+class QueueEntry:
+    """ A task waiting in TaskQueue, taken is set when it leaves the queue by get or cancel, then it is dropped
+        lazily from the client's deque, that's how cancellation is O(1).
+    """
+
+    __slots__ = (
+        'task_id', 'task_dict', 'client_id', 'card_name', 'priority', 'enqueued_at', 'taken', 'skipped', 'model_key'
+    )
+
+    def __init__(self, task: Task):
+        self.task_id = task.id
+        self.task_dict = task.model_dump()
+        self.client_id = task.client_id
+        self.card_name = task.card_name
+        self.priority = task.priority
+        self.enqueued_at = time.monotonic()
+        self.taken = False
+        self.skipped = 0
+        self.model_key: frozenset[str] | None = None
+
+
 class TaskQueue:
     """ Used to put prompt by frontend, get by prompt worker to generate.
         Mostly from ComfyUI, thanks.
+
+        Tasks of higher priority class always go first, inside one class clients take turns (round-robin),
+        so a client putting hundreds of tasks can't starve others, a client with max_in_flight tasks processing
+        is skipped until one of them is done.
     """
 
     mutex = threading.RLock()
     not_empty = threading.Condition(mutex)
-    queue = []
+
+    queues: dict[str, OrderedDict[str, deque[QueueEntry]]] = {
+        priority.value: OrderedDict() for priority in TaskPriority
+    }
+    """ priority -> client_id -> entries of the client in put order, the order of clients is the round-robin order. """
+
+    waiting: dict[str, OrderedDict[int, QueueEntry]] = {priority.value: OrderedDict() for priority in TaskPriority}
+    """ priority -> task_id -> entry of every task of the priority waiting, in put order. """
+
+    waiting_of_clients: Counter = Counter()
+    """ client_id -> count of tasks of the client waiting. """
+
+    in_flight: Counter = Counter()
+    """ client_id -> count of tasks got but not done yet. """
+
+    max_in_flight = arg_parser.max_tasks_per_client
+    """ Max tasks one client can have in processing, 0 means no limit. """
+
+    wait_times: deque[float] = deque(maxlen=1000)
+    """ Seconds waited in queue of recently got tasks. """
+
+    affinity_window = arg_parser.model_affinity_window
+    """ How many queued tasks to look ahead for one using the models loaded now, 0 or 1 turns it off. """
+
+    affinity_max_skips = arg_parser.model_affinity_max_skips
+    """ How many times a task can be passed over for model affinity before it must go, so it won't starve. """
+
+    current_model_key: frozenset[str] | None = None
+    """ Model files of the task got last, which are likely loaded now. """
+
+    affinity_picks = 0
+    """ How many times a task ran early for model affinity. """
 
     @classmethod
-    def put(cls, card_name: str, prompt: Prompt, client_id: str):
+    def put(cls, card_name: str, prompt: Prompt, client_id: str, priority: str = TaskPriority.normal.value):
         with cls.mutex:
             created_time_stamp, created_datetime_str = get_now_timestamp_and_str()
             task = Task(
@@ -47,30 +136,393 @@ class TaskQueue:
                 card_name=card_name,
                 prompt=prompt,
                 created_time_stamp=created_time_stamp,
-                created_datetime_str=created_datetime_str
+                created_datetime_str=created_datetime_str,
+                field0=TaskPriority(priority).value
             )
             task.save()
-            task_dict = task.model_dump()
-            cls.queue.append(task_dict)
-            cls.not_empty.notify()
+            cls.put_task(task)
+            return task
 
     @classmethod
     def put_task(cls, task: Task):
         with cls.mutex:
-            task_dict = task.model_dump()
-            cls.queue.append(task_dict)
+            entry = QueueEntry(task)
+            cls.waiting[entry.priority][entry.task_id] = entry
+            cls.waiting_of_clients[entry.client_id] += 1
+
+            clients = cls.queues[entry.priority]
+            if entry.client_id not in clients:
+                clients[entry.client_id] = deque()
+            clients[entry.client_id].append(entry)
+
             cls.not_empty.notify()
 
+    @classmethod
+    def recover(cls):
+        """ Put undone tasks back to queue when the worker starts, the processing ones were interrupted by restart
+            or crash, they run again and reuse artworks they saved, see PromptWorker.finish_tasks_with_saved_artworks.
+        """
+        undone_tasks = Task.get_undone_tasks()
+        for task in undone_tasks:
+            if task.status != TaskStatus.queued.value:
+                task.status = TaskStatus.queued.value
+                task.save()
+            cls.put_task(task)
+        logger.info(f"Recover prompt tasks {len(undone_tasks)}")
+
     @classmethod
     def get(cls, timeout=1):
         with cls.not_empty:
-            while len(cls.queue) == 0:
+            entry = cls._pop_next()
+            if entry is None:
                 cls.not_empty.wait(timeout=timeout)
-                if len(cls.queue) == 0:
+                entry = cls._pop_next()
+                if entry is None:
                     return None
-            task_dict = cls.queue.pop(0)
-            task = Task(**task_dict)
-            return task
+            return Task(**entry.task_dict)
+
+    @classmethod
+    def _pop_next(cls) -> QueueEntry | None:
+        entry = cls._peek_next()
+        if entry is None:
+            return None
+
+        entry = cls._pick_by_model_affinity(entry)
+        cls.current_model_key = cls.model_key_of(entry)
+        cls._take(entry)
+        return entry
+
+    @classmethod
+    def _peek_next(cls) -> QueueEntry | None:
+        """ The entry to go next by priority and client turns. """
+        for priority in TaskPriority:
+            clients = cls.queues[priority.value]
+            for client_id in list(clients.keys()):
+                entries = clients[client_id]
+                while entries and entries[0].taken:
+                    entries.popleft()
+
+                if not entries:
+                    del clients[client_id]
+                    continue
+
+                if cls._is_client_full(client_id):
+                    continue
+
+                return entries[0]
+        return None
+
+    @classmethod
+    def _pick_by_model_affinity(cls, entry: QueueEntry) -> QueueEntry:
+        """ Look ahead in the queue for a task of the same priority using the models loaded now, run it before
+            the entry to save a model swap, unless the entry has been passed over affinity_max_skips times.
+        """
+        if cls.affinity_window <= 1 or not cls.current_model_key:
+            return entry
+        if entry.skipped >= cls.affinity_max_skips or cls.model_key_of(entry) == cls.current_model_key:
+            return entry
+
+        for other in islice(cls.waiting[entry.priority].values(), cls.affinity_window):
+            if cls._is_client_full(other.client_id):
+                continue
+            if cls.model_key_of(other) == cls.current_model_key:
+                entry.skipped += 1
+                cls.affinity_picks += 1
+                return other
+        return entry
+
+    @classmethod
+    def model_key_of(cls, entry: QueueEntry) -> frozenset[str]:
+        if entry.model_key is None:
+            entry.model_key = PromptWorker.get_model_key(entry.card_name, entry.task_dict.get('prompt') or {})
+        return entry.model_key
+
+    @classmethod
+    def _is_client_full(cls, client_id: str):
+        return 0 < cls.max_in_flight <= cls.in_flight[client_id]
+
+    @classmethod
+    def _take(cls, entry: QueueEntry):
+        cls._leave(entry)
+
+        clients = cls.queues[entry.priority]
+        entries = clients.get(entry.client_id)
+        if entries is not None:
+            while entries and entries[0].taken:
+                entries.popleft()
+            if entries:
+                clients.move_to_end(entry.client_id)
+            else:
+                del clients[entry.client_id]
+
+        cls.in_flight[entry.client_id] += 1
+        cls.wait_times.append(time.monotonic() - entry.enqueued_at)
+
+    @classmethod
+    def _leave(cls, entry: QueueEntry):
+        """ Mark the entry taken and drop it from the waiting counts, the client's deque drops it lazily. """
+        entry.taken = True
+        if cls.waiting[entry.priority].pop(entry.task_id, None) is None:
+            return
+        cls.waiting_of_clients[entry.client_id] -= 1
+        if cls.waiting_of_clients[entry.client_id] <= 0:
+            del cls.waiting_of_clients[entry.client_id]
+
+    @classmethod
+    def get_batchable(cls, task: Task, max_count: int, can_join_batch) -> list[Task]:
+        """ Take queued tasks which can run as one batch with the task out of the queue, in queue order,
+            can_join_batch(batch, other_task) decides it.
+        """
+        batch = []
+        if max_count <= 0:
+            return batch
+
+        with cls.mutex:
+            for entry in [entry for entries in cls.waiting.values() for entry in entries.values()]:
+                if len(batch) >= max_count:
+                    break
+                if entry.card_name != task.card_name or cls._is_client_full(entry.client_id):
+                    continue
+
+                other_task = Task(**entry.task_dict)
+                if can_join_batch([task, *batch], other_task):
+                    cls._take(entry)
+                    batch.append(other_task)
+
+        return batch
+
+    @classmethod
+    def task_done(cls, task: Task):
+        """ Tell the queue a task got is finished, failed or canceled, so its client can get more. """
+        with cls.mutex:
+            cls.in_flight[task.client_id] -= 1
+            if cls.in_flight[task.client_id] <= 0:
+                del cls.in_flight[task.client_id]
+            cls.not_empty.notify()
+
+    @classmethod
+    def has_waiting_above(cls, priority: str) -> bool:
+        """ If any task of higher priority than the given is waiting. """
+        with cls.mutex:
+            return any(cls.waiting[priority_] for priority_ in higher_priorities(priority))
+
+    @classmethod
+    def cancel(cls, task_id: int) -> bool:
+        """ Take a waiting task out of the queue, return False if it is not waiting. """
+        with cls.mutex:
+            for entries in cls.waiting.values():
+                entry = entries.get(task_id)
+                if entry is not None:
+                    cls._leave(entry)
+                    return True
+            return False
+
+    @classmethod
+    def upcoming_model_keys(cls, count: int) -> list[frozenset[str]]:
+        """ Model files of the next count tasks waiting, by priority then put order, used to prefetch models. """
+        upcoming = []
+        with cls.mutex:
+            for entries in cls.waiting.values():
+                upcoming.extend(islice(entries.values(), max(count - len(upcoming), 0)))
+        return [cls.model_key_of(entry) for entry in upcoming]
+
+    @classmethod
+    def stats(cls):
+        """ Queue depth and wait time, used to size the worker pool. """
+        with cls.mutex:
+            now = time.monotonic()
+            # entries of a priority are in put order, so the first is the oldest.
+            oldest_wait = max((now - next(iter(entries.values())).enqueued_at
+                               for entries in cls.waiting.values() if entries), default=0)
+
+            wait_times = sorted(cls.wait_times)
+            return {
+                'depth': sum(len(entries) for entries in cls.waiting.values()),
+                'depth_of_priorities': {priority: len(entries) for priority, entries in cls.waiting.items()},
+                'depth_of_clients': dict(cls.waiting_of_clients),
+                'in_flight_of_clients': dict(cls.in_flight),
+                'oldest_wait_seconds': oldest_wait,
+                'current_models': sorted(cls.current_model_key or ()),
+                'affinity_picks': cls.affinity_picks,
+                'wait_seconds': {
+                    'count': len(wait_times),
+                    'avg': sum(wait_times) / len(wait_times) if wait_times else 0,
+                    'p50': wait_times[len(wait_times) // 2] if wait_times else 0,
+                    'p95': wait_times[int(len(wait_times) * 0.95)] if wait_times else 0,
+                    'max': wait_times[-1] if wait_times else 0,
+                }
+            }
+
+
+class SharedTaskQueue(TaskQueue):
+    """ TaskQueue backed by prompt_task table, shared by the server process and worker processes of the pool.
+        A worker claims a queued task atomically with a lease and renews leases of its tasks by heartbeat,
+        tasks whose lease expired, e.g. the worker crashed, are put back to queue.
+
+        Priorities and model affinity work as TaskQueue, max_in_flight of clients is not supported yet.
+    """
+
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+
+    lease_seconds = arg_parser.task_lease_seconds
+    """ How long a claimed task is kept by its worker without heartbeat. """
+
+    leased: dict[int, Task] = {}
+    """ task_id -> task claimed by this worker and not done yet, their leases are renewed by heartbeat. """
+
+    skips: Counter = Counter()
+    """ task_id -> times the task is passed over for model affinity. """
+
+    last_requeue_time = 0.
+
+    @classmethod
+    def put_task(cls, task: Task):
+        if task.status != TaskStatus.queued.value or task.worker_id:
+            task.status = TaskStatus.queued.value
+            task.field1 = None
+            task.field2 = None
+            task.save()
+
+    @classmethod
+    def recover(cls):
+        """ Tasks stay in the table, only those left processing by dead workers need to go back to queue,
+            other workers of the pool may be processing theirs, so only unleased and expired ones.
+        """
+        count = Task.requeue_unleased_tasks() + Task.requeue_expired_leases()
+        logger.info(f"Recover prompt tasks {count}")
+
+    @classmethod
+    def get(cls, timeout=1):
+        cls.requeue_expired_leases_if_due()
+
+        with cls.mutex:
+            task = cls._claim_next()
+        if task is None:
+            time.sleep(timeout)
+        return task
+
+    @classmethod
+    def _claim_next(cls) -> Task | None:
+        candidates = Task.get_queued_tasks(limit=max(cls.affinity_window, 1))
+        for task in cls._order_by_model_affinity(candidates):
+            claimed = cls._claim(task)
+            if claimed:
+                cls.current_model_key = cls.task_model_key(claimed)
+                cls.skips.pop(claimed.id, None)
+                return claimed
+        return None
+
+    @classmethod
+    def _order_by_model_affinity(cls, candidates: list[Task]) -> list[Task]:
+        """ Same as _pick_by_model_affinity of TaskQueue, tasks using the models loaded now go first. """
+        if not candidates or cls.affinity_window <= 1 or not cls.current_model_key:
+            return candidates
+
+        head = candidates[0]
+        if cls.skips[head.id] >= cls.affinity_max_skips or cls.task_model_key(head) == cls.current_model_key:
+            return candidates
+
+        affine = [
+            task for task in candidates
+            if task.priority == head.priority and cls.task_model_key(task) == cls.current_model_key
+        ]
+        if not affine:
+            return candidates
+
+        cls.skips[head.id] += 1
+        cls.affinity_picks += 1
+        return [*affine, *candidates]
+
+    @classmethod
+    def upcoming_model_keys(cls, count: int) -> list[frozenset[str]]:
+        return [cls.task_model_key(task) for task in Task.get_queued_tasks(limit=count)]
+
+    @classmethod
+    def task_model_key(cls, task: Task) -> frozenset[str]:
+        return PromptWorker.get_model_key(task.card_name, task.prompt.model_dump())
+
+    @classmethod
+    def _claim(cls, task: Task) -> Task | None:
+        claimed = Task.claim(task.id, cls.worker_id, cls.lease_seconds)
+        if claimed:
+            cls.leased[claimed.id] = claimed
+        return claimed
+
+    @classmethod
+    def get_batchable(cls, task: Task, max_count: int, can_join_batch) -> list[Task]:
+        batch = []
+        if max_count <= 0:
+            return batch
+
+        with cls.mutex:
+            for other_task in Task.get_queued_tasks(limit=max(cls.affinity_window, max_count), card_name=task.card_name):
+                if len(batch) >= max_count:
+                    break
+                if can_join_batch([task, *batch], other_task):
+                    claimed = cls._claim(other_task)
+                    if claimed:
+                        batch.append(claimed)
+
+        return batch
+
+    @classmethod
+    def task_done(cls, task: Task):
+        with cls.mutex:
+            cls.leased.pop(task.id, None)
+
+    @classmethod
+    def has_waiting_above(cls, priority: str) -> bool:
+        higher = higher_priorities(priority)
+        return any(priority_ in higher for priority_, _ in Task.count_queued().keys())
+
+    @classmethod
+    def cancel(cls, task_id: int) -> bool:
+        return Task.cancel_queued(task_id)
+
+    @classmethod
+    def stats(cls):
+        counts = Task.count_queued()
+        depth_of_priorities = Counter()
+        depth_of_clients = Counter()
+        for (priority, client_id), count in counts.items():
+            depth_of_priorities[priority] += count
+            depth_of_clients[client_id] += count
+
+        return {
+            'depth': sum(counts.values()),
+            'depth_of_priorities': {priority.value: depth_of_priorities[priority.value] for priority in TaskPriority},
+            'depth_of_clients': dict(depth_of_clients),
+        }
+
+    @classmethod
+    def heartbeat(cls):
+        """ Renew leases of tasks this worker is processing, run in a daemon thread of the worker. """
+        while True:
+            time.sleep(cls.lease_seconds / 3)
+            try:
+                MetricsRegistry.dump_snapshot(cls.worker_id)
+
+                with cls.mutex:
+                    tasks = list(cls.leased.values())
+                    lease_expires_at = time.time() + cls.lease_seconds
+                    for task in tasks:
+                        # tasks are saved as a whole row, keep them up to date to not roll the lease back.
+                        task.field2 = str(lease_expires_at)
+                Task.renew_leases([task.id for task in tasks], cls.worker_id, cls.lease_seconds)
+                cls.requeue_expired_leases_if_due()
+            except Exception as e:
+                logger.error(f"Heartbeat of worker {cls.worker_id} failed: {e}")
+
+    @classmethod
+    def requeue_expired_leases_if_due(cls):
+        now = time.monotonic()
+        if now - cls.last_requeue_time < cls.lease_seconds / 2:
+            return
+        cls.last_requeue_time = now
+
+        count = Task.requeue_expired_leases()
+        if count:
+            logger.info(f"Requeued {count} prompt tasks whose lease expired.")
 
 
 class PromptWorker:
@@ -78,271 +530,721 @@ class PromptWorker:
         Mostly from ComfyUI, thanks.
     """
 
-    cached_outputs: OutputsCache = OutputsCache()
+    model_residency: ModelResidency = ModelResidency(
+        budget_bytes=host_budget_bytes(arg_parser.model_residency_gb, 1 / 2),
+        policy=arg_parser.model_residency_policy
+    )
+    """ Outputs holding models, e.g. of checkpoint and LoRA loaders, they are looked up by outputs_cache. """
+
+    outputs_cache: ContentOutputsCache = ContentOutputsCache(
+        budget_bytes=host_budget_bytes(arg_parser.outputs_cache_gb, 1 / 4),
+        model_residency=model_residency
+    )
+    """ Outputs of Func/Comp/Addon of all prompts and cards, keyed by fingerprint, see func_fingerprint. """
+
+    resource_limits = {
+        'device': arg_parser.device_concurrency,
+        'disk': arg_parser.disk_concurrency,
+        'cpu': arg_parser.cpu_concurrency,
+    }
+    """ How many funcs can run at the same time per FuncResource, funcs loading models don't run with device
+        funcs whatever the limits, see Func.loads_models.
+    """
+
+    func_executor = ThreadPoolExecutor(max_workers=sum(resource_limits.values()), thread_name_prefix='FuncExecutor')
+
+    max_batch_size = arg_parser.max_batch_size
+    """ At most how many queued tasks of the same card run as one batch. """
+
+    task_queue: type[TaskQueue] = SharedTaskQueue if arg_parser.prompt_workers > 0 else TaskQueue
+    """ Where the worker gets tasks from, prompt_task table is shared when workers run in processes of a pool. """
+
+    card_plans = CardPlans(max_plans=arg_parser.max_card_plans)
+    """ Cards built with addons, reused by tasks of the same card and addon structure, see CardPlan. """
+
+    profile_funcs = arg_parser.profile_funcs
+    """ Record FuncProfile of every Func/Comp/Addon executed or hit in outputs cache, saved in TaskProfile. """
+
+    task_check_interval = 1.
+    """ Seconds between checks of cancellation and preemption of running tasks in sampling steps. """
 
-    old_prompt: Prompt = None
-    old_card: Card | None = None
+    task_start_times: dict[int, float] = {}
+    """ task_id -> time.monotonic when the task starts running, see observe_task_end. """
 
-    last_result = None
+    batchable_param_names_of_cards: dict[str, set[str]] = {}
+
+    model_param_names_of_cards: dict[str, tuple[set[str], dict[str, set[str]]]] = {}
 
     @classmethod
     def run(cls, task_queue):
         logger.debug("PromptWorker start to run.")
 
-        # todo: ask user to make the decision.
-        # try:
-        #     unfinished_tasks = Task.get_undone_tasks()
-        #     for t in unfinished_tasks:
-        #         TaskQueue.put_task(t)
-        #     logger.info(f"Recover prompt tasks {len(unfinished_tasks)}")
-        # except Exception as e:
-        #     traceback.print_exc()
+        EmbeddingIndex.install()
+
+        task_queue = cls.task_queue
+        if arg_parser.recover_tasks:
+            try:
+                task_queue.recover()
+            except Exception as e:
+                logger.error(f"Recover prompt tasks failed: {e}")
+                traceback.print_exc()
+
+        if task_queue is SharedTaskQueue:
+            threading.Thread(target=SharedTaskQueue.heartbeat, daemon=True, name='TaskLeaseHeartbeat').start()
+
+        if ModelPrefetcher.window > 0:
+            threading.Thread(target=ModelPrefetcher.run, args=(task_queue.upcoming_model_keys,), daemon=True,
+                             name='ModelPrefetcher').start()
 
         while True:
-            task = TaskQueue.get()
+            task = task_queue.get()
             if not task:
                 continue
-            cls.process_prompt(task)
+            tasks = [task, *task_queue.get_batchable(task, cls.max_batch_size - 1, cls.can_join_batch)]
+            try:
+                cls.process_prompts(tasks)
+            finally:
+                for task_ in tasks:
+                    task_queue.task_done(task_)
 
     @classmethod
-    def process_prompt(cls, task: Task):
-        logger.debug(f"start processing prompt task {task.id} {task.card_name}")
-        cls.start_task(task)
+    def process_prompts(cls, tasks: list[Task]):
+        """ Tasks are of the same card, they run as one batch if there are more than one. """
 
-        card_name = task.card_name
+        card_name = tasks[0].card_name
+        logger.debug(f"start processing prompt tasks {[task.id for task in tasks]} {card_name}")
+        tasks = [task for task in tasks if cls.start_task(task)]
+        if not tasks:
+            return
 
         card_class = cls.get_card_class(card_name)
         if not card_class:
-            cls.fail_task(task, 'Card: {} not found'.format(card_name))
+            for task in tasks:
+                cls.fail_task(task, 'Card: {} not found'.format(card_name))
             return
-        card = card_class()
 
-        cls.execute_card(card, task)
+        cls.execute_card(card_class, tasks)
 
     @classmethod
-    def execute_card(cls, card: Card, task: Task):
-        prompt = task.prompt
-        base_inputs = prompt.base_inputs
-        addon_inputs = prompt.addon_inputs
+    def execute_card(cls, card_class: type[Card], tasks: list[Task]):
+        card_name = tasks[0].card_name
+        prompts = [task.prompt for task in tasks]
+        addon_inputs = prompts[0].addon_inputs
+        """ Tasks of a batch share the same addon inputs, see can_join_batch. """
+
+        # a stale interruption is for a task gone, e.g. canceled after its sampling.
+        comfy.model_management.interrupt_current_processing(False)
+
+        profiles: list[FuncProfile] | None = [] if cls.profile_funcs else None
+        plan: CardPlan | None = None
+        model_evictions = cls.model_residency.evictions
 
         try:
             logger.debug(f"addon_inputs: {addon_inputs}")
-            addon_valid_errors = card.create_addons(addon_inputs)
+            plan, addon_valid_errors = cls.card_plans.acquire(card_name, card_class, addon_inputs)
+            card = plan.card
             logger.debug(f"Func list after created addon: {[func.name for func in card.func_list]}")
-            base_inputs_valid_errors = card.make_type_right_and_valid_inputs(base_inputs)
+
+            base_inputs_valid_errors = []
+            for prompt in prompts:
+                base_inputs_valid_errors.extend(card.make_type_right_and_valid_inputs(prompt.base_inputs))
 
             if addon_valid_errors or base_inputs_valid_errors:
                 addon_valid_errors.extend(base_inputs_valid_errors)
-                cls.fail_task(task, f"Inputs Error:{addon_valid_errors}")
+                for task in tasks:
+                    cls.fail_task(task, f"Inputs Error:{addon_valid_errors}")
+                return
+
+            tasks = cls.finish_tasks_with_saved_artworks(card, tasks)
+            if not tasks:
                 return
+            prompt_tasks, prompt_indexes = cls.dedupe_prompts(tasks)
+            prompts = [task.prompt for task in prompt_tasks]
 
             with torch.inference_mode():
                 logger.debug(f"loaded models: {comfy.model_management.current_loaded_models}")
 
-                card.set_prompt(prompt)
-                cls.set_k_samplers_callback_of_card(card, task)
+                if len(prompts) == 1:
+                    prompt = prompts[0]
+                    card.set_prompt(prompt, task_ids=[prompt_tasks[0].id])
+                else:
+                    prompt = cls.merge_prompts(prompts, plan.batchable_param_names)
+                    card.set_prompt(prompt, prompts, [task.id for task in prompt_tasks])
+                cls.set_k_samplers_callback_of_card(plan, tasks)
+                cls.resume_sampling_of_card(plan, tasks)
+
+                fingerprints = cls.calculate_fingerprints(plan, prompt)
 
-                to_deletes = cls.delete_outputs_if_changed(card, prompt)
-                logger.debug(f'to_deletes: {to_deletes}')
-                to_executes = cls.calculate_to_executes(card, to_deletes)
+                # outputs of this task only, hits of outputs_cache are copied in so they can't be evicted halfway.
+                task_outputs = OutputsCache()
+                to_executes = cls.calculate_to_executes(plan, fingerprints, task_outputs, profiles)
                 logger.debug(f'to_executes:{[func.name for func in to_executes]}')
 
-                if not to_executes:
-                    cls.finish_task(task, cls.last_result)
-                    return
+                cls.execute_funcs(to_executes, prompt, plan, task_outputs, fingerprints, profiles)
+
+                logger.debug(f"outputs cache stats: {cls.outputs_cache.stats}")
+                logger.debug(f"model residency stats: {cls.model_residency.stats}")
+
+                # Notice: card only support single result output now, the last func holds it.
+                last_func = plan.last_func
+                results = task_outputs.get_func_outputs(last_func.name).get(last_func.index)
+                results_of_prompts = cls.split_results(results, len(prompts))
+                for task, prompt_index in zip(tasks, prompt_indexes):
+                    cls.finish_task(task, results_of_prompts[prompt_index])
+                logger.debug(f"results: {results}")
 
-                # Notice: card only support single result output now, so any func of the card changed, the result should change.
-                for index, func in enumerate(to_executes):
-                    is_last = index == len(to_executes) - 1
-                    if is_last:
-                        cls.last_result = cls.execute_func(func, prompt, card)
-                        cls.old_prompt = prompt
-                        cls.old_card = card
+        except SamplingPreempted as e:
+            logger.info(f"Task {tasks[0].id} preempted: {e}")
+            cls.preempt_task(tasks[0], e)
 
-                        cls.finish_task(task, cls.last_result)
-                        logger.debug(f"results: {cls.last_result}")
-                    else:
-                        _ = cls.execute_func(func, prompt, card)
+        except comfy.model_management.InterruptProcessingException:
+            logger.info(f"Tasks {[task.id for task in tasks]} canceled.")
+            for task in tasks:
+                cls.cancel_task(task)
 
         except Exception as e:
             logger.debug(e)
             traceback.print_exc()
-            cls.fail_task(task, str(e))
+            for task in tasks:
+                cls.fail_task(task, str(e))
+
+        finally:
+            comfy.model_management.interrupt_current_processing(False)
+            if plan is not None:
+                cls.card_plans.release(plan)
+            if cls.model_residency.evictions != model_evictions:
+                cls.release_models()
+            if profiles:
+                cls.save_profiles(card_name, tasks, profiles)
 
     @classmethod
-    def execute_func(cls, func: Func, prompt: Prompt, card: Card):
-        logger.debug(f"Start to execute func {func.name}")
-        if isinstance(func, Addon):
-            func_outputs = func.execute(prompt.addon_inputs, cls.cached_outputs, card, func.name)
-        else:
-            func_outputs = func.execute(prompt.base_inputs, cls.cached_outputs, card, func.name)
-
-        cls.cached_outputs.cache_func_outputs(func.name, func.index, func_outputs)
-        logger.debug(f"cached funcs: {list(cls.cached_outputs.cache.keys())} ")
-        return func_outputs
+    def release_models(cls):
+        """ Models dropped by model_residency are gone once nothing holds them, clear them from comfy's loaded
+            models and give their memory back to device.
+        """
+        comfy.model_management.cleanup_models_gc()
+        comfy.model_management.cleanup_models()
+        comfy.model_management.soft_empty_cache()
 
     @classmethod
-    def delete_outputs_if_changed(cls, card: Card, prompt: Prompt):
-        to_deletes = []
+    def finish_tasks_with_saved_artworks(cls, card: Card, tasks: list[Task]) -> list[Task]:
+        """ A task run again after a crash may have saved its artworks last time, finish it with them instead of
+            generating again, return tasks left to run.
+        """
 
-        for func in card.func_list:
-            if isinstance(func, Addon):
-                is_widget_inputs_changed = cls.is_addon_inputs_changed(func, prompt.addon_inputs, card)
-            elif isinstance(func, Comp):
-                is_widget_inputs_changed = cls.is_comp_inputs_changed(func, prompt.base_inputs, card)
-            else:
-                is_widget_inputs_changed = False
+        last_func = card.func_list[-1]
+
+        tasks_to_run = []
+        for task in tasks:
+            artworks = Artwork.get_artworks_of_task(task.id) if task.attempts > 1 else []
+            outputs = last_func.outputs_of_artworks(artworks) if artworks else None
 
-            if is_widget_inputs_changed:
-                is_changed = True
+            if outputs is not None and len(artworks) == artworks[0].task_artwork_count:
+                logger.info(f"Task {task.id} reuses artworks saved: {[artwork.id for artwork in artworks]}")
+                cls.finish_task(task, outputs)
             else:
-                is_changed = not cls.are_func_inputs_equal(func, card)
+                if artworks:
+                    # saved halfway, the run again tags its own ones.
+                    Artwork.untag_task(task.id)
+                tasks_to_run.append(task)
+        return tasks_to_run
 
-            if is_changed:
-                to_deletes.append(func.name)
-                func_successor_names = card.get_func_successors(func)
-                to_deletes.extend(func_successor_names)
-                if len(to_deletes) == len(card.func_list):
-                    break
+    @classmethod
+    def get_batchable_param_names(cls, card_name: str) -> set[str]:
+        if card_name not in cls.batchable_param_names_of_cards:
+            card_class = cls.get_card_class(card_name)
+            cls.batchable_param_names_of_cards[card_name] = card_class().batchable_param_names if card_class else set()
+        return cls.batchable_param_names_of_cards[card_name]
 
-        func_names = [func.name for func in card.func_list]
-        for cached_func in cls.cached_outputs.cached_keys():
-            if cached_func not in func_names:
-                to_deletes.append(cached_func)
+    @classmethod
+    def get_model_param_names(cls, card_name: str) -> tuple[set[str], dict[str, set[str]]]:
+        if card_name not in cls.model_param_names_of_cards:
+            card_class = cls.get_card_class(card_name)
+            card = card_class() if card_class else None
+            cls.model_param_names_of_cards[card_name] = \
+                (card.model_param_names, card.addon_model_param_names) if card else (set(), {})
+        return cls.model_param_names_of_cards[card_name]
 
-        to_deletes = set(to_deletes)
-        for to_delete in to_deletes:
-            cls.cached_outputs.clear_func_outputs(to_delete)
+    @classmethod
+    def get_model_key(cls, card_name: str, prompt: dict) -> frozenset[str]:
+        """ Model files the prompt loads, base and addon ones together, e.g. checkpoint, unet and LoRAs. """
 
-        logger.debug(
-            f"Models before clean: {[model.model.model.__class__.__name__ for model in comfy.model_management.current_loaded_models]}")
-        comfy.model_management.cleanup_models()
-        logger.debug(
-            f"Models after clean: {[model.model.model.__class__.__name__ for model in comfy.model_management.current_loaded_models]}")
-        return to_deletes
+        param_names, addon_param_names = cls.get_model_param_names(card_name)
+
+        model_ids = set()
+        base_inputs = prompt.get('base_inputs') or {}
+        for param_name in param_names:
+            model_ids.add(base_inputs.get(param_name))
+
+        addon_inputs = prompt.get('addon_inputs') or {}
+        for addon_name, inputs_list in addon_inputs.items():
+            for inputs in inputs_list or []:
+                for param_name in addon_param_names.get(addon_name, ()):
+                    model_ids.add(inputs.get(param_name))
+
+        return frozenset(str(model_id) for model_id in model_ids if model_id not in (None, 'None'))
 
     @classmethod
-    def calculate_to_executes(cls, card, to_deletes):
-        to_executes = []
-        for func in card.func_list:
-            if func.name not in cls.cached_outputs.cached_keys():
-                to_executes.append(func)
-        return to_executes
+    def can_join_batch(cls, batch: list[Task], task: Task):
+        """ A task can join the batch if its prompt differs from the batch's only in batchable params,
+            a prompt same as one in batch joins too, it's run once for them, see dedupe_prompts.
+        """
+
+        first_prompt = batch[0].prompt
+        prompt = task.prompt
+        batchable_param_names = cls.get_batchable_param_names(task.card_name)
+
+        if not batchable_param_names or prompt.addon_inputs != first_prompt.addon_inputs:
+            return False
+
+        if prompt.base_inputs.keys() != first_prompt.base_inputs.keys():
+            return False
+
+        for name, value in prompt.base_inputs.items():
+            if name not in batchable_param_names and value != first_prompt.base_inputs[name]:
+                return False
+
+        return True
 
     @classmethod
-    def is_comp_inputs_changed(cls, comp: Comp, inputs, card):
-        if not cls.old_prompt:
-            return True
+    def dedupe_prompts(cls, tasks: list[Task]) -> tuple[list[Task], list[int]]:
+        """ Tasks of a batch with the same prompt run it once, return the first task of every prompt and the index
+            of its prompt for each task, results of the prompt are given to all tasks of it.
+        """
+
+        prompt_tasks = []
+        prompt_indexes = []
+        for task in tasks:
+            for index, prompt_task in enumerate(prompt_tasks):
+                if prompt_task.prompt.base_inputs == task.prompt.base_inputs:
+                    prompt_indexes.append(index)
+                    break
+            else:
+                prompt_indexes.append(len(prompt_tasks))
+                prompt_tasks.append(task)
+        return prompt_tasks, prompt_indexes
 
-        widget_input_names = comp.widgets.keys()
-        is_equals = []
+    @classmethod
+    def merge_prompts(cls, prompts: list[Prompt], batchable_param_names: set[str]) -> Prompt:
+        """ Merge prompts of a batch to one, values of batchable params are put in BatchedInputs. """
 
-        for input_name in widget_input_names:
-            old_input = cls.old_prompt.base_inputs.get(input_name)
-            input_ = inputs.get(input_name)
-            is_equals.append(old_input == input_)
+        base_inputs = {}
+        for name, value in prompts[0].base_inputs.items():
+            if name in batchable_param_names:
+                base_inputs[name] = BatchedInputs(prompt.base_inputs.get(name) for prompt in prompts)
+            else:
+                base_inputs[name] = value
 
-        return not all(is_equals)
+        # skip validation, or pydantic may take BatchedInputs as a plain list.
+        return Prompt.model_construct(
+            card_name=prompts[0].card_name,
+            base_inputs=base_inputs,
+            addon_inputs=prompts[0].addon_inputs
+        )
 
     @classmethod
-    def is_addon_inputs_changed(cls, addon: Addon, addon_inputs, card):
-        if not cls.old_prompt:
-            return True
+    def split_results(cls, results: dict, count: int) -> list[dict]:
+        """ Split results of a batch to its tasks in order, list values are divided evenly, dict values are split
+            recursively, e.g. {'result': {'images': [...]}}, others are shared.
+        """
+
+        if count == 1:
+            return [results]
+
+        splits = [{} for _ in range(count)]
+        for key, value in results.items():
+            if isinstance(value, dict):
+                for split, value_split in zip(splits, cls.split_results(value, count)):
+                    split[key] = value_split
+            elif isinstance(value, list) and len(value) % count == 0:
+                size = len(value) // count
+                for index, split in enumerate(splits):
+                    split[key] = value[index * size:(index + 1) * size]
+            else:
+                for split in splits:
+                    split[key] = value
+        return splits
 
-        addon_name = addon.name
-        this_addon_inputs = addon_inputs.get(addon_name, [])
-        old_addon_inputs = cls.old_prompt.addon_inputs.get(addon_name, [])
+    @classmethod
+    def execute_funcs(cls, to_executes: list[Func], prompt: Prompt, plan: CardPlan, task_outputs: OutputsCache,
+                      fingerprints: dict, profiles: list[FuncProfile] | None = None):
+        """ Run funcs of the card DAG as soon as their predecessors are done, funcs of independent branches run
+            at the same time in func_executor, as long as their resource is under resource_limits and funcs loading
+            models don't overlap with device funcs.
+        """
+
+        names_to_execute = {func.name for func in to_executes}
+        predecessors = {
+            func.name: plan.predecessors[func.name] & names_to_execute for func in to_executes
+        }
+
+        pending = list(to_executes)
+        running: dict[Future, Func] = {}
+        busy = Counter()
+        done = set()
+
+        def can_start(func: Func) -> bool:
+            # comfy model_management is not thread safe, loading a model may unload the one a device func is using.
+            if func.loads_models and (busy['device'] or busy['loads_models']):
+                return False
+            if func.resource == 'device' and busy['loads_models']:
+                return False
+            return busy[func.resource] < cls.resource_limits[func.resource]
 
-        if len(this_addon_inputs) != len(old_addon_inputs):
-            return True
+        try:
+            while pending or running:
+                for func in list(pending):
+                    if predecessors[func.name] <= done and can_start(func):
+                        pending.remove(func)
+                        busy[func.resource] += 1
+                        busy['loads_models'] += func.loads_models
+                        future = cls.func_executor.submit(cls.execute_func, func, prompt, plan.card, task_outputs, profiles)
+                        running[future] = func
+
+                assert running, f"Funcs: {[func.name for func in pending]} can never be ready to execute."
+
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    func = running.pop(future)
+                    busy[func.resource] -= 1
+                    busy['loads_models'] -= func.loads_models
+                    future.result()
+
+                    done.add(func.name)
+                    cls.outputs_cache.put(fingerprints[func.name], dict(task_outputs.get_func_outputs(func.name)))
+        except Exception:
+            # threads can't be killed, wait for running funcs to make sure nothing touches the task after it fails.
+            wait(running.keys())
+            raise
 
-        is_equals = []
-        for input_dict, old_input_dict in zip(this_addon_inputs, old_addon_inputs):
-            if input_dict.keys() == old_input_dict.keys():
-                if all(old_input_dict[key] == old_input_dict[key] for key in input_dict):
-                    is_equals.append(True)
-                else:
-                    is_equals.append(False)
+    @classmethod
+    def execute_func(cls, func: Func, prompt: Prompt, card: Card, task_outputs: OutputsCache,
+                     profiles: list[FuncProfile] | None = None):
+        logger.debug(f"Start to execute func {func.name} on {func.resource}")
+        # inference_mode is thread local, func may run in func_executor.
+        with torch.inference_mode(), profile_func(func, profiles) if profiles is not None else nullcontext():
+            if isinstance(func, Addon):
+                func_outputs = func.execute(prompt.addon_inputs, task_outputs, card, func.name)
             else:
-                is_equals.append(False)
+                func_outputs = func.execute(prompt.base_inputs, task_outputs, card, func.name)
 
-        return not all(is_equals)
+        task_outputs.cache_func_outputs(func.name, func.index, func_outputs)
+        return func_outputs
 
     @classmethod
-    def are_func_inputs_equal(cls, func: Func, card):
-        """ Check if inputs from other funcs are equal. """
+    def calculate_fingerprints(cls, plan: CardPlan, prompt: Prompt):
+        """ Fingerprint every Func/Comp/Addon of card in order, func_list is already topologically sorted.
+            Funcs run inside a Comp/Addon are fingerprinted one by one, the Comp keeps them to take outputs of its
+            funcs from outputs_cache, so a changed widget only reruns the funcs from the one taking it, e.g. a new
+            LoRA weight don't load the LoRAs before it again.
+        """
+
+        fingerprints = {}
+        for func in plan.func_list:
+            addon_inputs_list = (prompt.addon_inputs or {}).get(func.name) or []
+
+            fingerprint = None
+            planned_funcs = plan.planned_funcs[func.name]
+            for position, planned_func in enumerate(planned_funcs):
+                comp_index = planned_func.comp_index
+                if comp_index is None:
+                    inputs = prompt.base_inputs
+                else:
+                    inputs = addon_inputs_list[comp_index] if comp_index < len(addon_inputs_list) else {}
+                fingerprint = cls.func_fingerprint(planned_func, inputs, fingerprint, fingerprints)
 
-        if not cls.old_card:
-            return False
+                comp = planned_func.comp
+                if comp is not None:
+                    # outputs of the last one are cached as outputs of the Func/Comp/Addon.
+                    is_last = position == len(planned_funcs) - 1
+                    comp.func_fingerprints[planned_func.index] = None if is_last else fingerprint
+                    comp.func_outputs_cache = cls.outputs_cache
 
-        old_func = cls.old_card.get_func(func.name)
-        if not old_func:
-            return False
+            fingerprints[func.name] = cls.hash_fingerprint_content([func.__class__.__name__, fingerprint])
+        return fingerprints
 
-        def is_func_input_equal(func_input: FuncInput, old_func_input: FuncInput):
-            output_pos = func_input.link.frm.pos if func_input.link else None
-            old_output_pos = old_func_input.link.frm.pos if old_func_input.link else None
-            if not output_pos and not old_output_pos:
-                return True
+    @classmethod
+    def func_fingerprint(cls, planned_func: PlannedFunc, inputs: dict, prev_fingerprint: str | None,
+                         fingerprints: dict):
+        """ Hash of what decides the outputs of a Func: the func before it in the Comp/Addon, the widget inputs it
+            takes and the fingerprints of upstream Func/Comp/Addon it links from, so it's the same across cards.
+            inputs are base_inputs, or inputs of the comp if the func is of an Addon.
+        """
+
+        widget_inputs = {
+            input_name: unbatch_if_uniform(inputs.get(mapped_name))
+            for input_name, mapped_name in planned_func.widget_inputs
+        }
+
+        upstreams = [
+            [input_name, fingerprints.get(upstream_name), upstream_index, param_name]
+            for input_name, upstream_name, upstream_index, param_name in planned_func.upstream_links
+        ]
+
+        return cls.hash_fingerprint_content(
+            [prev_fingerprint, planned_func.func.__class__.__name__, widget_inputs, upstreams]
+        )
 
-            if (not output_pos and old_output_pos) or (output_pos and not old_output_pos):
-                return False
+    @classmethod
+    def hash_fingerprint_content(cls, content: list):
+        content = json.dumps(content, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def calculate_to_executes(cls, plan: CardPlan, fingerprints: dict, task_outputs: OutputsCache,
+                              profiles: list[FuncProfile] | None = None):
+        """ Walk the card backwards from its last func, a cached func cuts off its upstream, as they are not needed
+            any more. Cached outputs are put to task_outputs, return the funcs to execute in order.
+        """
+
+        needed = {plan.last_func.name} if plan.func_list else set()
+        to_executes = []
+
+        for func in reversed(plan.func_list):
+            if func.name not in needed:
+                continue
+
+            cached = cls.outputs_cache.get(fingerprints[func.name])
+            if cached is not None:
+                task_outputs.cache[func.name] = dict(cached)
+                if profiles is not None:
+                    profiles.append(cached_func_profile(func))
+                continue
 
-            func_name, func_index, param_name = card.map_pos_to_func_and_io_names(output_pos)
-            old_func_name, old_func_index, old_param_name = cls.old_card.map_pos_to_func_and_io_names(old_output_pos)
-            is_output_equal = (func_name == old_func_name
-                               and func_index == old_func_index
-                               and param_name == old_param_name
-                               )
-            return is_output_equal
+            to_executes.insert(0, func)
+            needed.update(plan.predecessors[func.name])
 
-        is_equals = []
-        for input_ in func.inputs.values():
-            old_input = old_func.inputs.get(input_.name)
-            if not old_input:
-                is_equals.append(False)
-            is_equal = is_func_input_equal(input_, old_input)
-            is_equals.append(is_equal)
+        return to_executes
 
-        return all(is_equals)
+    @classmethod
+    def save_profiles(cls, card_name: str, tasks: list[Task], profiles: list[FuncProfile]):
+        """ Every task of a batch gets the same profiles, as they run together. """
+        try:
+            for task in tasks:
+                TaskProfile(task_id=task.id, card_name=card_name, func_profiles=profiles).save()
+        except Exception as e:
+            logger.error(f"Save profiles of tasks {[task.id for task in tasks]} failed: {e}")
 
     @classmethod
-    def set_k_samplers_callback_of_card(cls, card, task):
-        k_samplers = card.get_ksampler_funcs()
+    def set_k_samplers_callback_of_card(cls, plan: CardPlan, tasks: list[Task]):
+        card = plan.card
+        card_name = card.meta_data.get('name')
+
+        start_time, start_step, last_step = None, 0, 0
 
         def callback(step, total_steps, preview_bytes):
-            cls.preview_task(task, info={
-                'step': step,
-                'total_steps': total_steps,
-                'preview_bytes': preview_bytes
-            })
+            nonlocal start_time, start_step, last_step
+            now = time.monotonic()
+            if start_time is None or step < last_step:
+                # step goes back when the next sampler of card starts.
+                start_time, start_step = now, step
+            else:
+                metrics.sampler_steps_total.inc(step - last_step, card_name=card_name)
+                if now > start_time:
+                    metrics.sampler_steps_per_second.set((step - start_step) / (now - start_time), card_name=card_name)
+            last_step = step
+
+            for task in tasks:
+                cls.preview_task(task, info={
+                    'step': step,
+                    'total_steps': total_steps,
+                    'preview_bytes': preview_bytes
+                })
+
+        last_check_time = 0.
+
+        def step_hook():
+            """ Check tasks now and then, interrupt if all canceled, tell to pause if a higher priority task waits. """
+            nonlocal last_check_time
+            now = time.monotonic()
+            if now - last_check_time < cls.task_check_interval:
+                return False
+            last_check_time = now
 
-        for k_sampler in k_samplers:
+            statuses = Task.get_statuses([task.id for task in tasks])
+            if all(statuses.get(task.id) == TaskStatus.canceled.value for task in tasks):
+                comfy.model_management.interrupt_current_processing()
+                return False
+
+            # a batch is not paused, its tasks may have different priorities.
+            return card.preemptible and len(tasks) == 1 and cls.task_queue.has_waiting_above(tasks[0].priority)
+
+        for k_sampler in plan.k_samplers:
             k_sampler.set_callback(callback)
+            k_sampler.step_hook = step_hook
 
     @classmethod
-    def start_task(cls, task: Task):
-        task.status = TaskStatus.processing.value
+    def resume_sampling_of_card(cls, plan: CardPlan, tasks: list[Task]):
+        """ Resume the sampling paused of the task, see preempt_task. """
+
+        checkpoint_info = tasks[0].sampling_checkpoint if len(tasks) == 1 else None
+        if not checkpoint_info:
+            return
+
+        # latents are saved by safetensors, so the file is never unpickled, older .pt files are not resumed.
+        path = Path(checkpoint_info.get('path'))
+        if path.suffix != '.safetensors' or not path.exists():
+            return
+
+        for k_sampler in plan.k_samplers:
+            if k_sampler.name == checkpoint_info.get('func_name'):
+                x = safetensors.torch.load_file(str(path), device='cpu')['x']
+                k_sampler.resume_from = SamplingCheckpoint(checkpoint_info.get('step'), x)
+                logger.info(f"Task {tasks[0].id} resumes sampling of {k_sampler.name} at step {checkpoint_info.get('step')}")
+                return
+
+    @classmethod
+    def preempt_task(cls, task: Task, preempted: SamplingPreempted):
+        """ Save the sampling checkpoint and put the task back to queue, it goes after tasks of higher priority. """
+
+        cls.clear_sampling_checkpoint(task)
+
+        path = sampling_checkpoint_dir / f'task_{task.id}.safetensors'
+        safetensors.torch.save_file({'x': preempted.checkpoint.x.detach().cpu().contiguous()}, str(path))
+        task.field4 = json.dumps({
+            'func_name': preempted.func_name,
+            'step': preempted.checkpoint.step,
+            'path': str(path)
+        })
+        task.status = TaskStatus.queued.value
         task.save()
+        cls.task_queue.put_task(task)
+
+    @classmethod
+    def clear_sampling_checkpoint(cls, task: Task):
+        checkpoint_info = task.sampling_checkpoint
+        if checkpoint_info:
+            Path(checkpoint_info.get('path')).unlink(missing_ok=True)
+            task.field4 = None
+
+    @classmethod
+    def is_task_canceled(cls, task: Task):
+        return Task.get_statuses([task.id]).get(task.id) == TaskStatus.canceled.value
+
+    @classmethod
+    def start_task(cls, task: Task) -> bool:
+        """ Return False if the task is not to run, e.g. canceled between it's got from queue and now. """
+        if not Task.start(task.id, task.attempts + 1):
+            logger.info(f"Task {task.id} is not started, it's canceled or done.")
+            return False
+
+        task.status = TaskStatus.processing.value
+        task.field3 = str(task.attempts + 1)
+        cls.task_start_times[task.id] = time.monotonic()
+        return True
+
+    @classmethod
+    def observe_task_end(cls, task: Task):
+        start_time = cls.task_start_times.pop(task.id, None)
+        if start_time is not None:
+            metrics.task_run_seconds.observe(time.monotonic() - start_time, card_name=task.card_name,
+                                             status=task.status)
+        if task.created_time_stamp:
+            metrics.task_latency_seconds.observe(time.time() - task.created_time_stamp, card_name=task.card_name,
+                                                 status=task.status)
+        metrics.tasks_total.inc(card_name=task.card_name, status=task.status)
+
+    @classmethod
+    def collect_metrics(cls):
+        stats = cls.outputs_cache.stats
+        metrics.outputs_cache_requests_total.set_total(stats['hits'], result='hit')
+        metrics.outputs_cache_requests_total.set_total(stats['misses'], result='miss')
+        metrics.outputs_cache_bytes.set(stats['total_bytes'])
+
+        residency_stats = cls.model_residency.stats
+        metrics.model_residency_bytes.set(residency_stats['total_bytes'])
+        metrics.model_residency_evictions_total.set_total(residency_stats['evictions'])
+
+        state_dict_stats = StateDictCache.stats()
+        metrics.state_dict_cache_requests_total.set_total(state_dict_stats['hits'], result='hit')
+        metrics.state_dict_cache_requests_total.set_total(state_dict_stats['misses'], result='miss')
+        metrics.state_dict_cache_bytes.set(state_dict_stats['bytes'])
+
+        lora_fusion_stats = LoraFusion.stats()
+        metrics.lora_fusion_requests_total.set_total(lora_fusion_stats['hits'], result='hit')
+        metrics.lora_fusion_requests_total.set_total(lora_fusion_stats['misses'], result='miss')
+        metrics.lora_fusion_bytes.set(lora_fusion_stats['bytes'])
+
+        cond_stats = CondCache.stats()
+        metrics.cond_cache_requests_total.set_total(cond_stats['hits'], result='hit')
+        metrics.cond_cache_requests_total.set_total(cond_stats['disk_hits'], result='disk_hit')
+        metrics.cond_cache_requests_total.set_total(cond_stats['misses'], result='miss')
+        metrics.cond_cache_bytes.set(cond_stats['bytes'], kind='memory')
+        metrics.cond_cache_bytes.set(cond_stats['disk_bytes'], kind='disk')
+
+        plan_stats = CondBatchPlanner.stats()
+        metrics.cond_batch_plans_total.set_total(plan_stats['planned'], result='planned')
+        metrics.cond_batch_plans_total.set_total(plan_stats['reused'], result='reused')
+
+        cfg_stats = CfgOptions.stats()
+        for result, count in cfg_stats.items():
+            metrics.cfg_uncond_predictions_total.set_total(count, result=result)
+
+        token_stats = TokenCache.stats()
+        metrics.token_cache_requests_total.set_total(token_stats['hits'], result='hit')
+        metrics.token_cache_requests_total.set_total(token_stats['misses'], result='miss')
+
+        metrics.loaded_model_bytes.clear()
+        for loaded_model in list(comfy.model_management.current_loaded_models):
+            model = loaded_model.model
+            if model is None:
+                continue
+            model_name = model.model.__class__.__name__
+            device = str(loaded_model.device)
+            metrics.loaded_model_bytes.set(model.loaded_size(), model=model_name, device=device, kind='loaded')
+            metrics.loaded_model_bytes.set(model.model_size(), model=model_name, device=device, kind='total')
+
+        device = comfy.model_management.get_torch_device()
+        metrics.device_memory_bytes.set(comfy.model_management.get_free_memory(device), device=str(device), kind='free')
+        metrics.device_memory_bytes.set(comfy.model_management.get_total_memory(device), device=str(device),
+                                        kind='total')
+
+        virtual_memory = psutil.virtual_memory()
+        metrics.ram_bytes.set(virtual_memory.available, kind='available')
+        metrics.ram_bytes.set(virtual_memory.total, kind='total')
 
     @classmethod
     def preview_task(cls, task: Task, info: dict):
         task.preview_info = info
+        Task.update_preview_info(task.id, info)
+
+    @classmethod
+    def cancel_task(cls, task: Task):
+        cls.clear_sampling_checkpoint(task)
+        task.preview_info = None
+        task.status = TaskStatus.canceled.value
         task.save()
+        cls.observe_task_end(task)
 
     @classmethod
     def fail_task(cls, task: Task, reason: str):
+        if cls.is_task_canceled(task):
+            cls.cancel_task(task)
+            return
+
+        cls.clear_sampling_checkpoint(task)
         task.info = reason
         task.status = TaskStatus.failed.value
         task.save()
+        cls.observe_task_end(task)
 
     @classmethod
     def finish_task(cls, task: Task, results: dict):
+        """ A task canceled while it's in a batch still goes to the end with others, it's dropped here. """
+        if cls.is_task_canceled(task):
+            cls.cancel_task(task)
+            return
+
+        cls.clear_sampling_checkpoint(task)
         task.outputs = results
         task.preview_info = None
         task.status = TaskStatus.done.value
         task.save()
+        cls.observe_task_end(task)
 
     @classmethod
     def get_card_class(cls, card_name: str):
         return CardDataModel.get_card_class(card_name)
+
+
+MetricsRegistry.add_collector(PromptWorker.collect_metrics)
@@ -0,0 +1,48 @@
+import asyncio
+import multiprocessing
+import os
+
+from misc.logger import logger
+
+
+def run_prompt_worker_process():
+    """ Entry of a prompt worker process, it gets tasks from prompt_task table shared with the server process. """
+
+    from misc.whatsai_dirs import init_file_paths
+    from prompt_worker import PromptWorker
+
+    init_file_paths()
+    PromptWorker.run(asyncio.new_event_loop())
+
+
+def start_prompt_worker_pool(worker_count: int, devices: list[str]):
+    """ Start prompt worker processes, each is given a device in turn by CUDA_VISIBLE_DEVICES if devices set,
+        processes are spawned, so the env works even if the server process has initialized CUDA.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    processes = []
+
+    for index in range(worker_count):
+        device = devices[index % len(devices)] if devices else None
+        env_device = os.environ.get('CUDA_VISIBLE_DEVICES')
+
+        if device is not None:
+            os.environ['CUDA_VISIBLE_DEVICES'] = device
+        try:
+            process = context.Process(
+                target=run_prompt_worker_process,
+                name=f'PromptWorker-{index}',
+                daemon=True
+            )
+            process.start()
+        finally:
+            if env_device is None:
+                os.environ.pop('CUDA_VISIBLE_DEVICES', None)
+            else:
+                os.environ['CUDA_VISIBLE_DEVICES'] = env_device
+
+        logger.info(f"Prompt worker process {process.name} started, pid: {process.pid}, device: {device}")
+        processes.append(process)
+
+    return processes
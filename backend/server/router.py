@@ -3,17 +3,20 @@ from typing import Optional
 
 from fastapi import APIRouter, HTTPException, BackgroundTasks
 from pydantic import BaseModel
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, PlainTextResponse
 
 from core.widgets import WIDGET_FUNCTION_MAP, list_vaes
 from data_type.whatsai_card import CardDataModel, download_cover_image, CardInfo
 from data_type.helpers import sort_model_info
-from data_type.whatsai_task import Task
+from data_type.whatsai_task import Task, TaskPriority
+from data_type.whatsai_task_profile import TaskProfile
 from data_type.whatsai_input_file import InputFile
 from data_type.whatsai_artwork import Artwork
 from misc.helpers import file_type_guess
+from misc import metrics
 from misc.logger import logger
-from prompt_worker import TaskQueue
+from misc.metrics import MetricsRegistry
+from prompt_worker import PromptWorker
 
 router = APIRouter()
 
@@ -130,6 +133,7 @@ async def local_addon_info(addon_name: str):
 class GenerationReq(BaseModel):
     card_name: str
     client_id: str
+    priority: TaskPriority = TaskPriority.normal
 
 
 @router.post('/generate')
@@ -142,11 +146,18 @@ async def generate(req: GenerationReq):
 
     current_card_info = card_record.get_card_info()
     prompt = current_card_info.to_prompt()
-    TaskQueue.put(card_name, prompt, client_id)
+    PromptWorker.task_queue.put(card_name, prompt, client_id, priority=req.priority.value)
     return True
 
 
-# todo: add task cancel logic
+@router.get('/task/cancel_task')
+async def cancel_task(task_id: int):
+    """ A queued task is taken out of queue at once, a processing one is interrupted by its worker
+        at the coming sampling step.
+    """
+    taken_out_of_queue = PromptWorker.task_queue.cancel(task_id)
+    canceled = Task.cancel(task_id)
+    return taken_out_of_queue or canceled
 
 
 class WidgetFunctionParams(BaseModel):
@@ -255,11 +266,37 @@ async def get_tasks():
     return tasks
 
 
+@router.get('/metrics')
+def get_metrics():
+    """ Metrics in Prometheus text format, worker processes of pool are included with worker label. """
+    for priority, depth in PromptWorker.task_queue.stats()['depth_of_priorities'].items():
+        metrics.queue_depth.set(depth, priority=priority)
+    return PlainTextResponse(MetricsRegistry.render(), media_type='text/plain; version=0.0.4')
+
+
+@router.get('/task/get_task_profiles')
+async def get_task_profiles(task_id: int):
+    return TaskProfile.get_profiles_of_task(task_id)
+
+
+@router.get('/task/get_task_trace')
+async def get_task_trace(task_id: int):
+    """ Profiles of the task in Chrome trace format. """
+    return TaskProfile.to_chrome_trace(TaskProfile.get_profiles_of_task(task_id))
+
+
+@router.get('/task/queue_stats')
+async def queue_stats():
+    return PromptWorker.task_queue.stats()
+
+
 @router.get('/task/remove_task')
 async def remove_task(task_id: str):
     if not task_id:
         return False
+    PromptWorker.task_queue.cancel(int(task_id))
     Task.remove(task_id)
+    TaskProfile.remove_profiles_of_task(task_id)
     return True
 
 
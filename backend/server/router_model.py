@@ -4,6 +4,7 @@ from fastapi import APIRouter
 from data_type.civitai_model_version import CivitaiModelVersion, CivitaiFileToDownload
 from data_type.whatsai_model_download_task import ModelDownloadTask
 from data_type.whatsai_model_info import ModelInfo
+from data_type.whatsai_model_detection import ModelDetection
 from misc.constants import webui_model_dirs_map, comfyui_model_dirs_map
 from misc.helpers import (
     get_model_files_in_dir, async_head
@@ -101,6 +102,14 @@ async def get_model_by_local_path(local_path: str):
     return ModelInfo.get(local_path, with_civitai_model_info=True)
 
 
+@router.get('/get_model_detections')
+async def get_model_detections():
+    """ Architecture, parameters and weight dtype of checkpoints and diffusion models loaded before,
+        taken from what model detection saved, no model is loaded.
+    """
+    return ModelDetection.get_all()
+
+
 class DownloadCivitAIModelReq(PydanticModel):
     civitai_model_version: CivitaiModelVersion
     files_to_download: list[CivitaiFileToDownload]
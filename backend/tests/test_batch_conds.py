@@ -0,0 +1,34 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from misc.helpers import repeat_conds_per_task
+
+
+def test_each_task_keeps_its_prompt_with_batch_size_2():
+    cond_0 = torch.zeros(1, 77, 8)
+    cond_1 = torch.ones(1, 77, 8)
+    conditioning = [[torch.cat([cond_0, cond_1]), {"pooled_output": torch.tensor([[0.], [1.]])}]]
+
+    # latent of the 2 tasks is [t0b0, t0b1, t1b0, t1b1]
+    [[cond, options]] = repeat_conds_per_task(conditioning, tasks=2, per_task=2)
+
+    assert cond.shape[0] == 4
+    assert [int(sample.mean()) for sample in cond] == [0, 0, 1, 1]
+    assert options["pooled_output"].flatten().tolist() == [0., 0., 1., 1.]
+
+
+def test_conds_not_batched_per_task_are_left():
+    cond = torch.rand(1, 77, 8)
+    conditioning = [[cond, {"strength": 1.0}]]
+
+    [[repeated, options]] = repeat_conds_per_task(conditioning, tasks=2, per_task=2)
+
+    assert repeated is cond
+    assert options == {"strength": 1.0}
+
+
+def test_batch_size_1_is_left():
+    conditioning = [[torch.rand(2, 77, 8), {}]]
+
+    assert repeat_conds_per_task(conditioning, tasks=2, per_task=1) is conditioning
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("torch")
+
+from data_type.whatsai_card import Prompt
+from data_type.whatsai_task import Task, TaskStatus
+from prompt_worker import PromptWorker
+
+CARD = 'test_card'
+
+
+def make_task(task_id, addon_inputs=None, **base_inputs):
+    base_inputs = {'ckpt_name': 'sd15', 'seed': 0, **base_inputs}
+    return Task(
+        id=task_id,
+        client_id='a',
+        status=TaskStatus.queued.value,
+        card_name=CARD,
+        prompt=Prompt(card_name=CARD, base_inputs=base_inputs, addon_inputs=addon_inputs),
+    )
+
+
+@pytest.fixture(autouse=True)
+def batchable_params(monkeypatch):
+    monkeypatch.setattr(PromptWorker, 'batchable_param_names_of_cards', {CARD: {'seed'}})
+
+
+def test_task_differing_in_batchable_params_joins():
+    assert PromptWorker.can_join_batch([make_task(1, seed=1)], make_task(2, seed=2))
+
+
+def test_task_differing_in_other_params_does_not_join():
+    assert not PromptWorker.can_join_batch([make_task(1)], make_task(2, ckpt_name='sdxl'))
+    assert not PromptWorker.can_join_batch([make_task(1)], make_task(2, steps=20))
+    assert not PromptWorker.can_join_batch([make_task(1)], make_task(2, addon_inputs={'lora': [{'weight': 1}]}))
+
+
+def test_same_prompts_join_and_run_once():
+    tasks = [make_task(1, seed=1), make_task(2, seed=2), make_task(3, seed=1)]
+    assert PromptWorker.can_join_batch(tasks[:1], tasks[2])
+
+    prompt_tasks, prompt_indexes = PromptWorker.dedupe_prompts(tasks)
+
+    assert [task.id for task in prompt_tasks] == [1, 2]
+    assert prompt_indexes == [0, 1, 0]
+
+
+def test_split_results_of_batch():
+    results = {'result': {'images': ['a', 'b', 'c', 'd']}, 'ui': 'shared', 'odd': [1, 2, 3]}
+
+    first, second = PromptWorker.split_results(results, 2)
+
+    assert first == {'result': {'images': ['a', 'b']}, 'ui': 'shared', 'odd': [1, 2, 3]}
+    assert second == {'result': {'images': ['c', 'd']}, 'ui': 'shared', 'odd': [1, 2, 3]}
+    assert PromptWorker.split_results(results, 1) == [results]
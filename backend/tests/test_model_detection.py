@@ -0,0 +1,62 @@
+import os
+import threading
+
+import pytest
+
+pytest.importorskip("torch")
+
+from data_type.base_data_model import DB
+from data_type.whatsai_model_detection import ModelDetection
+
+
+@pytest.fixture
+def model_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(DB, 'path', str(tmp_path / 'test.db'))
+    monkeypatch.setattr(DB, 'local', threading.local())
+    ModelDetection.init()
+
+    path = tmp_path / 'model.safetensors'
+    path.write_bytes(b'0' * 16)
+    return path
+
+
+def save_detection(path, sha_256=None):
+    stat = os.stat(path)
+    ModelDetection(
+        local_path=str(path),
+        kind='checkpoint',
+        mtime=stat.st_mtime,
+        size=stat.st_size,
+        sha_256=sha_256,
+        architecture='SD15',
+        unet_config={'context_dim': 768},
+        unet_prefix='model.diffusion_model.',
+        parameters=1,
+    ).save()
+
+
+def test_detection_of_file_not_changed(model_file):
+    save_detection(model_file)
+
+    detection = ModelDetection.get_of_file(str(model_file), 'checkpoint')
+
+    assert detection.architecture == 'SD15'
+    assert detection.unet_config == {'context_dim': 768}
+    assert ModelDetection.get_of_file(str(model_file), 'diffusion_model') is None
+
+
+def test_detection_of_file_changed_is_stale(model_file):
+    save_detection(model_file)
+
+    model_file.write_bytes(b'0' * 32)
+
+    assert ModelDetection.get_of_file(str(model_file), 'checkpoint') is None
+
+
+def test_detection_of_same_sha_256_is_taken(model_file):
+    save_detection(model_file, sha_256='abc')
+
+    model_file.write_bytes(b'0' * 32)
+
+    assert ModelDetection.get_of_file(str(model_file), 'checkpoint', sha_256='abc').architecture == 'SD15'
+    assert ModelDetection.get_of_file(str(model_file), 'checkpoint', sha_256='other') is None
@@ -0,0 +1,65 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from core.abstracts.cache import ContentOutputsCache
+from core.abstracts.card_plan import PlannedFunc
+from prompt_worker import PromptWorker
+
+
+class Func_Load:
+    pass
+
+
+class Func_Sample:
+    pass
+
+
+def fingerprint(func, inputs, upstream_fingerprints=None, widget_inputs=(('seed', 'seed'),), upstream_links=()):
+    planned_func = PlannedFunc(func, None, 0, None, list(widget_inputs), list(upstream_links))
+    return PromptWorker.func_fingerprint(planned_func, inputs, None, upstream_fingerprints or {})
+
+
+def test_same_inputs_same_fingerprint_across_prompts():
+    assert fingerprint(Func_Sample(), {'seed': 1, 'other': 'x'}) == fingerprint(Func_Sample(), {'seed': 1})
+    assert fingerprint(Func_Sample(), {'seed': 1}) != fingerprint(Func_Sample(), {'seed': 2})
+    assert fingerprint(Func_Sample(), {'seed': 1}) != fingerprint(Func_Load(), {'seed': 1})
+
+
+def test_upstream_fingerprint_changes_fingerprint():
+    links = [('model', 'load', 0, 'model')]
+    sample = Func_Sample()
+
+    with_sd15 = fingerprint(sample, {'seed': 1}, {'load': fingerprint(Func_Load(), {'seed': 'sd15'})},
+                            upstream_links=links)
+    with_sdxl = fingerprint(sample, {'seed': 1}, {'load': fingerprint(Func_Load(), {'seed': 'sdxl'})},
+                            upstream_links=links)
+
+    assert with_sd15 != with_sdxl
+
+
+def test_hits_and_misses():
+    cache = ContentOutputsCache(budget_bytes=1 << 20)
+    key = fingerprint(Func_Sample(), {'seed': 1})
+
+    assert cache.get(key) is None
+    cache.put(key, {0: {'latent': torch.zeros(4)}})
+    assert cache.get(key)[0]['latent'].shape == (4,)
+    assert cache.get(fingerprint(Func_Sample(), {'seed': 2})) is None
+
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 2
+
+
+def test_least_recently_used_is_evicted_over_budget():
+    tensor_bytes = 16 * 4  # float32
+    cache = ContentOutputsCache(budget_bytes=2 * tensor_bytes)
+
+    cache.put('a', {0: {'latent': torch.zeros(16)}})
+    cache.put('b', {0: {'latent': torch.zeros(16)}})
+    cache.get('a')
+    evicted = cache.put('c', {0: {'latent': torch.zeros(16)}})
+
+    assert evicted == ['b']
+    assert cache.keys() == ['a', 'c']
+    assert cache.total_bytes == 2 * tensor_bytes
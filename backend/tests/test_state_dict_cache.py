@@ -0,0 +1,74 @@
+from collections import OrderedDict
+
+import pytest
+
+torch = pytest.importorskip("torch")
+safetensors_torch = pytest.importorskip("safetensors.torch")
+
+from misc import arg_parser
+from misc import state_dict_cache
+from misc.state_dict_cache import LazyStateDict, StateDictCache
+
+
+@pytest.fixture
+def safetensors_file(tmp_path):
+    tensors = {
+        'weight': torch.randn(4, 8),
+        'half': torch.randn(3, 5).half(),
+        'bf16': torch.randn(7).bfloat16(),
+        'index': torch.arange(6, dtype=torch.int64).reshape(2, 3),
+        'byte': torch.arange(5, dtype=torch.uint8),
+        'mask': torch.tensor([True, False, True]),
+        'empty': torch.zeros(0, 4),
+        'scalar': torch.tensor(1.5),
+    }
+    path = tmp_path / 'model.safetensors'
+    safetensors_torch.save_file(tensors, str(path), metadata={'format': 'pt'})
+    return path
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    monkeypatch.setattr(StateDictCache, 'entries', OrderedDict())
+    monkeypatch.setattr(StateDictCache, 'entry_bytes', {})
+    monkeypatch.setattr(StateDictCache, 'total_bytes', 0)
+    monkeypatch.setattr(StateDictCache, 'hits', 0)
+    monkeypatch.setattr(arg_parser, 'lazy_safetensors', True)
+    return StateDictCache
+
+
+def test_lazy_state_dict_same_as_safetensors(safetensors_file):
+    expected = safetensors_torch.load_file(str(safetensors_file))
+
+    sd = LazyStateDict(str(safetensors_file))
+
+    assert sd.metadata == {'format': 'pt'}
+    assert sorted(sd) == sorted(expected)
+    for key, tensor in expected.items():
+        assert sd[key].dtype == tensor.dtype
+        assert sd[key].shape == tensor.shape
+        assert torch.equal(sd[key], tensor)
+
+
+def test_cached_lazy_state_dict_is_shallow_copy(safetensors_file, cache):
+    sd = cache.load_torch_file(str(safetensors_file))
+    sd.pop('weight')
+
+    again = cache.load_torch_file(str(safetensors_file))
+
+    assert 'weight' in again
+    assert isinstance(cache.entries[next(iter(cache.entries))], LazyStateDict)
+    assert cache.stats()['hits'] == 1
+
+
+def test_dtype_not_mapped_is_loaded_in_full(safetensors_file, cache, monkeypatch):
+    dtypes = dict(state_dict_cache.SAFETENSORS_DTYPES)
+    dtypes.pop('BF16')
+    monkeypatch.setattr(state_dict_cache, 'SAFETENSORS_DTYPES', dtypes)
+
+    with pytest.raises(ValueError):
+        LazyStateDict(str(safetensors_file))
+
+    sd = cache.load_torch_file(str(safetensors_file))
+
+    assert torch.equal(sd['bf16'], safetensors_torch.load_file(str(safetensors_file))['bf16'])
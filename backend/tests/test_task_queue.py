@@ -0,0 +1,129 @@
+from collections import Counter, OrderedDict
+
+import pytest
+
+pytest.importorskip("torch")
+
+from data_type.whatsai_card import Prompt
+from data_type.whatsai_task import Task, TaskPriority, TaskStatus
+from prompt_worker import PromptWorker, TaskQueue
+
+CARD = 'test_card'
+
+
+def make_task(task_id, client_id='a', priority=TaskPriority.normal.value, ckpt='sd15'):
+    return Task(
+        id=task_id,
+        client_id=client_id,
+        status=TaskStatus.queued.value,
+        card_name=CARD,
+        prompt=Prompt(card_name=CARD, base_inputs={'ckpt_name': ckpt}),
+        field0=priority,
+    )
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    monkeypatch.setattr(TaskQueue, 'queues', {priority.value: OrderedDict() for priority in TaskPriority})
+    monkeypatch.setattr(TaskQueue, 'waiting', {priority.value: OrderedDict() for priority in TaskPriority})
+    monkeypatch.setattr(TaskQueue, 'waiting_of_clients', Counter())
+    monkeypatch.setattr(TaskQueue, 'in_flight', Counter())
+    monkeypatch.setattr(TaskQueue, 'max_in_flight', 0)
+    monkeypatch.setattr(TaskQueue, 'affinity_window', 0)
+    monkeypatch.setattr(TaskQueue, 'affinity_max_skips', 2)
+    monkeypatch.setattr(TaskQueue, 'current_model_key', None)
+    monkeypatch.setattr(PromptWorker, 'model_param_names_of_cards', {CARD: ({'ckpt_name'}, {})})
+    return TaskQueue
+
+
+def put(queue, *tasks):
+    for task in tasks:
+        queue.put_task(task)
+
+
+def got_ids(queue, count):
+    return [queue.get(timeout=0).id for _ in range(count)]
+
+
+def test_higher_priority_goes_first(queue):
+    put(queue, make_task(1), make_task(2, priority='low'), make_task(3, priority='high'))
+
+    assert got_ids(queue, 3) == [3, 1, 2]
+    assert queue.get(timeout=0) is None
+
+
+def test_clients_take_turns(queue):
+    put(queue, make_task(1, 'a'), make_task(2, 'a'), make_task(3, 'a'), make_task(4, 'b'))
+
+    assert got_ids(queue, 4) == [1, 4, 2, 3]
+
+
+def test_full_client_waits_for_its_task_done(queue):
+    queue.max_in_flight = 1
+    put(queue, make_task(1, 'a'), make_task(2, 'a'), make_task(3, 'b'))
+
+    first = queue.get(timeout=0)
+    assert [first.id, *got_ids(queue, 1)] == [1, 3]
+    assert queue.get(timeout=0) is None
+
+    queue.task_done(first)
+    assert got_ids(queue, 1) == [2]
+
+
+def test_canceled_task_is_not_got(queue):
+    put(queue, make_task(1, 'a'), make_task(2, 'b'))
+
+    assert queue.cancel(1)
+    assert not queue.cancel(1)
+    assert got_ids(queue, 1) == [2]
+    assert queue.get(timeout=0) is None
+    assert queue.stats()['depth'] == 0
+    assert queue.stats()['depth_of_clients'] == {}
+
+
+def test_waiting_above_and_stats(queue):
+    put(queue, make_task(1, 'a', 'low'), make_task(2, 'b', 'low'))
+    assert not queue.has_waiting_above('normal')
+
+    put(queue, make_task(3, 'a', 'high'))
+    assert queue.has_waiting_above('normal')
+    assert not queue.has_waiting_above('high')
+
+    stats = queue.stats()
+    assert stats['depth'] == 3
+    assert stats['depth_of_priorities'] == {'high': 1, 'normal': 0, 'low': 2}
+    assert stats['depth_of_clients'] == {'a': 2, 'b': 1}
+
+
+def test_upcoming_model_keys_by_priority(queue):
+    put(queue, make_task(1, ckpt='sd15', priority='low'), make_task(2, ckpt='sdxl', priority='high'))
+
+    assert queue.upcoming_model_keys(1) == [frozenset({'sdxl'})]
+    assert queue.upcoming_model_keys(5) == [frozenset({'sdxl'}), frozenset({'sd15'})]
+
+
+def test_affinity_runs_task_of_loaded_models_first(queue):
+    queue.affinity_window = 4
+    queue.current_model_key = frozenset({'sdxl'})
+    put(queue, make_task(1, ckpt='sd15'), make_task(2, ckpt='sdxl'))
+
+    assert got_ids(queue, 2) == [2, 1]
+    assert queue.current_model_key == frozenset({'sd15'})
+
+
+def test_affinity_gives_up_after_max_skips(queue):
+    queue.affinity_window = 4
+    queue.affinity_max_skips = 1
+    queue.current_model_key = frozenset({'sdxl'})
+    put(queue, make_task(1, ckpt='sd15'), make_task(2, ckpt='sdxl'), make_task(3, ckpt='sdxl'))
+
+    assert got_ids(queue, 3) == [2, 1, 3]
+
+
+def test_affinity_window_counts_tasks_of_same_priority(queue):
+    queue.affinity_window = 2
+    queue.current_model_key = frozenset({'sdxl'})
+    put(queue, make_task(1, priority='low'), make_task(2, priority='low'))
+    put(queue, make_task(3, ckpt='sd15'), make_task(4, ckpt='sdxl'))
+
+    assert got_ids(queue, 2) == [4, 3]